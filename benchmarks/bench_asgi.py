@@ -0,0 +1,100 @@
+"""
+Requests/sec and latency of the sync mode (gunicorn, one sync worker) and the
+async mode (uvicorn asgi:app, one worker) with many requests in flight.
+
+    python benchmarks/bench_asgi.py [concurrency] [seconds]
+
+Both servers run as subprocesses on the same database (BENCH_DATABASE_URL) and
+every client thread keeps its own connection open where the server allows it.
+"""
+import http.client
+import os
+import subprocess
+import sys
+import threading
+import time
+from common import SRC, DATABASE_URL, load_app, reset_database, seed_catalogue, seed_users, seed_favorites
+
+PATHS = ["/planet?limit=50", "/planet/17", "/character?species=droid&limit=20", "/vehicle/3", "/favorites/user/1"]
+SERVERS = {
+    "sync (gunicorn)": ["gunicorn", "--workers", "1", "--bind", "127.0.0.1:{port}", "wsgi"],
+    "async (uvicorn)": ["uvicorn", "--workers", "1", "--port", "{port}", "--log-level", "warning", "asgi:app"],
+}
+
+
+def start_server(command, port):
+    env = dict(os.environ, DATABASE_URL=DATABASE_URL)
+    process = subprocess.Popen([part.format(port=port) for part in command], cwd=SRC, env=env)
+    for _ in range(100):
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/planet/1")
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    sys.exit("%s did not start" % command[0])
+
+
+def run_load(port, concurrency, duration):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(number):
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        mine = []
+        i = number
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                connection.request("GET", PATHS[i % len(PATHS)])
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    raise OSError(response.status)
+                mine.append(time.perf_counter() - started)
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                with lock:
+                    errors[0] += 1
+            i += 1
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+    return len(latencies) / elapsed, percentile(0.5), percentile(0.99), errors[0]
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    app = load_app()
+    reset_database(app)
+    seed_catalogue(app, 5000)
+    seed_users(app, 100)
+    seed_favorites(app, 20)
+
+    print("%d concurrent clients, %.0fs per server, GET %s" % (concurrency, duration, " ".join(PATHS)))
+    for port, (name, command) in enumerate(SERVERS.items(), start=8701):
+        process = start_server(command, port)
+        try:
+            rate, p50, p99, errors = run_load(port, concurrency, duration)
+        finally:
+            process.terminate()
+            process.wait()
+        print("%-16s %8.0f req/s   p50 %7.1f ms   p99 %7.1f ms   errors %d" % (name, rate, p50, p99, errors))
+
+
+if __name__ == "__main__":
+    main()
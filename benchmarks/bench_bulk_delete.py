@@ -0,0 +1,58 @@
+"""
+Purging planets: one DELETE /planet/<id> per row against one DELETE /planet?ids=.
+
+    python benchmarks/bench_bulk_delete.py [rows]
+
+Both runs start from the same seeded database (200 users with 10 favorites of
+each kind) and delete `rows` planets, the favorites pointing to them included.
+The table shows the time taken and the SQL statements sent.
+"""
+import sys
+import time
+from sqlalchemy import event
+from common import load_app, reset_database, seed_catalogue, seed_users, seed_favorites
+
+CATALOGUE = 5000
+
+
+def run(app, client, rows, bulk):
+    from models import db
+    reset_database(app)
+    seed_catalogue(app, CATALOGUE)
+    seed_users(app, 200)
+    seed_favorites(app, 10)
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    ids = list(range(1, rows + 1))
+    started = time.perf_counter()
+    if bulk:
+        response = client.delete("/planet?ids=" + ",".join(map(str, ids)))
+        assert response.status_code == 200 and response.get_json()["deleted"] == rows
+    else:
+        for id in ids:
+            assert client.delete("/planet/%d" % id).status_code == 200
+    elapsed = time.perf_counter() - started
+    event.remove(engine, "before_cursor_execute", count)
+    return elapsed, statements[0]
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    app = load_app()
+    app.config['BULK_DELETE_MAX'] = max(app.config['BULK_DELETE_MAX'], rows)
+    client = app.test_client()
+
+    print("deleting %d of %d planets" % (rows, CATALOGUE))
+    print("%-26s %10s %12s" % ("", "seconds", "statements"))
+    for name, bulk in (("DELETE /planet/<id>", False), ("DELETE /planet?ids=", True)):
+        elapsed, statements = run(app, client, rows, bulk)
+        print("%-26s %10.2f %12d" % (name, elapsed, statements))
+
+
+if __name__ == "__main__":
+    main()
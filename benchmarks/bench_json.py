@@ -0,0 +1,61 @@
+"""
+CPU time per request of the full list endpoints with the orjson and the
+standard library backends of json_provider.FastJSONProvider.
+
+    python benchmarks/bench_json.py [rows] [requests]
+"""
+import sys
+import time
+from common import load_app, reset_database, seed_catalogue
+
+
+def cpu_ms_per_request(client, path, requests):
+    client.get(path)
+    started = time.process_time()
+    for _ in range(requests):
+        client.get(path)
+    return (time.process_time() - started) * 1000 / requests
+
+
+def encode_ms(app, model, repeat):
+    with app.app_context():
+        items = list(map(lambda x: x.serialize(), model.query.all()))
+        app.json.response(items)
+        started = time.process_time()
+        for _ in range(repeat):
+            app.json.response(items)
+        return (time.process_time() - started) * 1000 / repeat
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    app = load_app()
+    if not app.json.use_orjson:
+        sys.exit("orjson is not installed, nothing to compare")
+    reset_database(app)
+    seed_catalogue(app, rows)
+    app.config['SNAPSHOT_LISTS'] = False
+    client = app.test_client()
+
+    print("%d rows per table, CPU ms per request" % rows)
+    print("%-12s %10s %10s %8s" % ("route", "stdlib", "orjson", "saved"))
+    for path in ("/planet", "/character", "/vehicle"):
+        app.json.use_orjson = False
+        stdlib = cpu_ms_per_request(client, path, requests)
+        app.json.use_orjson = True
+        fast = cpu_ms_per_request(client, path, requests)
+        print("%-12s %10.2f %10.2f %7.0f%%" % (path, stdlib, fast, 100 * (stdlib - fast) / stdlib))
+
+    from models import Planet, Character, Vehicle
+    print("\nencoding only (jsonify of the serialized list), CPU ms")
+    for model in (Planet, Character, Vehicle):
+        app.json.use_orjson = False
+        stdlib = encode_ms(app, model, requests)
+        app.json.use_orjson = True
+        fast = encode_ms(app, model, requests)
+        print("%-12s %10.2f %10.2f %7.0f%%" % (model.__tablename__, stdlib, fast, 100 * (stdlib - fast) / stdlib))
+
+
+if __name__ == "__main__":
+    main()
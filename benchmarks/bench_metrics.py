@@ -0,0 +1,36 @@
+"""
+Overhead of the request/SQL metrics (metrics.py): requests/sec with the
+metrics enabled and disabled, alternating to even out noise.
+
+    python benchmarks/bench_metrics.py [rows] [rounds]
+"""
+import statistics
+import sys
+from common import load_app, reset_database, seed_catalogue, requests_per_second
+
+PATHS = ["/planet/1", "/planet?limit=50", "/character?species=droid&limit=20", "/vehicle"]
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    app = load_app()
+    reset_database(app)
+    seed_catalogue(app, rows)
+    import app as module
+    metrics = module.metrics
+    client = app.test_client()
+
+    print("%-36s %10s %10s %9s" % ("path", "off req/s", "on req/s", "overhead"))
+    for path in PATHS:
+        rates = {False: [], True: []}
+        for _ in range(rounds):
+            for enabled in (False, True):
+                metrics.enabled = enabled
+                rates[enabled].append(requests_per_second(client, path, duration=1.0))
+        off, on = statistics.median(rates[False]), statistics.median(rates[True])
+        print("%-36s %10.0f %10.0f %8.1f%%" % (path, off, on, (off - on) / off * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Cost of building the list of dicts for a full table: ORM objects + serialize()
+against serialized_select() rows + serialize_row().
+
+    python benchmarks/bench_projection.py [rows]
+"""
+import sys
+import time
+import tracemalloc
+from common import load_app, reset_database, seed_catalogue
+
+
+def measure(fn, repeat=5):
+    fn()
+    started = time.process_time()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.process_time() - started) * 1000 / repeat
+    # memory is measured on a separate run, tracemalloc slows everything down
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak / 1024 / 1024
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    app = load_app()
+    reset_database(app)
+    seed_catalogue(app, rows)
+    from models import db, Planet, Character, Vehicle, serialized_select, serialize_row
+
+    print("%d rows per table" % rows)
+    print("%-10s %14s %14s %10s %10s" % ("table", "orm ms", "rows ms", "orm MiB", "rows MiB"))
+    with app.app_context():
+        for model in (Planet, Character, Vehicle):
+            def orm():
+                result = list(map(lambda x: x.serialize(), model.query.all()))
+                db.session.expunge_all()
+                return result
+
+            def projected():
+                return [serialize_row(model, row) for row in db.session.execute(serialized_select(model)).all()]
+
+            orm_ms, orm_mib = measure(orm)
+            rows_ms, rows_mib = measure(projected)
+            print("%-10s %14.1f %14.1f %10.1f %10.1f" % (model.__tablename__, orm_ms, rows_ms, orm_mib, rows_mib))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""
+Requests/sec of the full list endpoints with and without SNAPSHOT_LISTS.
+
+    python benchmarks/bench_snapshot.py [rows]
+"""
+import sys
+from common import load_app, reset_database, seed_catalogue, requests_per_second
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    app = load_app()
+    reset_database(app)
+    seed_catalogue(app, rows)
+    client = app.test_client()
+
+    print("%d rows per table" % rows)
+    print("%-12s %12s %12s %12s" % ("route", "serialize", "snapshot", "snapshot+gz"))
+    for path in ("/planet", "/character", "/vehicle"):
+        app.config['SNAPSHOT_LISTS'] = False
+        plain = requests_per_second(client, path)
+        app.config['SNAPSHOT_LISTS'] = True
+        snapshot = requests_per_second(client, path)
+        gzipped = requests_per_second(client, path, headers={"Accept-Encoding": "gzip"})
+        print("%-12s %10.1f/s %10.1f/s %10.1f/s" % (path, plain, snapshot, gzipped))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Start up time of a worker: importing app.py, create_app(), the first API
+request and the first /admin request, with and without API_ONLY.
+
+    python benchmarks/bench_startup.py [runs]
+
+Every run is a fresh interpreter, like a new gunicorn worker without --preload,
+and the table shows the median of the runs in milliseconds.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from common import SRC, DATABASE_URL, load_app, reset_database, seed_catalogue
+
+MODES = {"default": {}, "API_ONLY=1": {"API_ONLY": "1"}}
+STEPS = ("import", "create_app", "first request", "first /admin")
+
+
+def child():
+    # runs in the fresh interpreter, prints the timings as JSON
+    timings = {}
+    sys.path.insert(0, SRC)
+    started = time.perf_counter()
+    import app as module
+    timings["import"] = time.perf_counter() - started
+    started = time.perf_counter()
+    app = module.create_app()
+    timings["create_app"] = time.perf_counter() - started
+    client = app.test_client()
+    started = time.perf_counter()
+    assert client.get("/planet/1").status_code == 200
+    timings["first request"] = time.perf_counter() - started
+    if not app.config['API_ONLY']:
+        started = time.perf_counter()
+        assert client.get("/admin/").status_code == 200
+        timings["first /admin"] = time.perf_counter() - started
+    print(json.dumps(timings))
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    app = load_app()
+    reset_database(app)
+    seed_catalogue(app, 100)
+
+    print("%-12s %s" % ("ms", "".join("%15s" % step for step in STEPS)))
+    for mode, env in MODES.items():
+        env = dict(os.environ, DATABASE_URL=DATABASE_URL, **env)
+        timings = {step: [] for step in STEPS}
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, __file__, "--child"], env=env, capture_output=True, text=True, check=True).stdout
+            for step, seconds in json.loads(output.splitlines()[-1]).items():
+                timings[step].append(seconds * 1000)
+        print("%-12s %s" % (mode, "".join(
+            "%15.1f" % statistics.median(timings[step]) if timings[step] else "%15s" % "-" for step in STEPS)))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--child"]:
+        child()
+    else:
+        main()
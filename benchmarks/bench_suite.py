@@ -0,0 +1,226 @@
+"""
+Benchmark suite: serialize micro-benchmarks and every route of the API driven
+in-process through the WSGI test client. The results go to a JSON file that
+compare.py diffs against an earlier run.
+
+    python benchmarks/bench_suite.py [--seconds 1] [--output results.json] [--only favorites]
+    python benchmarks/compare.py baseline.json results.json
+
+The database (BENCH_DATABASE_URL) is reset and seeded with the same data on
+every run (CATALOGUE, USERS and FAVORITES below). Each case runs for --seconds
+after one warm-up call, and the JSON has ops/sec and the mean, p50 and p95 time
+per call. The creates run before the deletes, which remove what they created.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+from common import SRC, DATABASE_URL, load_app, reset_database, seed_catalogue, seed_users, seed_favorites
+
+CATALOGUE = 5000
+USERS = 200
+FAVORITES = 10
+
+
+def planet_body(name):
+    return {"name": name, "population": 1000, "climate": "arid", "terrain": "desert", "diameter": 10465,
+            "rotation_period": 23, "orbital_period": 304, "gravity": "1 standard", "surface_water": 1,
+            "created": "2021-09-01"}
+
+
+def character_body(name):
+    return {"name": name, "height": 172, "mass": 77, "hair_color": "blond", "age": 19,
+            "homeworld": "Tatooine", "species": "human"}
+
+
+def vehicle_body(name):
+    return {"name": name, "model": "T-65", "manufacturer": "Incom", "length": 12, "max_atmosphering_speed": 1050,
+            "passengers": 0, "cargo_capacity": 110, "consumables": "1 week"}
+
+
+def run(fn, seconds):
+    """
+    Calls fn(i) for i = 0, 1, ... during `seconds`, the first call is a warm-up.
+    fn raises StopIteration when it has nothing left to do. Returns the timings, or None.
+    """
+    timings = []
+    deadline = time.perf_counter() + seconds
+    i = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            fn(i)
+        except StopIteration:
+            break
+        if i > 0:
+            timings.append(time.perf_counter() - started)
+        i += 1
+    if not timings:
+        return None
+    timings.sort()
+    return {
+        "iterations": len(timings),
+        "ops_per_sec": round(len(timings) / sum(timings), 1),
+        "mean_ms": round(statistics.mean(timings) * 1000, 4),
+        "p50_ms": round(timings[len(timings) // 2] * 1000, 4),
+        "p95_ms": round(timings[int(len(timings) * 0.95)] * 1000, 4),
+    }
+
+
+def request(client, method, path, status=(200,), **kwargs):
+    response = client.open(path, method=method, **kwargs)
+    assert response.status_code in status, "%s %s: %s" % (method, path, response.status_code)
+    return response
+
+
+def micro_cases(app):
+    # the objects are loaded once, the cases only time serialize() / serialize_favorites()
+    from models import User, Planet, Character, Vehicle, Favorite
+    from sqlalchemy.orm import selectinload
+
+    def serialize(items):
+        return lambda i: items[i % len(items)].serialize()
+    with app.app_context():
+        cases = {"serialize/%s" % model.__tablename__: serialize(model.query.limit(1000).all())
+                 for model in (User, Planet, Character, Vehicle)}
+        users = User.query.options(
+            selectinload(User.favorite_vehicle).joinedload(Favorite.vehicle),
+            selectinload(User.favorite_character).joinedload(Favorite.character),
+            selectinload(User.favorite_planet).joinedload(Favorite.planet)
+        ).limit(100).all()
+    cases["serialize_favorites/%d favorites" % (FAVORITES * 3)] = lambda i: users[i % len(users)].serialize_favorites()
+    return cases
+
+
+def route_cases(app, client):
+    cases = {}
+    for table in ("user", "planet", "character", "vehicle"):
+        cases["GET /%s" % table] = lambda i, table=table: request(client, "GET", "/%s" % table)
+        cases["GET /%s?limit=100" % table] = lambda i, table=table: request(client, "GET", "/%s?limit=100" % table)
+        cases["GET /%s/<id>" % table] = lambda i, table=table: request(client, "GET", "/%s/%d" % (table, i % 100 + 1))
+    cases["GET /planet (gzip)"] = lambda i: request(client, "GET", "/planet", headers={"Accept-Encoding": "gzip"})
+    cases["GET /planet?limit=100 (gzip)"] = lambda i: request(client, "GET", "/planet?limit=100", headers={"Accept-Encoding": "gzip"})
+    cases["GET /planet?climate=arid&sort=-population&limit=20"] = \
+        lambda i: request(client, "GET", "/planet?climate=arid&sort=-population&limit=20")
+    cases["GET /favorites/user/<id>"] = lambda i: request(client, "GET", "/favorites/user/%d" % (i % USERS + 1))
+    cases["GET /search?q=planet-1"] = lambda i: request(client, "GET", "/search?q=planet-1")
+    cases["GET /popular/planet?top=10"] = lambda i: request(client, "GET", "/popular/planet?top=10")
+
+    # creates first, then the deletes remove what they created
+    created = {}
+    for table, body in (("planet", planet_body), ("character", character_body), ("vehicle", vehicle_body)):
+        created[table] = []
+        cases["POST /%s" % table] = lambda i, table=table, body=body: created[table].append(
+            request(client, "POST", "/%s" % table, json=body("bench-%s-%d" % (table, i))).get_json()["id"])
+    # a client retrying the same create: every call after the first replays the stored response
+    cases["POST /planet (Idempotency-Key replay)"] = lambda i: request(
+        client, "POST", "/planet", json=planet_body("bench-idempotent"), headers={"Idempotency-Key": "bench-replay"})
+    with app.app_context():
+        from models import db
+        dialect = db.engine.dialect.name
+    if dialect != "sqlite":
+        # create_user passes suscription_date through as a string, SQLite's Date column rejects it
+        cases["POST /user"] = lambda i: request(client, "POST", "/user", json={
+            "username": "bench-%d" % i, "email": "bench-%d@example.com" % i, "password": "x", "suscription_date": "2021-09-01"})
+
+    def favorite_path(i, table):
+        # the i-th (user, created entity) pair; the deletes walk the same pairs as the creates
+        targets = created[table]
+        if not targets:
+            raise StopIteration
+        return "/favorite/user/%d/%s/%d" % (i % USERS + 1, table, targets[i // USERS % len(targets)])
+
+    posted = {}
+
+    def post_favorite(table):
+        def case(i):
+            # 400 once the pairs wrap around
+            request(client, "POST", favorite_path(i, table), status=(200, 400))
+            posted[table] = i + 1
+        return case
+
+    def delete_favorite(table):
+        def case(i):
+            if i >= posted.get(table, 0):
+                raise StopIteration
+            # 404 for the pairs that were posted twice
+            request(client, "DELETE", favorite_path(i, table), status=(200, 404))
+        return case
+    for table in ("planet", "character", "vehicle"):
+        cases["POST /favorite/user/<id>/%s/<id>" % table] = post_favorite(table)
+        cases["DELETE /favorite/user/<id>/%s/<id>" % table] = delete_favorite(table)
+
+    def batch(i):
+        # 30 favorites per request: added on the first pass over the users, removed on the next
+        op = "add" if i // USERS % 2 == 0 else "remove"
+        operations = [{"op": op, "kind": kind, "id": CATALOGUE - n} for kind in ("planet", "character", "vehicle") for n in range(10)]
+        request(client, "POST", "/favorites/user/%d/batch" % (i % USERS + 1), json=operations)
+    cases["POST /favorites/user/<id>/batch (30 operations)"] = batch
+
+    def delete(table):
+        def case(i):
+            if not created[table]:
+                raise StopIteration
+            request(client, "DELETE", "/%s/%d" % (table, created[table].pop()))
+        return case
+    for table in ("planet", "character", "vehicle"):
+        cases["DELETE /%s/<id>" % table] = delete(table)
+    return cases
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(SRC),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the benchmark suite.")
+    parser.add_argument("--seconds", type=float, default=1.0, help="time per case")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--only", help="run the cases whose name contains this text")
+    args = parser.parse_args()
+
+    app = load_app()
+    reset_database(app)
+    seed_catalogue(app, CATALOGUE)
+    seed_users(app, USERS)
+    seed_favorites(app, FAVORITES)
+    client = app.test_client()
+
+    results = {}
+    cases = micro_cases(app)
+    cases.update(route_cases(app, client))
+    for name, fn in cases.items():
+        if args.only and args.only not in name:
+            continue
+        result = run(fn, args.seconds)
+        if result is None:
+            print("%-55s skipped, nothing to do" % name)
+            continue
+        results[name] = result
+        print("%-55s %10.1f ops/s  p50 %8.3f ms  p95 %8.3f ms" % (name, result["ops_per_sec"], result["p50_ms"], result["p95_ms"]))
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "meta": {
+                "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "database": DATABASE_URL.split(":", 1)[0],
+                "seconds": args.seconds,
+                "sizes": {"catalogue": CATALOGUE, "users": USERS, "favorites": FAVORITES},
+            },
+            "results": results,
+        }, f, indent=2, sort_keys=True)
+    print("results written to %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Favorite writes/sec with one transaction per request and with the write-behind
+queue (FAVORITES_WRITE_BEHIND=1).
+
+    python benchmarks/bench_write_behind.py [threads] [seconds]
+
+Each mode runs in a fresh process on the same seeded database (BENCH_DATABASE_URL).
+Every thread toggles favorites of its own users through the WSGI test client:
+POST, then DELETE once the pair was added. At the end the queue is drained and
+the favorite table is checked against what the requests answered.
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from common import DATABASE_URL, load_app, reset_database, seed_catalogue, seed_users
+
+MODES = {"transaction per request": {}, "write-behind": {"FAVORITES_WRITE_BEHIND": "1"}}
+USERS = 200
+TARGETS = 20
+
+
+def child(threads, seconds):
+    app = load_app()
+    import app as module
+    from models import db, Favorite
+    counts = [0] * threads
+    expected = [set() for _ in range(threads)]
+    deadline = time.perf_counter() + seconds
+
+    def worker(number):
+        client = app.test_client()
+        favorites = expected[number]
+        i = 0
+        while time.perf_counter() < deadline:
+            # the users of this thread only, so its view of their favorites is exact
+            pair = (number + threads * (i % (USERS // threads)) + 1, i // (USERS // threads) % TARGETS + 1)
+            path = "/favorite/user/%d/planet/%d" % pair
+            if pair in favorites:
+                assert client.delete(path).status_code == 200
+                favorites.discard(pair)
+            else:
+                assert client.post(path).status_code == 200
+                favorites.add(pair)
+            counts[number] += 1
+            i += 1
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    queue = module.favorite_queue
+    if queue is not None:
+        queue.drain()
+    with app.app_context():
+        stored = set(db.session.execute(db.select(Favorite.user_id, Favorite.target_id)).all())
+    print(json.dumps({
+        "writes_per_sec": sum(counts) / elapsed,
+        "consistent": stored == set().union(*expected),
+        "flushes": queue.flushes if queue is not None else None,
+        "flushed": queue.flushed if queue is not None else None,
+    }))
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    print("%d threads, %.0fs per mode, %s" % (threads, seconds, DATABASE_URL.split(":", 1)[0]))
+    for mode, env in MODES.items():
+        app = load_app()
+        reset_database(app)
+        seed_catalogue(app, TARGETS)
+        seed_users(app, USERS)
+        env = dict(os.environ, **env)
+        output = subprocess.run([sys.executable, __file__, "--child", str(threads), str(seconds)],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        batches = " (%d flushes, %.1f changes per flush)" % (
+            result["flushes"], result["flushed"] / max(result["flushes"], 1)) if result["flushes"] is not None else ""
+        print("%-24s %8.0f writes/s   table consistent: %s%s" % (mode, result["writes_per_sec"], result["consistent"], batches))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--child"]:
+        child(int(sys.argv[2]), float(sys.argv[3]))
+    else:
+        main()
@@ -0,0 +1,98 @@
+"""
+Shared setup for the benchmark scripts: a throwaway database, the Flask app
+and helpers to seed rows and time requests through the WSGI test client.
+
+Run the scripts from the repository root, e.g. `python benchmarks/bench_snapshot.py`.
+BENCH_DATABASE_URL selects the database (defaults to a SQLite file in /tmp).
+"""
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timezone
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+DATABASE_URL = os.getenv("BENCH_DATABASE_URL", "sqlite:////tmp/bench.db")
+
+
+def load_app():
+    # create_app() reads its configuration from the environment
+    os.environ["DATABASE_URL"] = DATABASE_URL
+    if SRC not in sys.path:
+        sys.path.insert(0, SRC)
+    import app
+    return app.app
+
+
+def reset_database(app):
+    from models import db
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+def seed_catalogue(app, count):
+    from models import db, Planet, Character, Vehicle
+    from sqlalchemy import insert
+    now = datetime.now(timezone.utc)
+    with app.app_context():
+        db.session.execute(insert(Planet), [{
+            "name": "planet-%d" % i, "population": i * 1000, "climate": ("arid", "temperate", "frozen")[i % 3],
+            "terrain": ("desert", "jungle", "tundra")[i % 3], "diameter": 1000 + i, "rotation_period": 24,
+            "orbital_period": 365, "gravity": "1 standard", "surface_water": i % 100, "created": now
+        } for i in range(count)])
+        db.session.execute(insert(Character), [{
+            "name": "character-%d" % i, "height": 150 + i % 50, "mass": 50 + i % 70, "hair_color": "brown",
+            "age": 20 + i % 60, "homeworld": "planet-%d" % (i % 100), "species": ("human", "droid", "wookiee")[i % 3]
+        } for i in range(count)])
+        db.session.execute(insert(Vehicle), [{
+            "name": "vehicle-%d" % i, "model": "model-%d" % (i % 10), "manufacturer": ("Incom", "Kuat", "Sienar")[i % 3],
+            "length": 10 + i % 30, "max_atmosphering_speed": 1000, "passengers": i % 40, "cargo_capacity": 100 * i,
+            "consumables": "1 week"
+        } for i in range(count)])
+        db.session.commit()
+
+
+def seed_users(app, count):
+    from models import db, User
+    from sqlalchemy import insert
+    with app.app_context():
+        db.session.execute(insert(User), [{
+            "username": "user-%d" % i, "email": "user-%d@example.com" % i, "password": "password",
+            "suscription_date": date(2021, 9, 1), "is_active": True
+        } for i in range(count)])
+        db.session.commit()
+
+
+def seed_favorites(app, per_user, seed=0):
+    """Gives every user `per_user` favorites of each kind, picked at random (but always the same for a seed)."""
+    from models import db, User, Favorite, FAVORITE_KINDS, Planet, Character, Vehicle
+    from sqlalchemy import insert, select
+    import favorite_documents
+    models = dict(zip(FAVORITE_KINDS, (Planet, Character, Vehicle)))
+    rng = random.Random(seed)
+    with app.app_context():
+        user_ids = db.session.execute(select(User.id).order_by(User.id)).scalars().all()
+        target_ids = {kind: db.session.execute(select(model.id).order_by(model.id)).scalars().all() for kind, model in models.items()}
+        rows = []
+        for user_id in user_ids:
+            for kind in FAVORITE_KINDS:
+                for target_id in rng.sample(target_ids[kind], min(per_user, len(target_ids[kind]))):
+                    rows.append({"user_id": user_id, "kind": kind, "target_id": target_id})
+        for start in range(0, len(rows), 10000):
+            db.session.execute(insert(Favorite), rows[start:start + 10000])
+        db.session.commit()
+        # the rows were inserted without the ORM, build the favorites documents like `flask favorites rebuild`
+        favorite_documents.rebuild(db.session)
+
+
+def requests_per_second(client, path, headers=None, duration=2.0):
+    """Sends GET `path` in a loop for `duration` seconds and returns the request rate."""
+    client.get(path, headers=headers)  # warm up
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        response = client.get(path, headers=headers)
+        assert response.status_code == 200, response.status_code
+        count += 1
+    return count / (time.perf_counter() - started)
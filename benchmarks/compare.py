@@ -0,0 +1,51 @@
+"""
+Compares two result files of bench_suite.py and flags the cases that got slower.
+
+    python benchmarks/compare.py baseline.json results.json [--threshold 10]
+
+Exits with status 1 when a case lost more than --threshold percent of its
+ops/sec, so it can gate a CI job. Timings from different machines or databases
+are not comparable, the "meta" of both files is printed to check that.
+"""
+import argparse
+import json
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two bench_suite.py result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("results")
+    parser.add_argument("--threshold", type=float, default=10.0, help="percent of ops/sec lost that counts as a regression")
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+
+    for label, run in (("baseline", baseline), ("results", results)):
+        meta = run["meta"]
+        print("%-8s %s commit %s, python %s, %s" % (label, meta["date"], meta["commit"], meta["python"], meta["database"]))
+    print()
+    print("%-55s %12s %12s %8s" % ("case", "before ops/s", "after ops/s", "change"))
+    regressions = []
+    for name in sorted(set(baseline["results"]) | set(results["results"])):
+        before = baseline["results"].get(name)
+        after = results["results"].get(name)
+        if before is None or after is None:
+            print("%-55s %12s %12s" % (name, before and before["ops_per_sec"] or "-", after and after["ops_per_sec"] or "-"))
+            continue
+        change = (after["ops_per_sec"] - before["ops_per_sec"]) / before["ops_per_sec"] * 100
+        flag = ""
+        if change < -args.threshold:
+            regressions.append(name)
+            flag = "  <- slower"
+        print("%-55s %12.1f %12.1f %+7.1f%%%s" % (name, before["ops_per_sec"], after["ops_per_sec"], change, flag))
+
+    if regressions:
+        print("\n%d case(s) more than %.0f%% slower" % (len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""add idempotency_key table for Idempotency-Key replays
+
+Revision ID: a6c3e81f2d47
+Revises: e5b1c7d93a28
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c3e81f2d47'
+down_revision = 'e5b1c7d93a28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_key',
+    sa.Column('key', sa.String(length=40), nullable=False),
+    sa.Column('fingerprint', sa.String(length=40), nullable=False),
+    sa.Column('status_code', sa.Integer(), nullable=True),
+    sa.Column('content_type', sa.String(length=100), nullable=True),
+    sa.Column('body', sa.LargeBinary(), nullable=True),
+    sa.Column('expires', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+    # the sweeper deletes by expiry
+    op.create_index('ix_idempotency_key_expires', 'idempotency_key', ['expires'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_idempotency_key_expires', table_name='idempotency_key')
+    op.drop_table('idempotency_key')
@@ -0,0 +1,63 @@
+"""merge favorite_planet, favorite_character and favorite_vehicle into favorite
+
+Revision ID: b3d7a91c52e0
+Revises: 7f1bf5a9004c
+Create Date: 2026-10-18 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3d7a91c52e0'
+down_revision = '7f1bf5a9004c'
+branch_labels = None
+depends_on = None
+
+KINDS = ('planet', 'character', 'vehicle')
+
+
+def upgrade():
+    op.create_table('favorite',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=20), nullable=False),
+    sa.Column('target_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], name='fk_favorite_user_id_user'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ux_favorite_user_kind_target', 'favorite', ['user_id', 'kind', 'target_id'], unique=True)
+    op.create_index('ix_favorite_kind_target', 'favorite', ['kind', 'target_id'], unique=False)
+
+    # rows left with a NULL user or target by old deletes are dropped, duplicates are collapsed
+    for kind in KINDS:
+        op.execute(
+            "INSERT INTO favorite (user_id, kind, target_id) "
+            "SELECT DISTINCT user_id, '{kind}', {kind}_id FROM favorite_{kind} "
+            "WHERE user_id IS NOT NULL AND {kind}_id IS NOT NULL".format(kind=kind)
+        )
+
+    op.drop_table('favorite_vehicle')
+    op.drop_table('favorite_character')
+    op.drop_table('favorite_planet')
+
+
+def downgrade():
+    for kind in KINDS:
+        op.create_table('favorite_%s' % kind,
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('%s_id' % kind, sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['%s_id' % kind], ['%s.id' % kind], ),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id')
+        )
+        op.execute(
+            "INSERT INTO favorite_{kind} (user_id, {kind}_id) "
+            "SELECT user_id, target_id FROM favorite WHERE kind = '{kind}'".format(kind=kind)
+        )
+
+    op.drop_index('ix_favorite_kind_target', table_name='favorite')
+    op.drop_index('ux_favorite_user_kind_target', table_name='favorite')
+    op.drop_table('favorite')
@@ -0,0 +1,29 @@
+"""add favorite_document table for the stored GET /favorites/user/<id> documents
+
+Revision ID: b7e2d4a19c63
+Revises: a6c3e81f2d47
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d4a19c63'
+down_revision = 'a6c3e81f2d47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled by `flask favorites rebuild`, until then the route reads the tables
+    op.create_table('favorite_document',
+    sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('document', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('favorite_document')
@@ -0,0 +1,33 @@
+"""add table_version counters for conditional GETs
+
+Revision ID: c84f2e6b1d95
+Revises: b3d7a91c52e0
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c84f2e6b1d95'
+down_revision = 'b3d7a91c52e0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table('table_version',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # rows exist up front so writers only ever UPDATE them
+    op.bulk_insert(table_version, [
+        {'name': name, 'version': 1}
+        for name in ('user', 'planet', 'character', 'vehicle', 'favorite')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
@@ -0,0 +1,29 @@
+"""cascade deletes from user to favorite
+
+Revision ID: c9f4a2e7b815
+Revises: b7e2d4a19c63
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9f4a2e7b815'
+down_revision = 'b7e2d4a19c63'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # batch: SQLite can't alter a constraint, the table is copied
+    with op.batch_alter_table('favorite') as batch_op:
+        batch_op.drop_constraint('fk_favorite_user_id_user', type_='foreignkey')
+        batch_op.create_foreign_key('fk_favorite_user_id_user', 'user', ['user_id'], ['id'], ondelete='CASCADE')
+
+
+def downgrade():
+    with op.batch_alter_table('favorite') as batch_op:
+        batch_op.drop_constraint('fk_favorite_user_id_user', type_='foreignkey')
+        batch_op.create_foreign_key('fk_favorite_user_id_user', 'user', ['user_id'], ['id'])
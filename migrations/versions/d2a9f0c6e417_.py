@@ -0,0 +1,34 @@
+"""add (column, id) indexes for the list endpoint filters
+
+Revision ID: d2a9f0c6e417
+Revises: c84f2e6b1d95
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a9f0c6e417'
+down_revision = 'c84f2e6b1d95'
+branch_labels = None
+depends_on = None
+
+INDEXED_COLUMNS = {
+    'planet': ('climate', 'terrain', 'population', 'diameter'),
+    'character': ('homeworld', 'species', 'height', 'mass'),
+    'vehicle': ('manufacturer', 'model', 'passengers', 'cargo_capacity'),
+}
+
+
+def upgrade():
+    for table, columns in INDEXED_COLUMNS.items():
+        for column in columns:
+            op.create_index('ix_%s_%s_id' % (table, column), table, [column, 'id'], unique=False)
+
+
+def downgrade():
+    for table, columns in INDEXED_COLUMNS.items():
+        for column in columns:
+            op.drop_index('ix_%s_%s_id' % (table, column), table_name=table)
@@ -0,0 +1,34 @@
+"""add pg_trgm name indexes for SEARCH_BACKEND=database (postgres only)
+
+Revision ID: e5b1c7d93a28
+Revises: d2a9f0c6e417
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b1c7d93a28'
+down_revision = 'd2a9f0c6e417'
+branch_labels = None
+depends_on = None
+
+TABLES = ('planet', 'character', 'vehicle')
+
+
+def upgrade():
+    # other databases search with a prefix range on the existing unique index of name
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table in TABLES:
+        op.execute('CREATE INDEX IF NOT EXISTS ix_%s_name_trgm ON "%s" USING gin (name gin_trgm_ops)' % (table, table))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in TABLES:
+        op.execute('DROP INDEX IF EXISTS ix_%s_name_trgm' % table)
@@ -1,10 +1,14 @@
 import os
 from flask_admin import Admin # type: ignore
-from models import db, User, Planet, Character, Vehicle,Favorite_Planet, Favorite_Character, Favorite_Vehicle
-#, Character, Vehicle, Favorite_Character, Favorite_Planet, Favorite_Vehicle
+from models import db, User, Planet, Character, Vehicle, Favorite
 
 from flask_admin.contrib.sqla import ModelView # type: ignore
 
+class FavoriteView(ModelView):
+    # planet/character/vehicle are read-only relationships resolved from kind + target_id
+    form_columns = ('user', 'kind', 'target_id')
+    column_list = ('user', 'kind', 'target_id')
+
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
@@ -16,9 +20,7 @@ def setup_admin(app):
     admin.add_view(ModelView(Planet, db.session))
     admin.add_view(ModelView(Character, db.session))
     admin.add_view(ModelView(Vehicle, db.session))
-    admin.add_view(ModelView(Favorite_Character, db.session))
-    admin.add_view(ModelView(Favorite_Planet, db.session))
-    admin.add_view(ModelView(Favorite_Vehicle, db.session))
+    admin.add_view(FavoriteView(Favorite, db.session))
 
 
     # You can duplicate that line to add mew models
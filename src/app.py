@@ -1,60 +1,383 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
+
+`create_app()` builds the app; `app` (what `flask`, wsgi.py and asgi.py use) is
+created by it the first time it is accessed, so importing this module is cheap
+and `gunicorn --preload` can do it once in the master. There is one app per
+process: the caches and indexes below are shared by its routes and asgi.py.
 """
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate # type: ignore
-from flask_swagger import swagger # type: ignore
+from datetime import datetime, timezone
+import click
+from flask import Blueprint, Flask, current_app, request, jsonify, g
+from flask.cli import ScriptInfo
 from flask_cors import CORS # type: ignore
-from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Planet, Character, Vehicle, Favorite_Planet, Favorite_Character, Favorite_Vehicle
-
-
-
-
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import selectinload
+from utils import APIException, generate_sitemap, env_flag
+from pagination import paginate, parse_limit
+from filtering import parse_list_query
+from streaming import wants_stream, ndjson_response
+from bulk import parse_bulk_body, bulk_create, parse_ids, bulk_delete
+from favorites import batch_favorites, FAVORITE_MODELS
+import favorite_documents
+from cache import LRUCache, invalidate_changes
+import changes
+import versioning
+from versioning import bump, conditional, conditional_response, make_etag
+from snapshot import SnapshotStore, snapshot_response
+from json_provider import FastJSONProvider
+from database import engine_options, setup_sqlite, pool_stats
+from replicas import ReplicaSet, reads_from_replica, stick_to_primary
+from metrics import Metrics
+from compression import Compression
+from search import SearchIndex, SEARCH_MODELS, database_search
+from popularity import Popularity, POPULAR_MODELS
+from lazy_admin import LazyAdmin
+from idempotency import IdempotencyStore
+from write_behind import FavoriteQueue, ADD
+from sqlalchemy.exc import IntegrityError
+from models import db, User, Planet, Character, Vehicle, Favorite, serialized_select, serialize_row
+
+api = Blueprint("api", __name__)
+
+# set up by create_app
+read_replicas = None
+metrics = None
+compression = None
+entity_cache = None
+list_snapshots = None
+search_index = None
+popularity = None
+favorite_queue = None
+# created here and configured by create_app: the POST routes are decorated with it
+idempotency = IdempotencyStore()
+
+changes.track(db.session)
+changes.on_commit(lambda changed: invalidate_changes(entity_cache, changed))
+# every write bumps the table version the ETags of the GET routes are built from
+changes.on_write(bump)
+# and updates the favorites documents it makes stale
+favorite_documents.track(db.session)
+# registered last: the versions are bumped after everything else the commit does
+versioning.track(db.session)
+
+
+def create_app():
+    global read_replicas, metrics, compression, entity_cache, list_snapshots, search_index, popularity, favorite_queue
+    app = Flask(__name__)
+    app.url_map.strict_slashes = False
+    app.json = FastJSONProvider(app)
+
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
+    else:
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # connection pool of each worker: keep workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+    # under the database's connection limit, see GET /pool/stats
+    app.config['DB_POOL_SIZE'] = int(os.getenv("DB_POOL_SIZE", 5))
+    app.config['DB_MAX_OVERFLOW'] = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    app.config['DB_POOL_TIMEOUT'] = int(os.getenv("DB_POOL_TIMEOUT", 30))
+    # seconds before a connection is replaced (-1 never), and a ping before reusing one,
+    # so connections closed by the server or a proxy while idle are not handed out
+    app.config['DB_POOL_RECYCLE'] = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    app.config['DB_POOL_PRE_PING'] = env_flag("DB_POOL_PRE_PING", True)
+    # WAL, synchronous=NORMAL, mmap and busy timeout on SQLite connections
+    app.config['SQLITE_PRAGMAS'] = env_flag("SQLITE_PRAGMAS", True)
+    app.config['SQLITE_MMAP_SIZE'] = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+    app.config['SQLITE_BUSY_TIMEOUT'] = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+    # comma separated replicas of DATABASE_URL for the GET/HEAD requests, see replicas.py
+    app.config['READ_REPLICA_URLS'] = [
+        url.strip().replace("postgres://", "postgresql://") for url in os.getenv("READ_REPLICA_URLS", "").split(",") if url.strip()
+    ]
+    app.config['REPLICA_EJECT_SECONDS'] = int(os.getenv("REPLICA_EJECT_SECONDS", 30))
+    app.config['READ_YOUR_WRITES_SECONDS'] = int(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+    # GET /metrics, and warnings for slow statements and requests with too many of them
+    app.config['METRICS_ENABLED'] = env_flag("METRICS_ENABLED", True)
+    app.config['SLOW_QUERY_MS'] = int(os.getenv("SLOW_QUERY_MS", 200))
+    app.config['SQL_WARN_STATEMENTS'] = int(os.getenv("SQL_WARN_STATEMENTS", 20))
+
+    # list endpoints: default and maximum page size for ?limit=, and whether a request
+    # without pagination params still gets the whole table as a plain array
+    app.config['PAGE_SIZE'] = int(os.getenv("PAGE_SIZE", 100))
+    app.config['MAX_PAGE_SIZE'] = int(os.getenv("MAX_PAGE_SIZE", 1000))
+    app.config['LEGACY_FULL_LIST'] = env_flag("LEGACY_FULL_LIST", True)
+    # rows fetched per round trip (and per chunk) in ?stream=1 / NDJSON exports
+    app.config['STREAM_BATCH_SIZE'] = int(os.getenv("STREAM_BATCH_SIZE", 1000))
+    # rows per INSERT statement in the /<entity>/bulk endpoints
+    app.config['BULK_BATCH_SIZE'] = int(os.getenv("BULK_BATCH_SIZE", 1000))
+    # ids per DELETE /<entity>?ids= request, deleted BULK_BATCH_SIZE per statement
+    app.config['BULK_DELETE_MAX'] = int(os.getenv("BULK_DELETE_MAX", 10000))
+    # operations per POST /favorites/user/<id>/batch request
+    app.config['FAVORITES_BATCH_MAX'] = int(os.getenv("FAVORITES_BATCH_MAX", 1000))
+    # cache for GET /<entity>/<id>, 0 entries disables it
+    app.config['CACHE_MAX_ENTRIES'] = int(os.getenv("CACHE_MAX_ENTRIES", 10000))
+    app.config['CACHE_TTL'] = int(os.getenv("CACHE_TTL", 300))
+    # keep the full list responses pre-encoded in memory until the next write
+    app.config['SNAPSHOT_LISTS'] = env_flag("SNAPSHOT_LISTS", False)
+    # GET /search: "memory" (index in every worker) or "database" (pg_trgm on postgres)
+    app.config['SEARCH_BACKEND'] = os.getenv("SEARCH_BACKEND", "memory")
+    app.config['SEARCH_REFRESH_SECONDS'] = int(os.getenv("SEARCH_REFRESH_SECONDS", 60))
+    app.config['SEARCH_MAX_RESULTS'] = int(os.getenv("SEARCH_MAX_RESULTS", 50))
+    # GET /popular/<kind>: how often the favorite counts are checked against the database, how often
+    # they are reloaded even if no one else wrote to the table, and the largest ?top=
+    app.config['POPULAR_REFRESH_SECONDS'] = int(os.getenv("POPULAR_REFRESH_SECONDS", 60))
+    app.config['POPULAR_RECONCILE_SECONDS'] = int(os.getenv("POPULAR_RECONCILE_SECONDS", 600))
+    app.config['POPULAR_MAX_TOP'] = int(os.getenv("POPULAR_MAX_TOP", 100))
+    # gzip/brotli for text responses of at least COMPRESSION_MIN_SIZE bytes, compressed bodies of the ETag routes are cached
+    app.config['COMPRESSION_ENABLED'] = env_flag("COMPRESSION_ENABLED", True)
+    app.config['COMPRESSION_MIN_SIZE'] = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+    app.config['COMPRESSION_LEVEL'] = int(os.getenv("COMPRESSION_LEVEL", 6))
+    app.config['COMPRESSION_BROTLI_QUALITY'] = int(os.getenv("COMPRESSION_BROTLI_QUALITY", 5))
+    app.config['COMPRESSION_CACHE_ENTRIES'] = int(os.getenv("COMPRESSION_CACHE_ENTRIES", 256))
+    # Idempotency-Key on the POST routes: how long responses are kept, how long a
+    # request holds its key, the LRU in front of the table and the expired rows sweeper
+    app.config['IDEMPOTENCY_TTL'] = int(os.getenv("IDEMPOTENCY_TTL", 86400))
+    app.config['IDEMPOTENCY_LOCK_SECONDS'] = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", 60))
+    app.config['IDEMPOTENCY_CACHE_ENTRIES'] = int(os.getenv("IDEMPOTENCY_CACHE_ENTRIES", 1000))
+    app.config['IDEMPOTENCY_SWEEP_SECONDS'] = int(os.getenv("IDEMPOTENCY_SWEEP_SECONDS", 300))
+    app.config['IDEMPOTENCY_SWEEP_BATCH'] = int(os.getenv("IDEMPOTENCY_SWEEP_BATCH", 1000))
+    # queue the favorite POST/DELETE and write them in batches, every FAVORITES_FLUSH_MS or
+    # FAVORITES_FLUSH_BATCH changes, see write_behind.py
+    app.config['FAVORITES_WRITE_BEHIND'] = env_flag("FAVORITES_WRITE_BEHIND", False)
+    app.config['FAVORITES_FLUSH_MS'] = int(os.getenv("FAVORITES_FLUSH_MS", 10))
+    app.config['FAVORITES_FLUSH_BATCH'] = int(os.getenv("FAVORITES_FLUSH_BATCH", 500))
+    # no /admin: for the workers that only serve the API
+    app.config['API_ONLY'] = env_flag("API_ONLY", False)
+
+    # the `flask db` commands are the only users of Flask-Migrate, which imports
+    # alembic: a third of the start up time of a worker
+    cli = click.get_current_context(silent=True)
+    if cli is not None and cli.find_object(ScriptInfo) is not None:
+        from flask_migrate import Migrate # type: ignore
+        Migrate(app, db)
+    db.init_app(app)
+    with app.app_context():
+        setup_sqlite(db.engine, app.config)
+    if app.config['READ_REPLICA_URLS']:
+        replica_engines = [create_engine(url, **engine_options(app.config, url)) for url in app.config['READ_REPLICA_URLS']]
+        for engine in replica_engines:
+            setup_sqlite(engine, app.config)
+        read_replicas = ReplicaSet(replica_engines, eject_seconds=app.config['REPLICA_EJECT_SECONDS'])
+    CORS(app)
+    # flask favorites rebuild / check
+    app.cli.add_command(favorite_documents.cli)
+    if not app.config['API_ONLY']:
+        app.wsgi_app = LazyAdmin(app)
+    # first, so its before/after_request hooks time the other ones too
+    metrics = Metrics(
+        slow_query_ms=app.config['SLOW_QUERY_MS'],
+        warn_statements=app.config['SQL_WARN_STATEMENTS'],
+        enabled=app.config['METRICS_ENABLED']
+    )
+    metrics.init_app(app)
+    compression = Compression(
+        min_size=app.config['COMPRESSION_MIN_SIZE'],
+        level=app.config['COMPRESSION_LEVEL'],
+        brotli_quality=app.config['COMPRESSION_BROTLI_QUALITY'],
+        cache_entries=app.config['COMPRESSION_CACHE_ENTRIES'],
+        enabled=app.config['COMPRESSION_ENABLED']
+    )
+    compression.init_app(app)
+
+    # serialized entities by "<table>:<id>", dropped as soon as a commit touches the row
+    entity_cache = LRUCache(maxsize=app.config['CACHE_MAX_ENTRIES'], ttl=app.config['CACHE_TTL'])
+    list_snapshots = SnapshotStore()
+    search_index = SearchIndex(refresh_seconds=app.config['SEARCH_REFRESH_SECONDS'])
+    popularity = Popularity(
+        refresh_seconds=app.config['POPULAR_REFRESH_SECONDS'],
+        reconcile_seconds=app.config['POPULAR_RECONCILE_SECONDS']
+    )
+    idempotency.init_app(app)
+    if app.config['FAVORITES_WRITE_BEHIND']:
+        favorite_queue = FavoriteQueue(
+            flush_ms=app.config['FAVORITES_FLUSH_MS'],
+            batch_size=app.config['FAVORITES_FLUSH_BATCH'],
+            on_applied=count_favorites
+        )
+        favorite_queue.init_app(app)
+    app.register_blueprint(api)
+    return app
+
+@api.before_app_request
+def warm_up_search_index():
+    # start building this worker's search index as soon as it gets its first request
+    if current_app.config['SEARCH_BACKEND'] == "memory":
+        search_index.warm_up(current_app._get_current_object())
+
+@api.before_app_request
+def choose_read_replica():
+    # db.session sends the statements of this request to g.read_replica, see RoutingSession
+    if read_replicas is not None and reads_from_replica(request.method, request.cookies):
+        g.read_replica = read_replicas.choose()
+
+@api.after_app_request
+def read_your_writes(response):
+    if read_replicas is not None and request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        stick_to_primary(response, current_app.config['READ_YOUR_WRITES_SECONDS'])
+    return response
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return generate_sitemap(current_app)
+
+@api.route('/search', methods=['GET'])
+def search():
+    # example: /search?q=tat&kind=planet,vehicle&limit=5, add &fuzzy=1 for similar names after the prefix matches
+    q = request.args.get("q", "").strip()
+    if not q:
+        raise APIException("You need to specify the q parameter", status_code=400)
+    limit = parse_limit(request.args.get("limit"), 10, current_app.config['SEARCH_MAX_RESULTS'])
+    kinds = tuple(filter(None, request.args.get("kind", ",".join(SEARCH_MODELS)).split(",")))
+    if not kinds or any(kind not in SEARCH_MODELS for kind in kinds):
+        raise APIException("kind must be one of %s" % ", ".join(SEARCH_MODELS), status_code=400)
+    fuzzy = request.args.get("fuzzy", "").lower() in ("1", "true", "yes")
+
+    if current_app.config['SEARCH_BACKEND'] == "database":
+        results = database_search(q, limit, kinds, fuzzy)
+    else:
+        search_index.ensure_built(current_app._get_current_object())
+        search_index.maybe_refresh(current_app._get_current_object())
+        results = search_index.search(q, limit, kinds, fuzzy)
+    return jsonify({"results": [{"kind": kind, "id": id, "name": name} for kind, id, name in results]}), 200
+
+@api.route('/popular/<kind>', methods=['GET'])
+def popular(kind):
+    # example: /popular/planet?top=5, the most favorited first
+    model = POPULAR_MODELS.get(kind)
+    if model is None:
+        raise APIException("kind must be one of %s" % ", ".join(POPULAR_MODELS), status_code=404)
+    top = parse_limit(request.args.get("top"), 10, current_app.config['POPULAR_MAX_TOP'], name="top")
+    popularity.ensure_built(current_app._get_current_object())
+    popularity.maybe_refresh(current_app._get_current_object())
+    ranking = popularity.top(kind, top)
+    names = dict(db.session.execute(select(model.id, model.name).where(model.id.in_([id for id, _ in ranking]))).all())
+    return jsonify({
+        "results": [{"id": id, "name": names[id], "favorites": count} for id, count in ranking if id in names]
+    }), 200
+
+@api.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(entity_cache.stats()), 200
+
+@api.route('/pool/stats', methods=['GET'])
+def get_pool_stats():
+    stats = pool_stats(db.engine)
+    if read_replicas is not None:
+        stats["replicas"] = [
+            dict(pool_stats(engine), **status) for engine, status in zip(read_replicas.engines, read_replicas.status())
+        ]
+    return jsonify(stats), 200
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text format, for this worker only
+    pools = [("primary", pool_stats(db.engine))]
+    if read_replicas is not None:
+        pools += [(engine.url.render_as_string(hide_password=True), pool_stats(engine)) for engine in read_replicas.engines]
+    body = metrics.render(entity_cache.stats(), pools)
+    return body, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def list_response(model):
+    # read only: rows are selected as plain tuples of the serialized columns, no ORM objects
+    list_query = parse_list_query(model, request.args)
+    if wants_stream(request):
+        return ndjson_response(db.session, list_query, current_app.config['STREAM_BATCH_SIZE'])
+
+    limit = request.args.get("limit")
+    after = request.args.get("after")
+    if limit is None and after is None and list_query.is_default and current_app.config['LEGACY_FULL_LIST']:
+        if current_app.config['SNAPSHOT_LISTS']:
+            # g.table_versions was read by @conditional
+            snapshot = list_snapshots.get(model, g.table_versions[model.__tablename__])
+            return snapshot_response(snapshot, request)
+        rows = db.session.execute(serialized_select(model)).all()
+        return jsonify([serialize_row(model, row) for row in rows]), 200
+
+    limit = parse_limit(limit, current_app.config['PAGE_SIZE'], current_app.config['MAX_PAGE_SIZE'])
+    rows, next_cursor, prev_cursor = paginate(db.session, list_query.statement(), list_query.order, limit, after)
+    return jsonify({
+        "results": [list_query.serialize(row) for row in rows],
+        "next": next_cursor,
+        "prev": prev_cursor
+    }), 200
+
+def get_response(model, id):
+    key = "%s:%s" % (model.__tablename__, id)
+    # the version the ETag was made from, set by @conditional
+    version = g.table_versions[model.__tablename__]
+    serialized = entity_cache.get(key, version)
+    if serialized is None:
+        item = db.session.get(model, id)
+        if item is None:
+            raise APIException("%s not found" % model.__name__, status_code=404)
+        serialized = item.serialize()
+        entity_cache.set(key, serialized, version)
+    return jsonify(serialized), 200
+
+def delete_rows(model, ids):
+    # the favorites of these rows go with them: the queued ones must be in the table first
+    flush_favorites()
+    # the search index and the favorite counts are updated below
+    versioning.local_write(db.session, "favorite")
+    if model is not User:
+        versioning.local_write(db.session, model.__tablename__)
+    deleted, removed = bulk_delete(model, ids, current_app.config['BULK_BATCH_SIZE'])
+    for (kind, target_id), count in removed.items():
+        popularity.change(kind, target_id, -count)
+    if model is not User:
+        for row in deleted:
+            search_index.remove(model.__tablename__, row["id"])
+            popularity.remove(model.__tablename__, row["id"])
+    return deleted
+
+def delete_response(model, id):
+    deleted = delete_rows(model, [id])
+    if not deleted:
+        raise APIException("%s not found" % model.__name__, status_code=404)
+    return jsonify(deleted[0]), 200
+
+def bulk_delete_response(model):
+    ids = parse_ids(request.args, current_app.config['BULK_DELETE_MAX'])
+    deleted = {row["id"] for row in delete_rows(model, ids)}
+    return jsonify({"deleted": len(deleted), "not_found": [id for id in ids if id not in deleted]}), 200
+
+def bulk_response(model, defaults=None):
+    rows = parse_bulk_body(request)
+    versioning.local_write(db.session, model.__tablename__)
+    status, results = bulk_create(model, rows, defaults, current_app.config['BULK_BATCH_SIZE'])
+    if status == 200:
+        for result in results:
+            search_index.add(model.__tablename__, result["id"], rows[result["index"]]["name"])
+    created = len([x for x in results if x["status"] == "created"])
+    return jsonify({"created": created, "results": results}), status
 
 ####################################
 # CRUD for User
 ####################################
 
-@app.route('/user', methods=['GET'])
+@api.route('/user', methods=['GET'])
+@conditional("user")
 def get_user():
-    users= User.query.all()
-    users = list(map(lambda x: x.serialize(), users))
-    return jsonify(users), 200
+    return list_response(User)
 
 
-@app.route('/user/<int:id>', methods=['GET'])
+@api.route('/user/<int:id>', methods=['GET'])
+@conditional("user")
 def get_user_id(id):
-    user = User.query.get(id)
-    return jsonify(user.serialize()), 200
+    return get_response(User, id)
 
-@app.route('/user', methods=['POST'])
+@api.route('/user', methods=['POST'])
+@idempotency.idempotent
 def create_user():
     request_body = request.get_json()
     user = User(
@@ -68,31 +391,31 @@ def create_user():
     db.session.commit()
     return jsonify(user.serialize()), 200
 
-@app.route('/user/<int:id>', methods=['DELETE'])
+@api.route('/user/<int:id>', methods=['DELETE'])
 def delete_user(id):
-    user = User.query.get(id)
-    if user is None:
-        raise APIException("User not found", status_code=404)
-    db.session.delete(user)
-    db.session.commit()
-    return jsonify(user.serialize()), 200
+    return delete_response(User, id)
+
+@api.route('/user', methods=['DELETE'])
+def delete_user_bulk():
+    # example: DELETE /user?ids=1,2,3
+    return bulk_delete_response(User)
 
 ####################################
 # CRUD for Planet
 ####################################
 
-@app.route('/planet', methods=['GET'])
+@api.route('/planet', methods=['GET'])
+@conditional("planet")
 def get_planet():
-    planets= Planet.query.all()
-    planets = list(map(lambda x: x.serialize(), planets))
-    return jsonify(planets), 200
+    return list_response(Planet)
 
-@app.route('/planet/<int:id>', methods=['GET'])
+@api.route('/planet/<int:id>', methods=['GET'])
+@conditional("planet")
 def get_planet_id(id):
-    planet = Planet.query.get(id)
-    return jsonify(planet.serialize()), 200
+    return get_response(Planet, id)
 
-@app.route('/planet', methods=['POST'])
+@api.route('/planet', methods=['POST'])
+@idempotency.idempotent
 def create_planet():
     request_body = request.get_json()
     planet = Planet(
@@ -109,34 +432,44 @@ def create_planet():
         )
     #exmple: dict = {"name": "test", "population": 1, "climate": "test", "terrain": "test", "diameter": 1, "rotation_period": 1, "orbital_period": 1, "gravity": "test", "surface_water": 1, "created": "2021-09-01"}
     db.session.add(planet)
+    # applied to the search index below, not a reason to rebuild it
+    versioning.local_write(db.session, "planet")
     db.session.commit()
+    search_index.add("planet", planet.id, planet.name)
     return jsonify(planet.serialize()), 200
 
-@app.route('/planet/<int:id>', methods=['DELETE'])
+@api.route('/planet/bulk', methods=['POST'])
+@idempotency.idempotent
+def create_planet_bulk():
+    # accepts a JSON array or NDJSON, example: [{...}, {...}] with the same fields as POST /planet
+    # created is always set by the server, like in create_planet
+    return bulk_response(Planet, {"created": datetime.now(timezone.utc)})
+
+@api.route('/planet/<int:id>', methods=['DELETE'])
 def delete_planet(id):
-    planet = Planet.query.get(id)
-    if planet is None:
-        raise APIException("Planet not found", status_code=404)
-    db.session.delete(planet)
-    db.session.commit()
-    return jsonify(planet.serialize()), 200
+    return delete_response(Planet, id)
+
+@api.route('/planet', methods=['DELETE'])
+def delete_planet_bulk():
+    # example: DELETE /planet?ids=1,2,3
+    return bulk_delete_response(Planet)
 
 ####################################
 # CRUD for Character
 ####################################
 
-@app.route('/character', methods=['GET'])
+@api.route('/character', methods=['GET'])
+@conditional("character")
 def get_character():
-    characters= Character.query.all()
-    characters = list(map(lambda x: x.serialize(), characters))
-    return jsonify(characters), 200
+    return list_response(Character)
 
-@app.route('/character/<int:id>', methods=['GET'])
+@api.route('/character/<int:id>', methods=['GET'])
+@conditional("character")
 def get_character_id(id):
-    character = Character.query.get(id)
-    return jsonify(character.serialize()), 200
+    return get_response(Character, id)
 
-@app.route('/character', methods=['POST'])
+@api.route('/character', methods=['POST'])
+@idempotency.idempotent
 def create_character():
     request_body = request.get_json()
     character = Character(
@@ -150,34 +483,43 @@ def create_character():
         )
     #exmple: dict = {"name": "test", "height": 1, "mass": 1, "hair_color": "test", "age": 1, "homeworld": "test", "species": "test"}
     db.session.add(character)
+    # applied to the search index below, not a reason to rebuild it
+    versioning.local_write(db.session, "character")
     db.session.commit()
+    search_index.add("character", character.id, character.name)
     return jsonify(character.serialize()), 200
 
-@app.route('/character/<int:id>', methods=['DELETE'])
+@api.route('/character/bulk', methods=['POST'])
+@idempotency.idempotent
+def create_character_bulk():
+    # accepts a JSON array or NDJSON, example: [{...}, {...}] with the same fields as POST /character
+    return bulk_response(Character)
+
+@api.route('/character/<int:id>', methods=['DELETE'])
 def delete_character(id):
-    character = Character.query.get(id)
-    if character is None:
-        raise APIException("Character not found", status_code=404)
-    db.session.delete(character)
-    db.session.commit()
-    return jsonify(character.serialize()), 200
+    return delete_response(Character, id)
+
+@api.route('/character', methods=['DELETE'])
+def delete_character_bulk():
+    # example: DELETE /character?ids=1,2,3
+    return bulk_delete_response(Character)
 
 ####################################
 # CRUD for Vehicle
 ####################################
 
-@app.route('/vehicle', methods=['GET'])
+@api.route('/vehicle', methods=['GET'])
+@conditional("vehicle")
 def get_vehicle():
-    vehicles= Vehicle.query.all()
-    vehicles = list(map(lambda x: x.serialize(), vehicles))
-    return jsonify(vehicles), 200
+    return list_response(Vehicle)
 
-@app.route('/vehicle/<int:id>', methods=['GET'])
+@api.route('/vehicle/<int:id>', methods=['GET'])
+@conditional("vehicle")
 def get_vehicle_id(id):
-    vehicle = Vehicle.query.get(id)
-    return jsonify(vehicle.serialize()), 200
+    return get_response(Vehicle, id)
 
-@app.route('/vehicle', methods=['POST'])
+@api.route('/vehicle', methods=['POST'])
+@idempotency.idempotent
 def create_vehicle():
     request_body = request.get_json()
     vehicle = Vehicle(
@@ -192,159 +534,190 @@ def create_vehicle():
         )
     #exmple: dict = {"name": "test", "model": "test", "manufacturer": "test", "length": 1, "max_atmosphering_speed": 1, "passengers": 1, "cargo_capacity": 1, "consumables": "test"}
     db.session.add(vehicle)
+    # applied to the search index below, not a reason to rebuild it
+    versioning.local_write(db.session, "vehicle")
     db.session.commit()
+    search_index.add("vehicle", vehicle.id, vehicle.name)
     return jsonify(vehicle.serialize()), 200
 
-@app.route('/vehicle/<int:id>', methods=['DELETE'])
+@api.route('/vehicle/bulk', methods=['POST'])
+@idempotency.idempotent
+def create_vehicle_bulk():
+    # accepts a JSON array or NDJSON, example: [{...}, {...}] with the same fields as POST /vehicle
+    return bulk_response(Vehicle)
+
+@api.route('/vehicle/<int:id>', methods=['DELETE'])
 def delete_vehicle(id):
-    vehicle = Vehicle.query.get(id)
-    if vehicle is None:
-        raise APIException("Vehicle not found", status_code=404)
-    db.session.delete(vehicle)
-    db.session.commit()
-    return jsonify(vehicle.serialize()), 200
+    return delete_response(Vehicle, id)
+
+@api.route('/vehicle', methods=['DELETE'])
+def delete_vehicle_bulk():
+    # example: DELETE /vehicle?ids=1,2,3
+    return bulk_delete_response(Vehicle)
 
 
 ####################################
 # GET Favorites
 ####################################
 
-@app.route('/favorites/user/<int:user_id>', methods=['GET'])
+@api.route('/favorites/user/<int:user_id>', methods=['GET'])
 def get_all_favorites(user_id):
-    user = User.query.get(user_id)
-    if user is None:
-        raise APIException("User not found", status_code=404)    
-    
-    return jsonify(user.serialize_favorites()), 200
+    pending = favorite_queue.pending(user_id) if favorite_queue is not None else None
+    document = favorite_documents.read(db.session, user_id)
+    if pending:
+        # queued changes are not in the document yet: no ETag until they are flushed
+        return user_favorites_response(user_id, document, pending)
+    if document is None:
+        return conditional_user_favorites(user_id)
+    # tagged from this user's document, the writes of other users don't change it
+    return conditional_response(make_etag(favorite_documents.validator(document)), document_response, document)
+
+@conditional("user", "favorite", "planet", "character", "vehicle")
+def conditional_user_favorites(user_id):
+    return user_favorites_response(user_id, None)
+
+def document_response(document):
+    # stored encoded, see favorite_documents.py
+    return current_app.response_class(document + "\n", mimetype=current_app.json.mimetype), 200
+
+def user_favorites_response(user_id, document, pending=None):
+    if document is not None:
+        serialized = current_app.json.loads(document)
+    else:
+        # no document yet (before `flask favorites rebuild`): load the three favorite lists
+        # and their targets up front, 4 queries no matter how many favorites the user has
+        user = User.query.options(
+            selectinload(User.favorite_vehicle).joinedload(Favorite.vehicle),
+            selectinload(User.favorite_character).joinedload(Favorite.character),
+            selectinload(User.favorite_planet).joinedload(Favorite.planet)
+        ).filter_by(id=user_id).one_or_none()
+        if user is None:
+            raise APIException("User not found", status_code=404)
+        serialized = user.serialize_favorites()
+    for (kind, target_id), op in (pending or {}).items():
+        # the user reads their own writes before the flush
+        items = serialized["favorite_%s" % kind]
+        items[:] = [item for item in items if item["id"] != target_id]
+        target = db.session.get(FAVORITE_MODELS[kind], target_id) if op == ADD else None
+        if target is not None:
+            items.append(target.serialize())
+    return jsonify(serialized), 200
 
 ####################################
-# CRUD for Favorite_Planet
+# CRUD for Favorites
 ####################################
 
-@app.route('/favorite/user/<int:user_id>/planet/<int:planet_id>', methods=['POST'])
-def create_favorite_planet(user_id, planet_id):
-    # Verifica si los campos requeridos fueron proporcionados
-    if user_id is None or planet_id is None:
-        raise APIException("You need to specify the user_id and planet_id", status_code=400)
-
-    # Verifica si el usuario y el planeta existen
-    user = User.query.get(user_id)
-    planet = Planet.query.get(planet_id)
-
-    if user is None or planet is None:
-        raise APIException("User or planet not found", status_code=404)
-
-    # Verifica si el favorito ya existe
-    existing_favorite_planet = Favorite_Planet.query.filter_by(user_id=user_id, planet_id=planet_id).first()
-    
-    if existing_favorite_planet:
+def favorite_exists(user_id, kind, target_id):
+    # write-behind mode: the table, unless a change of this favorite is waiting in the queue
+    waiting = favorite_queue.state(user_id, kind, target_id)
+    if waiting is not None:
+        return waiting == ADD
+    statement = select(Favorite.id).where(Favorite.user_id == user_id, Favorite.kind == kind, Favorite.target_id == target_id)
+    return db.session.execute(statement).first() is not None
+
+def count_favorites(applied):
+    # the (delta, kind, target_id) of committed favorite changes, into this worker's rankings
+    for delta, kind, target_id in applied:
+        popularity.change(kind, target_id, delta)
+
+def flush_favorites():
+    # for the routes that change favorites in bulk: the queued changes go in first
+    if favorite_queue is not None:
+        favorite_queue.drain()
+
+def add_favorite(user_id, kind, model, target_id):
+    user = db.session.get(User, user_id)
+    target = db.session.get(model, target_id)
+    if user is None or target is None:
+        raise APIException("User or %s not found" % kind, status_code=404)
+
+    serialized = target.serialize()
+    if favorite_queue is not None:
+        # add() is False when a request for the same favorite queued it since the check;
+        # the favorite counts are updated by the flush, see count_favorites()
+        if favorite_exists(user_id, kind, target_id) or not favorite_queue.add(user_id, kind, target_id):
+            raise APIException("Favorite already exists", status_code=400)
+        return jsonify(serialized), 200
+
+    # the unique index on (user_id, kind, target_id) detects duplicates, no need to look first
+    db.session.add(Favorite(user_id=user_id, kind=kind, target_id=target_id))
+    # the favorite counts are updated below
+    versioning.local_write(db.session, "favorite")
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
         raise APIException("Favorite already exists", status_code=400)
-
-    # Crea un nuevo favorito si no existe
-    favorite_planet = Favorite_Planet(user_id=user_id, planet_id=planet_id)
-    
-    db.session.add(favorite_planet)
+    popularity.change(kind, target_id, 1)
+    return jsonify(serialized), 200
+
+def remove_favorite(user_id, kind, target_id):
+    if favorite_queue is not None:
+        if not favorite_exists(user_id, kind, target_id) or not favorite_queue.remove(user_id, kind, target_id):
+            raise APIException("Favorite_%s not found" % kind, status_code=404)
+        return jsonify({"message": "Favorite %s deleted" % kind}), 200
+
+    deleted = Favorite.query.filter_by(user_id=user_id, kind=kind, target_id=target_id).delete(synchronize_session=False)
+    versioning.local_write(db.session, "favorite")
+    changes.record(db.session, "favorite")
+    favorite_documents.mark_favorite(db.session, user_id, kind, target_id, False)
+    if deleted == 0:
+        db.session.rollback()
+        raise APIException("Favorite_%s not found" % kind, status_code=404)
     db.session.commit()
+    popularity.change(kind, target_id, -1)
+    return jsonify({"message": "Favorite %s deleted" % kind}), 200
 
-    return jsonify(favorite_planet.serialize()), 200
-
+@api.route('/favorite/user/<int:user_id>/planet/<int:planet_id>', methods=['POST'])
+@idempotency.idempotent
+def create_favorite_planet(user_id, planet_id):
+    return add_favorite(user_id, "planet", Planet, planet_id)
 
-@app.route('/favorite/user/<int:user_id>/planet/<int:planet_id>', methods=['DELETE'])
+@api.route('/favorite/user/<int:user_id>/planet/<int:planet_id>', methods=['DELETE'])
 def delete_favorite_planet(user_id, planet_id):
-    favorite_planet = Favorite_Planet.query.filter_by(user_id=user_id, planet_id=planet_id).first()
-    if favorite_planet is None:
-        raise APIException("Favorite_planet not found", status_code=404)
-    
-    db.session.delete(favorite_planet)
-    db.session.commit()
-    return jsonify({"message": "Favorite vehicle deleted"}), 200
+    return remove_favorite(user_id, "planet", planet_id)
 
-####################################
-# CRUD for Favorite_Character
-####################################
-
-@app.route('/favorite/user/<int:user_id>/character/<int:character_id>', methods=['POST'])
+@api.route('/favorite/user/<int:user_id>/character/<int:character_id>', methods=['POST'])
+@idempotency.idempotent
 def create_favorite_character(user_id, character_id):
-    
-    if user_id is None or character_id is None:
-        raise APIException("You need to specify the user_id and character_id", status_code=400)
-    
-    user = User.query.get(user_id)
-    character = Character.query.get(character_id)
-
-    if user is None or character is None:
-        raise APIException("User or character not found", status_code=404)
-
-    existing_favorite_character = Favorite_Character.query.filter_by(user_id=user_id, character_id=character_id).first()
-
-    if existing_favorite_character:
-        raise APIException("Favorite already exists", status_code=400)
-
-    favorite_character = Favorite_Character(user_id=user_id, character_id=character_id)    
-    
-    db.session.add(favorite_character)
-    db.session.commit()
-    return jsonify(favorite_character.serialize()), 200
+    return add_favorite(user_id, "character", Character, character_id)
 
-@app.route('/favorite/user/<int:user_id>/character/<int:character_id>', methods=['DELETE'])
+@api.route('/favorite/user/<int:user_id>/character/<int:character_id>', methods=['DELETE'])
 def delete_favorite_character(user_id, character_id):
-    favorite_character = Favorite_Character.query.filter_by(user_id=user_id, character_id=character_id).first()
-    if favorite_character is None:
-        raise APIException("Favorite_character not found", status_code=404)
-    db.session.delete(favorite_character)
-    db.session.commit()
-    return jsonify({"message": "Favorite vehicle deleted"}), 200
-
-    
-####################################
-# CRUD for Favorite_Vehicle
-####################################
-
+    return remove_favorite(user_id, "character", character_id)
 
-@app.route('/favorite/user/<int:user_id>/vehicle/<int:vehicle_id>', methods=['POST'])
+@api.route('/favorite/user/<int:user_id>/vehicle/<int:vehicle_id>', methods=['POST'])
+@idempotency.idempotent
 def create_favorite_vehicle(user_id, vehicle_id):
-    
-    if user_id is None or vehicle_id is None:
-        raise APIException("You need to specify the user_id and vehicle_id", status_code=400)
-    
-    user = User.query.get(user_id)
-    vehicle = Vehicle.query.get(vehicle_id)
-
-    if user is None or vehicle is None:
-        raise APIException("User or Vehicle not found", status_code=404)
-
-    existing_favorite_vehicle = Favorite_Vehicle.query.filter_by(user_id=user_id, vehicle_id=vehicle_id).first()
-    if existing_favorite_vehicle:
-        raise APIException("Favorite already exists", status_code=400)
+    return add_favorite(user_id, "vehicle", Vehicle, vehicle_id)
 
-    favorite_vehicle = Favorite_Vehicle(user_id=user_id, vehicle_id=vehicle_id)    
-    
-    db.session.add(favorite_vehicle)
-    db.session.commit()
-    return jsonify(favorite_vehicle.serialize()), 200
-
-@app.route('/favorite/user/<int:user_id>/vehicle/<int:vehicle_id>', methods=['DELETE'])
+@api.route('/favorite/user/<int:user_id>/vehicle/<int:vehicle_id>', methods=['DELETE'])
 def delete_favorite_vehicle(user_id, vehicle_id):
-    try:
-        # Buscar la relación Favorite_Vehicle con la sesión activa
-        favorite_vehicle = Favorite_Vehicle.query.filter_by(user_id=user_id, vehicle_id=vehicle_id).one_or_none()
-
-        if favorite_vehicle is None:
-            raise APIException("Favorite_Vehicle not found", status_code=404)        
-        db.session.delete(favorite_vehicle)
-        db.session.commit()
-
-        return jsonify({"message": "Favorite vehicle deleted"}), 200
-
-    except APIException as e:
-        return jsonify({"message": e.message}), e.status_code
-
-    except Exception as e:
-        db.session.rollback()  # Hacer rollback en caso de error
-        return jsonify({"message": "Internal server error"}), 500
+    return remove_favorite(user_id, "vehicle", vehicle_id)
+
+@api.route('/favorites/user/<int:user_id>/batch', methods=['POST'])
+@idempotency.idempotent
+def batch_user_favorites(user_id):
+    operations = parse_bulk_body(request)
+    flush_favorites()
+    versioning.local_write(db.session, "favorite")
+    status, results, applied = batch_favorites(user_id, operations, current_app.config['FAVORITES_BATCH_MAX'])
+    count_favorites(applied)
+    added = len([x for x in results if x["status"] == "added"])
+    removed = len([x for x in results if x["status"] == "removed"])
+    return jsonify({"added": added, "removed": removed, "results": results}), status
+
+
+def __getattr__(name):
+    # `from app import app` creates the app on first use
+    global app
+    if name == "app":
+        app = create_app()
+        return app
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
@@ -0,0 +1,324 @@
+"""
+ASGI entry point with async handlers for the busiest routes:
+
+    uvicorn asgi:app --app-dir src
+
+The lists, `/<entity>/<id>`, `/favorites/user/<id>` and the favorite POST/DELETE
+routes run as coroutines on an AsyncSession (aiosqlite or asyncpg), so a single
+worker keeps hundreds of requests in flight while they wait on the database.
+Every other request (entity create/delete, bulk, search, admin, NDJSON exports,
+snapshots, favorite POSTs with an Idempotency-Key, the favorite routes when
+FAVORITES_WRITE_BEHIND is on...) is handed to the Flask app unchanged, so the API
+is exactly the one gunicorn serves.
+
+starlette, uvicorn, a2wsgi and aiosqlite come with `pipenv install`; on postgres
+also `pipenv install asyncpg`. ASYNC_DATABASE_URL overrides the URL derived from DATABASE_URL.
+"""
+import os
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+from a2wsgi import WSGIMiddleware  # type: ignore
+from starlette.applications import Starlette  # type: ignore
+from starlette.middleware import Middleware  # type: ignore
+from starlette.middleware.cors import CORSMiddleware  # type: ignore
+from starlette.responses import Response  # type: ignore
+from starlette.routing import Mount, Route  # type: ignore
+from sqlalchemy import delete, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, selectinload, sessionmaker
+from werkzeug.datastructures import MIMEAccept, MultiDict
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+# creating the Flask app also creates the caches the async handlers share with it
+from app import app as flask_app
+from app import entity_cache, popularity, compression, favorite_queue
+from database import engine_options, setup_sqlite, pool_stats
+from replicas import ReplicaSet, reads_from_replica, stick_to_primary
+from utils import APIException
+from pagination import page_statement, page_cursors, parse_limit
+from filtering import parse_list_query
+from streaming import wants_stream
+from compression import compressible
+from idempotency import HEADER as IDEMPOTENCY_HEADER
+from versioning import etag_for, matching_etag, versions_select
+from models import User, Planet, Character, Vehicle, Favorite, serialized_select, serialize_row
+import changes
+import versioning
+import favorite_documents
+
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg", "mysql": "mysql+aiomysql"}
+
+
+def async_url(url):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+class TrackedSession(Session):
+    """The sync side of the AsyncSessions, with its own change tracking listeners."""
+
+
+engine = create_async_engine(
+    os.getenv("ASYNC_DATABASE_URL") or async_url(flask_app.config['SQLALCHEMY_DATABASE_URI']),
+    **engine_options(flask_app.config, for_async=True)
+)
+setup_sqlite(engine.sync_engine, flask_app.config)
+async_session = sessionmaker(engine, class_=AsyncSession, sync_session_class=TrackedSession, expire_on_commit=False)
+# same cache invalidation, table versions and favorites documents as the Flask session
+changes.track(TrackedSession)
+favorite_documents.track(TrackedSession)
+versioning.track(TrackedSession)
+
+read_replicas = None
+if flask_app.config['READ_REPLICA_URLS']:
+    replica_engines = [
+        create_async_engine(async_url(url), **engine_options(flask_app.config, url, for_async=True))
+        for url in flask_app.config['READ_REPLICA_URLS']
+    ]
+    for replica in replica_engines:
+        setup_sqlite(replica.sync_engine, flask_app.config)
+    read_replicas = ReplicaSet(replica_engines, eject_seconds=flask_app.config['REPLICA_EJECT_SECONDS'])
+
+
+def read_session(request):
+    # same routing as the Flask app: GET/HEAD on a replica unless the client wrote recently
+    if read_replicas is not None and reads_from_replica(request.method, request.cookies):
+        replica = read_replicas.choose()
+        if replica is not None:
+            return async_session(bind=replica)
+    return async_session()
+
+# the other routes, run in a thread pool
+wsgi_app = WSGIMiddleware(flask_app)
+
+
+class Passthrough:
+    """A response that hands the request over to the Flask app."""
+    async def __call__(self, scope, receive, send):
+        await wsgi_app(scope, receive, send)
+
+
+def json_response(obj, status_code=200):
+    return Response(flask_app.json.dumps(obj) + "\n", status_code=status_code, media_type="application/json")
+
+
+async def handle_api_exception(request, error):
+    return json_response(error.to_dict(), error.status_code)
+
+
+async def get_pool_stats(request):
+    # the pool of the async handlers; the Flask routes have their own
+    stats = pool_stats(engine.sync_engine)
+    if read_replicas is not None:
+        stats["replicas"] = [
+            dict(pool_stats(replica.sync_engine), **status) for replica, status in zip(read_replicas.engines, read_replicas.status())
+        ]
+    return json_response(stats)
+
+
+async def conditional(request, session, tables, view):
+    """Same ETag / 304 handling as versioning.conditional, for the async handlers."""
+    versions = dict.fromkeys(tables, 0)
+    versions.update((await session.execute(versions_select(tables))).all())
+    # like g.table_versions in the Flask app
+    request.state.table_versions = versions
+    return await conditional_response(request, make_etag(request, versions), view)
+
+
+def make_etag(request, versions):
+    return etag_for("%s?%s" % (request.url.path, request.url.query), request.headers.get("accept", ""), versions)
+
+
+async def conditional_response(request, etag, view):
+    """Same as versioning.conditional_response."""
+    matched = matching_etag(etag, parse_etags(request.headers.get("if-none-match")))
+    if matched is not None:
+        response = Response(status_code=304)
+        response.headers["ETag"] = quote_etag(matched)
+    else:
+        response = await view()
+        if response.status_code != 200:
+            return response
+        response.headers["ETag"] = quote_etag(etag)
+        return compress(request, response, etag)
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+def compress(request, response, etag):
+    """Same compression as the Flask app, sharing its cache of compressed bodies."""
+    response.headers["Vary"] = "Accept"
+    if not compressible(response.media_type):
+        return response
+    response.headers["Vary"] = "Accept, Accept-Encoding"
+    encoding = compression.choose(response.media_type, len(response.body), parse_accept_header(request.headers.get("accept-encoding")))
+    if encoding is not None:
+        response.body = compression.compress(response.body, encoding, etag)
+        response.headers["Content-Length"] = str(len(response.body))
+        response.headers["Content-Encoding"] = encoding
+        response.headers["ETag"] = quote_etag("%s-%s" % (etag, encoding))
+    return response
+
+
+def list_endpoint(model):
+    async def endpoint(request):
+        args = MultiDict(request.query_params.multi_items())
+        list_query = parse_list_query(model, args)
+        limit = args.get("limit")
+        after = args.get("after")
+        full_list = limit is None and after is None and list_query.is_default and flask_app.config['LEGACY_FULL_LIST']
+        accept = parse_accept_header(request.headers.get("accept"), MIMEAccept)
+        if wants_stream(SimpleNamespace(args=args, accept_mimetypes=accept)) or (full_list and flask_app.config['SNAPSHOT_LISTS']):
+            # NDJSON exports and snapshots live in the Flask app
+            return Passthrough()
+
+        async def view():
+            if full_list:
+                rows = (await session.execute(serialized_select(model))).all()
+                return json_response([serialize_row(model, row) for row in rows])
+            page_size = parse_limit(limit, flask_app.config['PAGE_SIZE'], flask_app.config['MAX_PAGE_SIZE'])
+            statement, direction = page_statement(list_query.statement(), list_query.order, page_size, after)
+            rows = (await session.execute(statement)).all()
+            rows, next_cursor, prev_cursor = page_cursors(rows, list_query.order, page_size, after, direction)
+            return json_response({
+                "results": [list_query.serialize(row) for row in rows],
+                "next": next_cursor,
+                "prev": prev_cursor
+            })
+
+        async with read_session(request) as session:
+            return await conditional(request, session, (model.__tablename__,), view)
+    return endpoint
+
+
+def get_endpoint(model):
+    async def endpoint(request):
+        id = request.path_params["id"]
+
+        async def view():
+            key = "%s:%s" % (model.__tablename__, id)
+            version = request.state.table_versions[model.__tablename__]
+            serialized = entity_cache.get(key, version)
+            if serialized is None:
+                item = await session.get(model, id)
+                if item is None:
+                    raise APIException("%s not found" % model.__name__, status_code=404)
+                serialized = item.serialize()
+                entity_cache.set(key, serialized, version)
+            return json_response(serialized)
+
+        async with read_session(request) as session:
+            return await conditional(request, session, (model.__tablename__,), view)
+    return endpoint
+
+
+async def get_all_favorites(request):
+    if favorite_queue is not None:
+        # merges the queued changes, see write_behind.py
+        return Passthrough()
+    user_id = request.path_params["user_id"]
+
+    async def document_response():
+        return Response(document + "\n", media_type="application/json")
+
+    async def view():
+        result = await session.execute(select(User).options(
+            selectinload(User.favorite_vehicle).joinedload(Favorite.vehicle),
+            selectinload(User.favorite_character).joinedload(Favorite.character),
+            selectinload(User.favorite_planet).joinedload(Favorite.planet)
+        ).where(User.id == user_id))
+        user = result.scalars().one_or_none()
+        if user is None:
+            raise APIException("User not found", status_code=404)
+        return json_response(user.serialize_favorites())
+
+    async with read_session(request) as session:
+        document = (await session.execute(favorite_documents.document_select(user_id))).scalar()
+        if document is not None:
+            # same per-user ETag as the Flask route
+            return await conditional_response(request, make_etag(request, favorite_documents.validator(document)), document_response)
+        return await conditional(request, session, ("user", "favorite", "planet", "character", "vehicle"), view)
+
+
+async def write_favorite(request, kind, model):
+    user_id = request.path_params["user_id"]
+    target_id = request.path_params["target_id"]
+    async with async_session() as session:
+        if request.method == "POST":
+            user = await session.get(User, user_id)
+            target = await session.get(model, target_id)
+            if user is None or target is None:
+                raise APIException("User or %s not found" % kind, status_code=404)
+            serialized = target.serialize()
+            session.add(Favorite(user_id=user_id, kind=kind, target_id=target_id))
+            # the favorite counts are updated below, see versioning.local_write()
+            await session.run_sync(versioning.local_write, "favorite")
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                raise APIException("Favorite already exists", status_code=400)
+            popularity.change(kind, target_id, 1)
+            return json_response(serialized)
+
+        result = await session.execute(
+            delete(Favorite).where(Favorite.user_id == user_id, Favorite.kind == kind, Favorite.target_id == target_id)
+        )
+        # record() bumps the table version, which needs the sync session
+        await session.run_sync(versioning.local_write, "favorite")
+        await session.run_sync(changes.record, "favorite")
+        await session.run_sync(favorite_documents.mark_favorite, user_id, kind, target_id, False)
+        if result.rowcount == 0:
+            await session.rollback()
+            raise APIException("Favorite_%s not found" % kind, status_code=404)
+        await session.commit()
+        popularity.change(kind, target_id, -1)
+        return json_response({"message": "Favorite %s deleted" % kind})
+
+
+def favorite_endpoint(kind, model):
+    async def endpoint(request):
+        if request.method == "POST" and IDEMPOTENCY_HEADER in request.headers:
+            # the Flask route keeps the stored responses, see idempotency.py
+            return Passthrough()
+        if favorite_queue is not None:
+            # write-behind mode, the queue lives in the Flask routes
+            return Passthrough()
+        response = await write_favorite(request, kind, model)
+        if read_replicas is not None:
+            stick_to_primary(response, flask_app.config['READ_YOUR_WRITES_SECONDS'])
+        return response
+    return endpoint
+
+
+routes = []
+for model in (User, Planet, Character, Vehicle):
+    table = model.__tablename__
+    routes.append(Route("/%s" % table, list_endpoint(model), methods=["GET"]))
+    routes.append(Route("/%s/{id:int}" % table, get_endpoint(model), methods=["GET"]))
+    if model is not User:
+        routes.append(Route("/favorite/user/{user_id:int}/%s/{target_id:int}" % table, favorite_endpoint(table, model), methods=["POST", "DELETE"]))
+routes.append(Route("/favorites/user/{user_id:int}", get_all_favorites, methods=["GET"]))
+routes.append(Route("/pool/stats", get_pool_stats, methods=["GET"]))
+# anything else, including other methods on the paths above, goes to Flask
+routes.append(Mount("/", app=wsgi_app))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    if favorite_queue is not None:
+        favorite_queue.drain()
+    await engine.dispose()
+    if read_replicas is not None:
+        for replica in read_replicas.engines:
+            await replica.dispose()
+
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    exception_handlers={APIException: handle_api_exception},
+    lifespan=lifespan
+)
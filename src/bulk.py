@@ -0,0 +1,153 @@
+"""
+Bulk creation of catalogue entities (planets, characters, vehicles), and bulk
+deletion of users and catalogue entities.
+
+The whole payload is validated first, then inserted with one executemany per
+batch inside a single transaction: either every row is created or none is.
+
+Deletes are set-based, in one transaction: per batch of ids, one DELETE for the
+favorites pointing to the rows and one for the rows, never an ORM object.
+"""
+from collections import Counter
+from flask import current_app
+from sqlalchemy import delete, func, insert, select, Integer, String
+from sqlalchemy.exc import IntegrityError
+from utils import APIException
+from models import db, User, Favorite, serialized_select, serialize_row
+from streaming import NDJSON_MIMETYPE
+import changes
+import favorite_documents
+
+
+def parse_bulk_body(request):
+    if request.mimetype == NDJSON_MIMETYPE:
+        try:
+            return [current_app.json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            raise APIException("Invalid NDJSON body", status_code=400)
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list):
+        raise APIException("The body must be a JSON array or NDJSON", status_code=400)
+    return rows
+
+
+def validate_row(columns, row):
+    if not isinstance(row, dict):
+        return None, {"row": "must be an object"}
+    values = {}
+    errors = {}
+    for column in columns:
+        if row.get(column.name) is None:
+            errors[column.name] = "is required"
+            continue
+        value = row[column.name]
+        if isinstance(column.type, Integer) and (not isinstance(value, int) or isinstance(value, bool)):
+            errors[column.name] = "must be an integer"
+        elif isinstance(column.type, String) and not isinstance(value, str):
+            errors[column.name] = "must be a string"
+        elif isinstance(column.type, String) and column.type.length and len(value) > column.type.length:
+            errors[column.name] = "must be at most %d characters" % column.type.length
+        else:
+            values[column.name] = value
+    return values, errors
+
+
+def bulk_create(model, rows, defaults=None, batch_size=1000):
+    """Validates and inserts `rows`, returns (status_code, per row results)."""
+    defaults = defaults or {}
+    if len(rows) == 0:
+        raise APIException("Nothing to create", status_code=400)
+    columns = [c for c in model.__table__.columns if not c.primary_key and c.name not in defaults]
+
+    results = []
+    valid = []
+    seen_names = set()
+    for index, row in enumerate(rows):
+        values, errors = validate_row(columns, row)
+        if not errors and values["name"] in seen_names:
+            errors = {"name": "is repeated in the request"}
+        if errors:
+            results.append({"index": index, "status": "invalid", "errors": errors})
+            continue
+        seen_names.add(values["name"])
+        values.update(defaults)
+        valid.append((index, values))
+        results.append({"index": index, "status": "valid"})
+
+    # names are unique: one IN query per batch finds the rows that would collide
+    for start in range(0, len(valid), batch_size):
+        batch = valid[start:start + batch_size]
+        names = [values["name"] for _, values in batch]
+        existing = set(db.session.execute(select(model.name).where(model.name.in_(names))).scalars())
+        for index, values in batch:
+            if values["name"] in existing:
+                results[index] = {"index": index, "status": "invalid", "errors": {"name": "already exists"}}
+
+    if any(result["status"] == "invalid" for result in results):
+        return 400, results
+
+    try:
+        for start in range(0, len(valid), batch_size):
+            batch = [values for _, values in valid[start:start + batch_size]]
+            db.session.execute(insert(model), batch)
+            names = [values["name"] for values in batch]
+            ids = dict(db.session.execute(select(model.name, model.id).where(model.name.in_(names))).all())
+            for index, values in valid[start:start + batch_size]:
+                results[index] = {"index": index, "status": "created", "id": ids[values["name"]]}
+            changes.record(db.session, model.__tablename__, ids.values())
+        db.session.commit()
+    except IntegrityError:
+        # someone else inserted one of the names after we checked
+        db.session.rollback()
+        raise APIException("One or more names already exist", status_code=409)
+    return 200, results
+
+
+def parse_ids(args, max_ids):
+    """The ids of ?ids=1,2,3 (or ?ids=1&ids=2), sorted and without repeats."""
+    values = [value.strip() for arg in args.getlist("ids") for value in arg.split(",") if value.strip()]
+    if not values:
+        raise APIException("You need to specify the ids parameter, e.g. ?ids=1,2,3", status_code=400)
+    try:
+        ids = sorted({int(value) for value in values})
+    except ValueError:
+        raise APIException("ids must be a comma separated list of integers", status_code=400)
+    if len(ids) > max_ids:
+        raise APIException("At most %d ids per request" % max_ids, status_code=400)
+    return ids
+
+
+def bulk_delete(model, ids, batch_size=1000):
+    """
+    Deletes the rows of `ids` that exist and the favorites pointing to them, returns
+    (the deleted rows serialized, Counter of the favorites removed by (kind, target_id), for users only).
+    """
+    table = model.__tablename__
+    deleted = []
+    removed = Counter()
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        rows = [serialize_row(model, row) for row in db.session.execute(serialized_select(model).where(model.id.in_(batch)))]
+        existing = [row["id"] for row in rows]
+        if not existing:
+            continue
+        if model is User:
+            # ON DELETE CASCADE would do it, but not on SQLite with SQLITE_PRAGMAS=0, and the counts are needed
+            favorites = Favorite.user_id.in_(existing)
+            removed.update(dict(((kind, target_id), count) for kind, target_id, count in db.session.execute(
+                select(Favorite.kind, Favorite.target_id, func.count()).where(favorites).group_by(Favorite.kind, Favorite.target_id)
+            )))
+            # their documents are deleted with them
+            favorite_documents.mark_users(db.session, existing)
+        else:
+            # there is no foreign key to cascade from: Favorite.target_id points to any of the three tables
+            favorites = (Favorite.kind == table) & Favorite.target_id.in_(existing)
+            favorite_documents.mark_targets(db.session, table, existing)
+        db.session.execute(delete(Favorite).where(favorites).execution_options(synchronize_session=False))
+        db.session.execute(delete(model).where(model.id.in_(existing)).execution_options(synchronize_session=False))
+        deleted.extend(rows)
+    if deleted:
+        changes.record(db.session, "favorite")
+        changes.record(db.session, table, [row["id"] for row in deleted])
+    db.session.commit()
+    return deleted, removed
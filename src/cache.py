@@ -0,0 +1,124 @@
+"""
+Read-through cache for serialized entities.
+
+`CacheBackend` is the interface the app talks to; `LRUCache` is the default
+in-process implementation (bounded size + TTL). A shared backend such as redis
+only has to implement the same methods.
+
+Entries are stored with the version of their table (see versioning.py) and
+`get()` with any other version is a miss: writes of other workers, or rows read
+from a replica that was behind, are never served once the version moved on.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+class CacheBackend(ABC):
+    @abstractmethod
+    def get(self, key, version=None):
+        pass
+
+    @abstractmethod
+    def set(self, key, value, version=None):
+        pass
+
+    @abstractmethod
+    def delete(self, *keys):
+        pass
+
+    @abstractmethod
+    def delete_prefix(self, prefix):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    @abstractmethod
+    def stats(self):
+        pass
+
+
+class LRUCache(CacheBackend):
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    def get(self, key, version=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, stored_version, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if stored_version != version:
+                # written since (maybe by another worker): the caller reads it again and replaces it
+                self.stale += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, version=None):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, version, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "stale": self.stale,
+            "invalidations": self.invalidations
+        }
+
+
+def invalidate_changes(cache, changes):
+    # changes is {table: ids} as collected by changes.py, keys look like "planet:42"
+    for table, ids in changes.items():
+        if ids is None:
+            cache.delete_prefix(table + ":")
+        else:
+            cache.delete(*["%s:%s" % (table, id) for id in ids])
@@ -0,0 +1,60 @@
+"""
+Keeps track of the rows each transaction writes so caches can be invalidated.
+
+ORM writes are picked up automatically after every flush. Statements that
+bypass the unit of work (bulk INSERT/DELETE) must call `record()` themselves.
+Callbacks registered with `on_commit` receive {table name: set of ids} once the
+transaction is committed; an id set of None means "any row of that table".
+Callbacks registered with `on_write` run inside the transaction, once per table,
+the first time the transaction writes to it.
+"""
+from sqlalchemy import event, inspect
+
+_commit_listeners = []
+_write_listeners = []
+
+
+def on_commit(fn):
+    _commit_listeners.append(fn)
+    return fn
+
+
+def on_write(fn):
+    _write_listeners.append(fn)
+    return fn
+
+
+def record(session, table, ids=None):
+    changes = session.info.setdefault("changes", {})
+    if table not in changes:
+        for fn in _write_listeners:
+            fn(session, table)
+    if ids is None or changes.get(table, set()) is None:
+        changes[table] = None
+    else:
+        changes.setdefault(table, set()).update(ids)
+
+
+def _after_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, "__tablename__", None)
+        identity = inspect(obj).identity
+        if table is not None:
+            record(session, table, [identity[0]] if identity else None)
+
+
+def _after_commit(session):
+    changes = session.info.pop("changes", None)
+    if changes:
+        for fn in _commit_listeners:
+            fn(changes)
+
+
+def _after_rollback(session):
+    session.info.pop("changes", None)
+
+
+def track(session):
+    event.listen(session, "after_flush", _after_flush)
+    event.listen(session, "after_commit", _after_commit)
+    event.listen(session, "after_soft_rollback", lambda session, previous: _after_rollback(session))
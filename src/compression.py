@@ -0,0 +1,78 @@
+"""
+gzip / brotli compression of the responses.
+
+Text responses of at least `min_size` bytes are compressed with the best
+encoding the client accepts: brotli when the `brotli` package is installed,
+gzip otherwise. A compressed body is a different representation, so its ETag
+gets the "-<encoding>" suffix versioning.matching_etag already understands.
+
+The routes with an ETag (see versioning.conditional) return the same bytes
+until the tables they read change, so their compressed bodies are kept in an
+LRU keyed by ETag and encoding: the catalogue lists are compressed once per
+write, not once per client. Responses that are streamed or already encoded
+(the list snapshots) are left alone.
+"""
+import gzip
+from flask import request
+from cache import LRUCache
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript", "application/xml", "image/svg+xml")
+
+
+def compressible(mimetype):
+    return mimetype is not None and (mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES)
+
+
+class Compression:
+    def __init__(self, min_size=1024, level=6, brotli_quality=5, cache_entries=256, enabled=True):
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.enabled = enabled
+        self.encodings = ("br", "gzip") if brotli is not None else ("gzip",)
+        # the ETag changes with the body, the TTL only releases entries nobody asks for anymore
+        self.cache = LRUCache(maxsize=cache_entries, ttl=3600)
+
+    def init_app(self, app):
+        app.after_request(self._after_request)
+
+    def choose(self, mimetype, size, accept_encodings):
+        """The encoding to send a body in, or None; accept_encodings is a werkzeug Accept."""
+        if not self.enabled or size < self.min_size or not compressible(mimetype):
+            return None
+        return accept_encodings.best_match(self.encodings)
+
+    def compress(self, body, encoding, etag=None):
+        key = "%s:%s" % (etag, encoding)
+        if etag is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        if encoding == "br":
+            compressed = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            compressed = gzip.compress(body, compresslevel=self.level)
+        if etag is not None:
+            self.cache.set(key, compressed)
+        return compressed
+
+    def _after_request(self, response):
+        if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+                or response.content_encoding or "no-transform" in response.cache_control):
+            return response
+        encoding = self.choose(response.mimetype, response.content_length or 0, request.accept_encodings)
+        if compressible(response.mimetype):
+            response.vary.add("Accept-Encoding")
+        if encoding is None:
+            return response
+        etag, weak = response.get_etag()
+        response.set_data(self.compress(response.get_data(), encoding, etag))
+        response.content_encoding = encoding
+        if etag is not None:
+            response.set_etag("%s-%s" % (etag, encoding), weak)
+        return response
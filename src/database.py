@@ -0,0 +1,97 @@
+"""
+Engine and connection pool settings, shared by the Flask app and asgi.py.
+
+The pool is sized per worker from DB_POOL_SIZE / DB_MAX_OVERFLOW (see app.py),
+SQLite files get the same kind of pool (as in SQLAlchemy 2.0) plus WAL and the
+other pragmas below on every new connection, and `pool_stats()` reports how
+busy the pool is so the number of gunicorn workers can be sized against the
+database's connection limit.
+"""
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that counts the checkouts that had to wait for a connection to come back."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        if self._max_overflow == -1 or self._overflow < self._max_overflow or not self._pool.empty():
+            return super()._do_get()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.waits += 1
+            self.wait_seconds += time.perf_counter() - started
+
+
+def engine_options(config, url=None, for_async=False):
+    """Engine arguments for url (SQLALCHEMY_DATABASE_URI by default) with the pool settings of config."""
+    url = make_url(url or config['SQLALCHEMY_DATABASE_URI'])
+    options = {"pool_pre_ping": config['DB_POOL_PRE_PING'], "pool_recycle": config['DB_POOL_RECYCLE']}
+    if url.get_backend_name() == "sqlite":
+        if url.database in (None, "", ":memory:"):
+            # one shared connection (StaticPool), nothing to size
+            return options
+        # the connections move between the threads of the pool
+        options["connect_args"] = {"check_same_thread": False}
+    options.update(
+        poolclass=AsyncAdaptedQueuePool if for_async else TimedQueuePool,
+        pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'],
+        pool_timeout=config['DB_POOL_TIMEOUT'],
+    )
+    return options
+
+
+def setup_sqlite(engine, config):
+    """Sets the SQLite pragmas on every new connection of engine (a sync Engine)."""
+    if engine.dialect.name != "sqlite" or not config['SQLITE_PRAGMAS']:
+        return
+    pragmas = [
+        # readers don't block the writer and the other way around
+        "journal_mode=WAL",
+        # with WAL only a power loss can lose the last commits, never corrupt the file
+        "synchronous=NORMAL",
+        "mmap_size=%d" % config['SQLITE_MMAP_SIZE'],
+        # wait for the write lock instead of failing with "database is locked"
+        "busy_timeout=%d" % config['SQLITE_BUSY_TIMEOUT'],
+        # off by default in SQLite: enforce the foreign keys and their ON DELETE CASCADE
+        "foreign_keys=ON",
+    ]
+
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute("PRAGMA " + pragma)
+        cursor.close()
+    event.listen(engine, "connect", set_pragmas)
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            max_overflow=pool._max_overflow,
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            # overflow() counts up from -size while the pool fills up
+            overflow=max(pool.overflow(), 0),
+        )
+    if isinstance(pool, TimedQueuePool):
+        stats.update(waits=pool.waits, wait_seconds=round(pool.wait_seconds, 3), timeouts=pool.timeouts)
+    return stats
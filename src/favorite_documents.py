@@ -0,0 +1,277 @@
+"""
+The `GET /favorites/user/<id>` document of every user, stored encoded in
+`favorite_document` so the route is one primary key read instead of a query on
+the user, their favorites and the three target tables plus serialize_favorites().
+
+The documents are maintained in the transaction that makes them stale, just
+before it commits:
+- favorites added or removed (the favorite routes, the batch, a write-behind
+  flush) are patched into the stored documents: a locking read, one query per
+  kind for the targets the session hasn't loaded already, and an UPDATE
+- anything else rebuilds the documents of the users concerned from the tables,
+  5 queries per 500 users: users created, changed or deleted, and the users
+  who favorited a planet/character/vehicle that is changed or deleted
+ORM writes are picked up after every flush; statements that bypass the unit of
+work must call `mark_favorite()`, `mark_users()` or `mark_targets()` (before
+deleting the favorites of a target).
+
+The ETag of the route is made from the document itself (`validator()`), so a
+write only changes the tags of the users whose documents it changed.
+
+`flask favorites rebuild` fills the table (after the migration, or a restore),
+`flask favorites check [--fix]` compares it with the tables.
+"""
+import hashlib
+import json
+import click
+from flask.cli import AppGroup
+from sqlalchemy import bindparam, delete, event, func, insert, inspect, select, update
+from sqlalchemy.orm.util import identity_key
+from models import db, User, Planet, Character, Vehicle, Favorite, FavoriteDocument, FAVORITE_KINDS, serialized_select, serialize_row
+from json_provider import dumps
+
+TARGET_MODELS = {"planet": Planet, "character": Character, "vehicle": Vehicle}
+CHUNK = 500
+
+_USERS = "favorite_document_users"
+_FAVORITES = "favorite_document_favorites"
+_TARGETS = "favorite_document_targets"
+_RESOLVED = "favorite_document_resolved"
+
+
+def mark_users(session, user_ids):
+    """The documents of these users are rebuilt from the tables."""
+    session.info.setdefault(_USERS, set()).update(user_ids)
+
+
+def mark_favorite(session, user_id, kind, target_id, added):
+    """One favorite added (True) or removed (False), patched into the document."""
+    session.info.setdefault(_FAVORITES, []).append((user_id, kind, target_id, added))
+
+
+def mark_targets(session, kind, target_ids):
+    """Marks the users who favorited these targets; call it while their favorites are still in the table."""
+    targets = {(kind, id) for id in target_ids}
+    session.info.setdefault(_RESOLVED, set()).update(targets)
+    mark_users(session, users_of(session, targets))
+
+
+def users_of(session, targets):
+    users = set()
+    for kind in FAVORITE_KINDS:
+        ids = [id for k, id in targets if k == kind]
+        for start in range(0, len(ids), CHUNK):
+            users.update(session.execute(select(Favorite.user_id).distinct().where(
+                Favorite.kind == kind, Favorite.target_id.in_(ids[start:start + CHUNK])
+            )).scalars())
+    return users
+
+
+def read(session, user_id):
+    return session.execute(select(FavoriteDocument.document).where(FavoriteDocument.user_id == user_id)).scalar()
+
+
+def document_select(user_id):
+    # for the AsyncSession of asgi.py
+    return select(FavoriteDocument.document).where(FavoriteDocument.user_id == user_id)
+
+
+def validator(document):
+    """What the ETag of GET /favorites/user/<id> is made from, in place of table versions."""
+    return {"favorite_document": hashlib.sha1(document.encode()).hexdigest()}
+
+
+def build(session, user_ids):
+    """{user_id: encoded document} of the users in user_ids that exist, same content as serialize_favorites()."""
+    documents = {}
+    for row in session.execute(serialized_select(User).where(User.id.in_(user_ids))):
+        document = serialize_row(User, row)
+        for kind in FAVORITE_KINDS:
+            document["favorite_%s" % kind] = []
+        documents[document["id"]] = document
+    if not documents:
+        return {}
+    favorites = session.execute(
+        select(Favorite.user_id, Favorite.kind, Favorite.target_id).where(Favorite.user_id.in_(list(documents))).order_by(Favorite.id)
+    ).all()
+    targets = {}
+    for kind, model in TARGET_MODELS.items():
+        ids = {target_id for _, k, target_id in favorites if k == kind}
+        if ids:
+            rows = session.execute(serialized_select(model).where(model.id.in_(ids)))
+            targets[kind] = {row[0]: serialize_row(model, row) for row in rows}
+    for user_id, kind, target_id in favorites:
+        target = targets.get(kind, {}).get(target_id)
+        # a favorite of a target deleted outside the API (admin) is left out
+        if target is not None:
+            documents[user_id]["favorite_%s" % kind].append(target)
+    return {user_id: dumps(document) for user_id, document in documents.items()}
+
+
+def refresh(session, user_ids):
+    """Rebuilds the documents of user_ids, in the session's transaction; returns how many were written."""
+    table = FavoriteDocument.__table__
+    user_ids = sorted(user_ids)
+    written = 0
+    for start in range(0, len(user_ids), CHUNK):
+        chunk = user_ids[start:start + CHUNK]
+        # lock the documents first (in id order, no deadlocks): a concurrent refresh of
+        # the same users waits for this transaction, then builds on what it committed
+        stored = set(session.execute(select(table.c.user_id).where(table.c.user_id.in_(chunk)).with_for_update()).scalars())
+        documents = build(session, chunk)
+        updates = [{"b_user_id": id, "b_document": document} for id, document in documents.items() if id in stored]
+        inserts = [{"user_id": id, "document": document} for id, document in documents.items() if id not in stored]
+        gone = [id for id in stored if id not in documents]
+        if updates:
+            session.execute(update(table).where(table.c.user_id == bindparam("b_user_id")).values(document=bindparam("b_document")), updates)
+        if inserts:
+            session.execute(insert(table), inserts)
+        if gone:
+            session.execute(delete(table).where(table.c.user_id.in_(gone)))
+        written += len(documents)
+    return written
+
+
+def added_targets(session, keys):
+    """{(kind, id): serialized target}, from the session when the route loaded it, one IN query per kind otherwise."""
+    targets = {}
+    for kind, model in TARGET_MODELS.items():
+        missing = []
+        for id in {id for k, id in keys if k == kind}:
+            target = session.identity_map.get(identity_key(model, id))
+            if target is not None:
+                targets[kind, id] = target.serialize()
+            else:
+                missing.append(id)
+        if missing:
+            for row in session.execute(serialized_select(model).where(model.id.in_(missing))):
+                targets[kind, row[0]] = serialize_row(model, row)
+    return targets
+
+
+def patch(session, favorites):
+    """Applies [(user_id, kind, target_id, added)] to the stored documents; returns the users without one."""
+    table = FavoriteDocument.__table__
+    user_ids = sorted({user_id for user_id, _, _, _ in favorites})
+    stored = dict(session.execute(
+        select(table.c.user_id, table.c.document).where(table.c.user_id.in_(user_ids)).with_for_update()
+    ).all())
+    documents = {user_id: json.loads(document) for user_id, document in stored.items()}
+    targets = added_targets(session, [(kind, target_id) for user_id, kind, target_id, added in favorites if added and user_id in stored])
+    for user_id, kind, target_id, added in favorites:
+        document = documents.get(user_id)
+        if document is None:
+            continue
+        items = document["favorite_%s" % kind]
+        present = any(item["id"] == target_id for item in items)
+        if added and not present and (kind, target_id) in targets:
+            items.append(targets[kind, target_id])
+        elif not added and present:
+            document["favorite_%s" % kind] = [item for item in items if item["id"] != target_id]
+    if documents:
+        session.execute(update(table).where(table.c.user_id == bindparam("b_user_id")).values(document=bindparam("b_document")), [
+            {"b_user_id": user_id, "b_document": dumps(document)} for user_id, document in documents.items()
+        ])
+    return set(user_ids) - set(stored)
+
+
+def _after_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            mark_users(session, [obj.id])
+        elif isinstance(obj, Favorite):
+            if obj in session.new or obj in session.deleted:
+                mark_favorite(session, obj.user_id, obj.kind, obj.target_id, obj in session.new)
+            else:
+                # and the user it was moved away from
+                mark_users(session, [obj.user_id] + list(inspect(obj).attrs.user_id.history.deleted or ()))
+        elif isinstance(obj, tuple(TARGET_MODELS.values())) and obj not in session.new:
+            # nobody can have favorited a new one
+            session.info.setdefault(_TARGETS, set()).add((obj.__tablename__, obj.id))
+
+
+def _before_commit(session):
+    # the last flush happens after before_commit, do it now so its changes are marked
+    session.flush()
+    users = session.info.pop(_USERS, set())
+    favorites = session.info.pop(_FAVORITES, [])
+    targets = session.info.pop(_TARGETS, set()) - session.info.pop(_RESOLVED, set())
+    if targets:
+        users |= users_of(session, targets)
+    favorites = [favorite for favorite in favorites if favorite[0] not in users]
+    if favorites:
+        users |= patch(session, favorites)
+    if users:
+        refresh(session, users)
+
+
+def _after_rollback(session):
+    for key in (_USERS, _FAVORITES, _TARGETS, _RESOLVED):
+        session.info.pop(key, None)
+
+
+def track(session):
+    event.listen(session, "after_flush", _after_flush)
+    event.listen(session, "before_commit", _before_commit)
+    event.listen(session, "after_soft_rollback", lambda session, previous: _after_rollback(session))
+
+
+def user_batches(session, size):
+    last = 0
+    while True:
+        ids = session.execute(select(User.id).where(User.id > last).order_by(User.id).limit(size)).scalars().all()
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
+
+def delete_orphans(session):
+    table = FavoriteDocument.__table__
+    return session.execute(delete(table).where(table.c.user_id.not_in(select(User.id)))).rowcount
+
+
+def rebuild(session, batch=CHUNK):
+    """Rebuilds the document of every user, one transaction per batch; returns (written, deleted)."""
+    written = 0
+    for ids in user_batches(session, batch):
+        written += refresh(session, ids)
+        session.commit()
+    deleted = delete_orphans(session)
+    session.commit()
+    return written, deleted
+
+
+cli = AppGroup("favorites", help="The stored GET /favorites/user/<id> documents.")
+
+
+@cli.command("rebuild")
+@click.option("--batch", default=CHUNK, show_default=True, help="Users per transaction.")
+def rebuild_command(batch):
+    """Rebuilds the document of every user."""
+    written, deleted = rebuild(db.session, batch)
+    click.echo("%d documents written, %d of deleted users removed" % (written, deleted))
+
+
+@cli.command("check")
+@click.option("--fix", is_flag=True, help="Rewrite the documents that differ.")
+def check_command(fix):
+    """Compares the documents with the tables, exits with status 1 if any differ."""
+    table = FavoriteDocument.__table__
+    missing = stale = 0
+    for ids in user_batches(db.session, CHUNK):
+        expected = build(db.session, ids)
+        stored = dict(db.session.execute(select(table.c.user_id, table.c.document).where(table.c.user_id.in_(ids))).all())
+        wrong = [id for id, document in expected.items() if stored.get(id) != document]
+        missing += len([id for id in wrong if id not in stored])
+        stale += len([id for id in wrong if id in stored])
+        if fix and wrong:
+            refresh(db.session, wrong)
+        db.session.commit()
+    orphans = db.session.execute(select(func.count()).select_from(table).where(table.c.user_id.not_in(select(User.id)))).scalar()
+    if fix and orphans:
+        delete_orphans(db.session)
+        db.session.commit()
+    click.echo("%d missing, %d stale, %d of deleted users%s" % (missing, stale, orphans, " (fixed)" if fix else ""))
+    if not fix and missing + stale + orphans:
+        raise SystemExit(1)
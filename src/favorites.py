@@ -0,0 +1,108 @@
+"""
+Batch favorite changes for one user (`POST /favorites/user/<id>/batch`).
+
+    [{"op": "add", "kind": "planet", "id": 1}, {"op": "remove", "kind": "vehicle", "id": 4}, ...]
+
+Like bulk.py, the whole batch is validated first, with one IN query per kind
+for the targets being added and one query for the user's current favorites,
+then applied with one INSERT and one DELETE per kind in a single transaction:
+either every operation is applied or none is. Adding a favorite the user
+already has, or removing one they don't have, is not an error ("unchanged"),
+so an import can be retried.
+"""
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from utils import APIException
+from models import db, User, Favorite, FAVORITE_KINDS, Planet, Character, Vehicle
+import changes
+import favorite_documents
+
+FAVORITE_MODELS = {"planet": Planet, "character": Character, "vehicle": Vehicle}
+OPERATIONS = ("add", "remove")
+
+
+def validate_operation(operation):
+    if not isinstance(operation, dict):
+        return {"operation": "must be an object"}
+    errors = {}
+    if operation.get("op") not in OPERATIONS:
+        errors["op"] = "must be one of %s" % ", ".join(OPERATIONS)
+    if operation.get("kind") not in FAVORITE_KINDS:
+        errors["kind"] = "must be one of %s" % ", ".join(FAVORITE_KINDS)
+    if not isinstance(operation.get("id"), int) or isinstance(operation.get("id"), bool):
+        errors["id"] = "must be an integer"
+    return errors
+
+
+def batch_favorites(user_id, operations, max_operations=1000):
+    """Validates and applies `operations`, returns (status_code, per operation results, applied (delta, kind, id) list)."""
+    if len(operations) == 0:
+        raise APIException("Nothing to change", status_code=400)
+    if len(operations) > max_operations:
+        raise APIException("At most %d operations per batch" % max_operations, status_code=400)
+    if db.session.get(User, user_id) is None:
+        raise APIException("User not found", status_code=404)
+
+    results = []
+    valid = []
+    seen = set()
+    for index, operation in enumerate(operations):
+        errors = validate_operation(operation)
+        if not errors and (operation["kind"], operation["id"]) in seen:
+            errors = {"id": "is repeated in the request"}
+        if errors:
+            results.append({"index": index, "status": "invalid", "errors": errors})
+            continue
+        seen.add((operation["kind"], operation["id"]))
+        valid.append((index, operation["op"], operation["kind"], operation["id"]))
+        results.append({"index": index, "status": "valid"})
+
+    # one IN query per kind: the targets being added must exist
+    for kind, model in FAVORITE_MODELS.items():
+        ids = [id for _, op, k, id in valid if op == "add" and k == kind]
+        if ids:
+            existing = set(db.session.execute(select(model.id).where(model.id.in_(ids))).scalars())
+            for index, op, k, id in valid:
+                if op == "add" and k == kind and id not in existing:
+                    results[index] = {"index": index, "status": "invalid", "errors": {"id": "%s not found" % kind}}
+
+    if any(result["status"] == "invalid" for result in results):
+        return 400, results, []
+
+    kinds = {kind for _, _, kind, _ in valid}
+    current = set(db.session.execute(
+        select(Favorite.kind, Favorite.target_id).where(Favorite.user_id == user_id, Favorite.kind.in_(kinds))
+    ).all())
+    added = []
+    removed = []
+    for index, op, kind, id in valid:
+        if op == "add" and (kind, id) not in current:
+            added.append((kind, id))
+            results[index] = {"index": index, "status": "added"}
+        elif op == "remove" and (kind, id) in current:
+            removed.append((kind, id))
+            results[index] = {"index": index, "status": "removed"}
+        else:
+            results[index] = {"index": index, "status": "unchanged"}
+
+    try:
+        if added:
+            db.session.execute(insert(Favorite), [{"user_id": user_id, "kind": kind, "target_id": id} for kind, id in added])
+        for kind in FAVORITE_KINDS:
+            ids = [id for k, id in removed if k == kind]
+            if ids:
+                db.session.execute(delete(Favorite).where(
+                    Favorite.user_id == user_id, Favorite.kind == kind, Favorite.target_id.in_(ids)
+                ).execution_options(synchronize_session=False))
+        if added or removed:
+            changes.record(db.session, "favorite")
+            for kind, id in added:
+                favorite_documents.mark_favorite(db.session, user_id, kind, id, True)
+            for kind, id in removed:
+                favorite_documents.mark_favorite(db.session, user_id, kind, id, False)
+        db.session.commit()
+    except IntegrityError:
+        # a concurrent request added one of the favorites after we looked
+        db.session.rollback()
+        raise APIException("One or more favorites changed during the batch, try again", status_code=409)
+    return 200, results, [(1, kind, id) for kind, id in added] + [(-1, kind, id) for kind, id in removed]
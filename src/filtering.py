@@ -0,0 +1,101 @@
+"""
+Query string filters, sorting and sparse fieldsets for the list endpoints.
+
+    GET /planet?climate=arid&population_min=1000&sort=-population&fields=name,population
+
+- `<column>=value` equality (repeat the parameter for IN), for the columns in
+  the model's `filter_columns`
+- `<column>_min` / `<column>_max` inclusive ranges, for the integer ones
+- `sort=` comma separated columns, `-` prefix for descending; `id`, `name` and
+  the filter columns can be used, they are all indexed
+- `fields=` comma separated subset of `serialize_columns`
+
+Parameters that don't name a column of the model are ignored.
+
+Everything is pushed down into the SELECT; the parsed result plugs into
+pagination.py (keyset on the sort columns + id) and the NDJSON export.
+"""
+from sqlalchemy import Integer, select
+from utils import APIException
+
+RESERVED_PARAMS = ("limit", "after", "stream", "sort", "fields")
+
+
+class ListQuery:
+    def __init__(self, model, conditions, order, fields):
+        self.model = model
+        self.conditions = conditions
+        self.order = order
+        self.fields = fields
+
+    @property
+    def is_default(self):
+        # no filters, all the fields, sorted by id ascending
+        return not self.conditions and self.fields == self.model.serialize_columns and len(self.order) == 1 and not self.order[0][1]
+
+    def statement(self):
+        # the sort columns are needed to build cursors even when they are not requested
+        names = list(self.fields)
+        names += [column.key for column, _ in self.order if column.key not in names]
+        return select(*[getattr(self.model, name) for name in names]).where(*self.conditions)
+
+    def serialize(self, row):
+        return dict(zip(self.fields, row))
+
+
+def parse_value(column, value, param):
+    if isinstance(column.type, Integer):
+        try:
+            return int(value)
+        except ValueError:
+            raise APIException("%s must be an integer" % param, status_code=400)
+    return value
+
+
+def parse_list_query(model, args):
+    filterable = {name: getattr(model, name) for name in getattr(model, "filter_columns", ())}
+    conditions = []
+    for param in args:
+        if param in RESERVED_PARAMS:
+            continue
+        name, bound = param, None
+        if param.endswith("_min") or param.endswith("_max"):
+            name, bound = param[:-4], param[-3:]
+        column = filterable.get(name)
+        if column is None and name not in model.serialize_columns:
+            # not about this resource (cache busters and the like)
+            continue
+        if column is None or (bound is not None and not isinstance(column.type, Integer)):
+            raise APIException("Can't filter by %s" % param, status_code=400)
+        values = [parse_value(column, value, param) for value in args.getlist(param)]
+        if bound == "min":
+            conditions.append(column >= max(values))
+        elif bound == "max":
+            conditions.append(column <= min(values))
+        elif len(values) == 1:
+            conditions.append(column == values[0])
+        else:
+            conditions.append(column.in_(values))
+
+    sortable = ("id", "name") + tuple(filterable)
+    order = []
+    for name in filter(None, args.get("sort", "").split(",")):
+        descending = name.startswith("-")
+        name = name.lstrip("-")
+        if name not in sortable:
+            raise APIException("Can't sort by %s" % name, status_code=400)
+        if name not in [column.key for column, _ in order]:
+            order.append((getattr(model, name), descending))
+    # the primary key makes the sort key unique, which keyset pagination needs; it follows
+    # the direction of the last column so a (column, id) index can be scanned either way
+    if "id" not in [column.key for column, _ in order]:
+        order.append((model.id, order[-1][1] if order else False))
+
+    fields = model.serialize_columns
+    if args.get("fields"):
+        fields = tuple(name for name in args["fields"].split(",") if name)
+        unknown = [name for name in fields if name not in model.serialize_columns]
+        if unknown or not fields:
+            raise APIException("Unknown fields: %s" % ",".join(unknown), status_code=400)
+
+    return ListQuery(model, conditions, order, fields)
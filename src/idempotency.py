@@ -0,0 +1,170 @@
+"""
+Idempotency-Key support for the POST routes.
+
+A client that retries a POST with the same `Idempotency-Key` header gets the
+response of the first request back, with `Idempotent-Replayed: true`, instead
+of running it again:
+- the first request inserts a pending row (the primary key lets only one
+  request run per key), runs the view and stores its response if it is a 2xx;
+  any other outcome deletes the row so the client can try again
+- a retry while the first request is still running gets a 409, the same key
+  with a different body a 422
+- rows expire after IDEMPOTENCY_TTL seconds, pending ones after
+  IDEMPOTENCY_LOCK_SECONDS in case their worker died, and a background thread
+  deletes the expired rows in batches
+
+The stored responses are also kept in an LRU in every worker, so most replays
+don't touch the database at all. The rows are written on a connection of their
+own, outside the transaction of the view: they don't bump the table versions
+or invalidate any cache.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import namedtuple
+from functools import wraps
+from flask import Response, current_app, make_response, request
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from cache import LRUCache
+from models import db, IdempotencyKey
+from utils import APIException
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+StoredResponse = namedtuple("StoredResponse", "fingerprint status_code content_type body expires")
+
+
+class IdempotencyStore:
+    def __init__(self, ttl=86400, lock_seconds=60, cache_entries=1000, sweep_seconds=300, sweep_batch=1000):
+        self.ttl = ttl
+        self.lock_seconds = lock_seconds
+        self.sweep_seconds = sweep_seconds
+        self.sweep_batch = sweep_batch
+        self.cache = LRUCache(maxsize=cache_entries, ttl=ttl)
+        self._sweeper = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = app.config['IDEMPOTENCY_TTL']
+        self.lock_seconds = app.config['IDEMPOTENCY_LOCK_SECONDS']
+        self.sweep_seconds = app.config['IDEMPOTENCY_SWEEP_SECONDS']
+        self.sweep_batch = app.config['IDEMPOTENCY_SWEEP_BATCH']
+        self.cache = LRUCache(maxsize=app.config['IDEMPOTENCY_CACHE_ENTRIES'], ttl=self.ttl)
+
+    def idempotent(self, view):
+        """Replays the stored response of the view for requests with an Idempotency-Key it has already seen."""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            header = request.headers.get(HEADER)
+            if header is None:
+                return view(*args, **kwargs)
+            if not header or len(header) > MAX_KEY_LENGTH:
+                raise APIException("%s must be 1 to %d characters long" % (HEADER, MAX_KEY_LENGTH), status_code=400)
+            self.start_sweeper(current_app._get_current_object())
+            # keys are scoped to the route: the same key on another path is another request
+            key = hashlib.sha1(("%s %s %s" % (request.method, request.path, header)).encode()).hexdigest()
+            fingerprint = hashlib.sha1(request.get_data()).hexdigest()
+
+            stored = self.cache.get(key)
+            if stored is None or stored.expires <= time.time():
+                stored = self.claim(key, fingerprint)
+            if stored is not None:
+                return replay(stored, fingerprint)
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                self.release(key)
+                raise
+            if 200 <= response.status_code < 300:
+                self.save(key, fingerprint, response)
+            else:
+                self.release(key)
+            return response
+        return wrapper
+
+    def claim(self, key, fingerprint):
+        """Inserts the pending row of key and returns None, or returns the stored response of an earlier request."""
+        now = int(time.time())
+        table = IdempotencyKey.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(insert(table).values(key=key, fingerprint=fingerprint, expires=now + self.lock_seconds))
+            return None
+        except IntegrityError:
+            pass
+        with db.engine.begin() as connection:
+            row = connection.execute(select(table).where(table.c.key == key)).one_or_none()
+            if row is None or row.expires <= now:
+                # expired but not swept yet: take it over, unless another request just did
+                taken = connection.execute(update(table).where(table.c.key == key, table.c.expires <= now).values(
+                    fingerprint=fingerprint, status_code=None, content_type=None, body=None, expires=now + self.lock_seconds
+                )).rowcount
+                if taken == 1:
+                    return None
+                raise APIException("A request with this %s is in progress" % HEADER, status_code=409)
+        if row.status_code is None:
+            raise APIException("A request with this %s is in progress" % HEADER, status_code=409)
+        stored = StoredResponse(row.fingerprint, row.status_code, row.content_type, row.body, row.expires)
+        self.cache.set(key, stored)
+        return stored
+
+    def save(self, key, fingerprint, response):
+        stored = StoredResponse(fingerprint, response.status_code, response.content_type, response.get_data(), int(time.time()) + self.ttl)
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(update(table).where(table.c.key == key).values(
+                status_code=stored.status_code, content_type=stored.content_type, body=stored.body, expires=stored.expires
+            ))
+        self.cache.set(key, stored)
+
+    def release(self, key):
+        table = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(delete(table).where(table.c.key == key, table.c.status_code.is_(None)))
+
+    def sweep(self):
+        """Deletes the expired rows, sweep_batch per transaction; returns how many."""
+        now = int(time.time())
+        table = IdempotencyKey.__table__
+        deleted = 0
+        while True:
+            with db.engine.begin() as connection:
+                keys = connection.execute(select(table.c.key).where(table.c.expires <= now).limit(self.sweep_batch)).scalars().all()
+                if keys:
+                    connection.execute(delete(table).where(table.c.key.in_(keys)))
+            deleted += len(keys)
+            if len(keys) < self.sweep_batch:
+                return deleted
+
+    def start_sweeper(self, app):
+        # started by the first request with a key, not at import: threads don't survive gunicorn's fork
+        if self._sweeper is not None:
+            return
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_forever, args=(app,), daemon=True)
+                self._sweeper.start()
+
+    def _sweep_forever(self, app):
+        while True:
+            try:
+                with app.app_context():
+                    deleted = self.sweep()
+                if deleted:
+                    logger.info("deleted %d expired idempotency keys", deleted)
+            except Exception:
+                logger.exception("idempotency key sweep failed")
+            time.sleep(self.sweep_seconds)
+
+
+def replay(stored, fingerprint):
+    if stored.fingerprint != fingerprint:
+        raise APIException("This %s was used with a different request" % HEADER, status_code=422)
+    response = Response(stored.body, status=stored.status_code, content_type=stored.content_type)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
@@ -0,0 +1,42 @@
+"""
+WSGI middleware that builds the admin (admin.py) on the first request to /admin.
+
+Importing Flask-Admin and building its ModelViews is a large part of the start
+up of a worker, and most workers never serve an admin page. Flask doesn't
+allow adding views once an app has handled a request, so the admin gets a
+small Flask app of its own, with the same config and database.
+"""
+import threading
+from flask import Flask
+from models import db
+from database import setup_sqlite
+
+PREFIX = "/admin"
+
+
+class LazyAdmin:
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.admin_app = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        path = environ.get("PATH_INFO", "")
+        if path == PREFIX or path.startswith(PREFIX + "/"):
+            return self.get_admin_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def get_admin_app(self):
+        if self.admin_app is None:
+            with self._lock:
+                if self.admin_app is None:
+                    from admin import setup_admin
+                    admin_app = Flask("admin")
+                    admin_app.config.update(self.app.config)
+                    db.init_app(admin_app)
+                    with admin_app.app_context():
+                        setup_sqlite(db.engine, admin_app.config)
+                    setup_admin(admin_app)
+                    self.admin_app = admin_app
+        return self.admin_app
@@ -0,0 +1,176 @@
+"""
+Request and SQL metrics of this worker, exported at GET /metrics in the
+Prometheus text format.
+
+For every request (labelled by method and route rule, e.g. /planet/<int:id>):
+- a latency histogram and a response count per status code
+- a histogram of the number of SQL statements it ran and their total time,
+  measured with the before/after_cursor_execute events of every engine
+
+Statements slower than SLOW_QUERY_MS and requests running more than
+SQL_WARN_STATEMENTS statements (usually an N+1 query) are logged as warnings.
+"""
+import bisect
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# stats of cache.py / database.py that only ever grow
+CACHE_COUNTERS = ("hits", "misses", "evictions", "expirations", "stale", "invalidations")
+POOL_COUNTERS = ("waits", "wait_seconds", "timeouts")
+
+# the Metrics of the last app created: times the statements of asgi.py and of the admin app
+_latest = None
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in labels.items())
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    def __init__(self, slow_query_ms=200, warn_statements=20, enabled=True):
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.warn_statements = warn_statements
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self._statements = defaultdict(lambda: Histogram(STATEMENT_BUCKETS))
+        self._sql_seconds = defaultdict(float)
+        self._responses = Counter()
+
+    def init_app(self, app):
+        global _latest
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.extensions["metrics"] = _latest = self
+        # once per process, on the Engine class: covers the primary, the replicas and engines
+        # created later, and a second create_app() doesn't count every statement twice
+        if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+    def _before_request(self):
+        if self.enabled:
+            g.metrics = [time.perf_counter(), 0, 0.0]  # started, statements, SQL seconds
+
+    def _after_request(self, response):
+        measured = g.pop("metrics", None)
+        if measured is None:
+            return response
+        started, statements, sql_seconds = measured
+        seconds = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        key = (request.method, route)
+        with self._lock:
+            self._latency[key].observe(seconds)
+            self._statements[key].observe(statements)
+            self._sql_seconds[key] += sql_seconds
+            self._responses[key + (response.status_code,)] += 1
+        if statements > self.warn_statements:
+            logger.warning("%s %s ran %d SQL statements (%.1f ms), N+1 query?", request.method, request.path, statements, sql_seconds * 1000)
+        return response
+
+    def _before_cursor_execute(self, context):
+        if self.enabled:
+            context.metrics_started = time.perf_counter()
+
+    def _after_cursor_execute(self, statement, context):
+        started = getattr(context, "metrics_started", None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        if seconds > self.slow_query_seconds:
+            logger.warning("slow query (%.1f ms): %s", seconds * 1000, " ".join(statement.split()))
+        measured = g.get("metrics") if has_request_context() else None
+        if measured is not None:
+            measured[1] += 1
+            measured[2] += seconds
+
+    def render(self, cache_stats=None, pools=()):
+        """The metrics in the Prometheus text format; pools is a list of (name, database.pool_stats())."""
+        lines = []
+
+        def family(name, kind, help):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        def histograms(name, help, histograms):
+            family(name, "histogram", help)
+            for (method, route), histogram in sorted(histograms.items()):
+                labels = _labels(method=method, route=route)
+                total = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    total += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, total))
+                lines.append("%s_sum{%s} %s" % (name, labels, _format_value(histogram.sum)))
+                lines.append("%s_count{%s} %d" % (name, labels, total))
+
+        with self._lock:
+            histograms("http_request_duration_seconds", "Request latency by route.", self._latency)
+            family("http_responses_total", "counter", "Responses by route and status code.")
+            for (method, route, status), count in sorted(self._responses.items()):
+                lines.append("http_responses_total{%s} %d" % (_labels(method=method, route=route, status=status), count))
+            histograms("sql_statements_per_request", "SQL statements run by each request.", self._statements)
+            family("sql_statement_seconds_total", "counter", "Time spent in SQL statements by route.")
+            for (method, route), seconds in sorted(self._sql_seconds.items()):
+                lines.append("sql_statement_seconds_total{%s} %s" % (_labels(method=method, route=route), _format_value(seconds)))
+
+        for name, value in sorted((cache_stats or {}).items()):
+            if name in CACHE_COUNTERS:
+                family("entity_cache_%s_total" % name, "counter", "Entity cache %s." % name)
+                lines.append("entity_cache_%s_total %s" % (name, _format_value(value)))
+            else:
+                family("entity_cache_%s" % name, "gauge", "Entity cache %s." % name)
+                lines.append("entity_cache_%s %s" % (name, _format_value(value)))
+
+        samples = defaultdict(list)
+        for pool, stats in pools:
+            for name, value in stats.items():
+                if isinstance(value, (int, float)):
+                    samples[name].append((pool, value))
+        for name, values in sorted(samples.items()):
+            metric = "db_pool_%s_total" % name if name in POOL_COUNTERS else "db_pool_%s" % name
+            family(metric, "counter" if name in POOL_COUNTERS else "gauge", "Connection pool %s." % name.replace("_", " "))
+            for pool, value in values:
+                lines.append("%s{%s} %s" % (metric, _labels(pool=pool), _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def _current():
+    return current_app.extensions.get("metrics", _latest) if has_app_context() else _latest
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = _current()
+    if metrics is not None:
+        metrics._before_cursor_execute(context)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = _current()
+    if metrics is not None:
+        metrics._after_cursor_execute(statement, context)
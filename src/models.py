@@ -1,22 +1,25 @@
 # This file will contain the models for the database.
-from sqlalchemy import Column, ForeignKey, Integer, String, Date, Table
+from sqlalchemy import Column, ForeignKey, Integer, String, Date, Table, select
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime, timezone
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
 class User(db.Model):
     __tablename__ = 'user'
+    # the columns serialize() returns, in the same order, see serialized_select()
+    serialize_columns = ("id", "username", "email", "suscription_date")
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(120), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password = db.Column(db.String(80), unique=False, nullable=False)
     suscription_date = db.Column(db.Date(), unique=False, nullable=False)    
     is_active = db.Column(db.Boolean(), unique=False, nullable=False)
-    favorite_vehicle = db.relationship('Favorite_Vehicle', back_populates='user', lazy=True)
-    favorite_character = db.relationship('Favorite_Character', back_populates='user', lazy=True)
-    favorite_planet = db.relationship('Favorite_Planet', back_populates='user', lazy=True)
+    favorite_vehicle = db.relationship('Favorite', primaryjoin="and_(User.id == Favorite.user_id, Favorite.kind == 'vehicle')", viewonly=True, lazy=True)
+    favorite_character = db.relationship('Favorite', primaryjoin="and_(User.id == Favorite.user_id, Favorite.kind == 'character')", viewonly=True, lazy=True)
+    favorite_planet = db.relationship('Favorite', primaryjoin="and_(User.id == Favorite.user_id, Favorite.kind == 'planet')", viewonly=True, lazy=True)
     
 
     def __init__(self, username, email, password, suscription_date):
@@ -56,6 +59,17 @@ class User(db.Model):
 
 class Planet(db.Model):
     __tablename__ = 'planet'
+    # the columns serialize() returns, in the same order, see serialized_select()
+    serialize_columns = ("id", "name", "population", "climate", "terrain", "diameter", "rotation_period", "orbital_period", "gravity", "surface_water", "created")
+    # columns the list endpoint can filter and sort on, see filtering.py
+    filter_columns = ("climate", "terrain", "population", "diameter")
+    __table_args__ = (
+        # (column, id) serves equality filters, ranges and sorts together with the keyset on id
+        db.Index('ix_planet_climate_id', 'climate', 'id'),
+        db.Index('ix_planet_terrain_id', 'terrain', 'id'),
+        db.Index('ix_planet_population_id', 'population', 'id'),
+        db.Index('ix_planet_diameter_id', 'diameter', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
     population = db.Column(db.Integer, unique=False, nullable=False)
@@ -67,7 +81,6 @@ class Planet(db.Model):
     gravity = db.Column(db.String(120), unique=False, nullable=False)
     surface_water = db.Column(db.Integer, unique=False, nullable=False)
     created = db.Column(db.DateTime(), unique=False, nullable=False)
-    favorite_planet = db.relationship('Favorite_Planet', back_populates='planet', lazy=True)
 
     def __init__(self, name, population, climate, terrain, diameter, rotation_period, orbital_period, gravity, surface_water, created):
         self.name = name
@@ -102,6 +115,17 @@ class Planet(db.Model):
 
 class Character(db.Model):
     __tablename__ = 'character'
+    # the columns serialize() returns, in the same order, see serialized_select()
+    serialize_columns = ("id", "name", "height", "mass", "hair_color", "age", "homeworld", "species")
+    # columns the list endpoint can filter and sort on, see filtering.py
+    filter_columns = ("homeworld", "species", "height", "mass")
+    __table_args__ = (
+        # (column, id) serves equality filters, ranges and sorts together with the keyset on id
+        db.Index('ix_character_homeworld_id', 'homeworld', 'id'),
+        db.Index('ix_character_species_id', 'species', 'id'),
+        db.Index('ix_character_height_id', 'height', 'id'),
+        db.Index('ix_character_mass_id', 'mass', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
     height = db.Column(db.Integer, unique=False, nullable=False)
@@ -110,7 +134,6 @@ class Character(db.Model):
     age = db.Column(db.Integer, unique=False, nullable=False)
     homeworld = db.Column(db.String(120), unique=False, nullable=False)
     species = db.Column(db.String(120), unique=False, nullable = False)
-    favorite_character = db.relationship('Favorite_Character', back_populates='character', lazy=True)
 
     def __init__(self, name, height, mass, hair_color, age, homeworld, species):
         self.name = name
@@ -138,6 +161,17 @@ class Character(db.Model):
 
 class Vehicle(db.Model):
     __tablename__ = 'vehicle'
+    # the columns serialize() returns, in the same order, see serialized_select()
+    serialize_columns = ("id", "name", "model", "manufacturer", "length", "max_atmosphering_speed", "passengers", "cargo_capacity", "consumables")
+    # columns the list endpoint can filter and sort on, see filtering.py
+    filter_columns = ("manufacturer", "model", "passengers", "cargo_capacity")
+    __table_args__ = (
+        # (column, id) serves equality filters, ranges and sorts together with the keyset on id
+        db.Index('ix_vehicle_manufacturer_id', 'manufacturer', 'id'),
+        db.Index('ix_vehicle_model_id', 'model', 'id'),
+        db.Index('ix_vehicle_passengers_id', 'passengers', 'id'),
+        db.Index('ix_vehicle_cargo_capacity_id', 'cargo_capacity', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
     model = db.Column(db.String(120), unique=False, nullable=False)
@@ -147,7 +181,6 @@ class Vehicle(db.Model):
     passengers = db.Column(db.Integer, unique=False, nullable=False) #
     cargo_capacity = db.Column(db.Integer, unique=False, nullable=False)
     consumables = db.Column(db.String(120), unique=False, nullable=False)
-    favorite_vehicle = db.relationship('Favorite_Vehicle', back_populates='vehicle', lazy=True)
 
     def __init__(self, name, model, manufacturer, length, max_atmosphering_speed, passengers, cargo_capacity, consumables):
         self.name = name
@@ -175,60 +208,78 @@ class Vehicle(db.Model):
             "consumables": self.consumables
         }
 
-class Favorite_Planet(db.Model):
-    __tablename__ = 'favorite_planet'
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    user = db.relationship(User)    
-    planet_id = db.Column(db.Integer, db.ForeignKey('planet.id'))
-    planet = db.relationship(Planet)
+def serialized_select(model):
+    """SELECT of only the columns serialize() returns, for read paths that don't need ORM objects."""
+    return select(*[getattr(model, name) for name in model.serialize_columns])
 
-    def __init__(self, user_id, planet_id):
-        self.user_id = user_id
-        self.planet_id = planet_id
-        
+def serialize_row(model, row):
+    # same dict serialize() builds, straight from a serialized_select() row
+    return dict(zip(model.serialize_columns, row))
 
-    def __repr__(self):
-        return '<Favorite_Planet %r>' % self.id
-    
-    def serialize(self):
-        return self.planet.serialize()
+# kind values of Favorite.kind, each one is also the name of the target relationship
+FAVORITE_KINDS = ("planet", "character", "vehicle")
 
-class Favorite_Character(db.Model):
-    __tablename__ = 'favorite_character'
+class Favorite(db.Model):
+    __tablename__ = 'favorite'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    user = db.relationship(User)    
-    character_id = db.Column(db.Integer, db.ForeignKey('character.id'))
-    character = db.relationship(Character)
+    # deleting a user deletes their favorites, also when it is done outside the API
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', name='fk_favorite_user_id_user', ondelete='CASCADE'), nullable=False)
+    user = db.relationship(User)
+    kind = db.Column(db.String(20), nullable=False)
+    # points to planet.id, character.id or vehicle.id depending on kind, so there is no foreign key
+    target_id = db.Column(db.Integer, nullable=False)
+    planet = db.relationship(Planet, primaryjoin="and_(Favorite.kind == 'planet', foreign(Favorite.target_id) == Planet.id)", viewonly=True)
+    character = db.relationship(Character, primaryjoin="and_(Favorite.kind == 'character', foreign(Favorite.target_id) == Character.id)", viewonly=True)
+    vehicle = db.relationship(Vehicle, primaryjoin="and_(Favorite.kind == 'vehicle', foreign(Favorite.target_id) == Vehicle.id)", viewonly=True)
 
-    def __init__(self, user_id, character_id):
+    __table_args__ = (
+        # one favorite per user and target, duplicates are rejected by the database
+        db.Index('ux_favorite_user_kind_target', 'user_id', 'kind', 'target_id', unique=True),
+        # used to find (and clean up) every favorite pointing to a given target
+        db.Index('ix_favorite_kind_target', 'kind', 'target_id'),
+    )
+
+    def __init__(self, user_id, kind, target_id):
         self.user_id = user_id
-        self.character_id = character_id
-        
+        self.kind = kind
+        self.target_id = target_id
 
     def __repr__(self):
-        return '<Favorite_Character %r>' % self.id
-    
+        return '<Favorite %r %r>' % (self.kind, self.target_id)
+
     def serialize(self):
-        return self.character.serialize()
-    
-class Favorite_Vehicle(db.Model):
-    __tablename__ = 'favorite_vehicle'
-    id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    user = db.relationship(User)    
-    vehicle_id = db.Column(db.Integer, db.ForeignKey('vehicle.id'))
-    vehicle = db.relationship(Vehicle)
+        return getattr(self, self.kind).serialize()
 
-    def __init__(self, user_id, vehicle_id):
-        
-        self.user_id = user_id
-        self.vehicle_id = vehicle_id
-        
+class TableVersion(db.Model):
+    # bumped by every transaction that writes to the table, see versioning.py
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
 
     def __repr__(self):
-        return '<Favorite_Vehicle %r>' % self.id
-    
-    def serialize(self):
-        return self.vehicle.serialize()
\ No newline at end of file
+        return '<TableVersion %r %r>' % (self.name, self.version)
+
+class IdempotencyKey(db.Model):
+    # responses of the POST requests sent with an Idempotency-Key header, see idempotency.py
+    __tablename__ = 'idempotency_key'
+    # sha1 of the method, path and header value
+    key = db.Column(db.String(40), primary_key=True)
+    # sha1 of the request body, a key can't be reused for another request
+    fingerprint = db.Column(db.String(40), nullable=False)
+    # None while the first request is running
+    status_code = db.Column(db.Integer)
+    content_type = db.Column(db.String(100))
+    body = db.Column(db.LargeBinary)
+    # unix time, the sweeper deletes the expired rows
+    expires = db.Column(db.Integer, nullable=False, index=True)
+
+class FavoriteDocument(db.Model):
+    # GET /favorites/user/<id> of every user, encoded and kept up to date by the writes, see favorite_documents.py
+    __tablename__ = 'favorite_document'
+    # no foreign key: the document of a deleted user is removed in the same transaction, after the user row
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    document = db.Column(db.Text, nullable=False)
@@ -0,0 +1,105 @@
+"""
+Keyset (cursor) pagination for the list endpoints.
+
+Cursors are opaque to clients: they encode the sort key of the last row seen
+and the direction to continue in, so every page is a single indexed range scan
+instead of an OFFSET. The sort always ends with the primary key, which makes
+the key unique.
+"""
+import base64
+import json
+from sqlalchemy import and_, or_
+from utils import APIException
+
+
+def encode_cursor(key, direction):
+    raw = json.dumps({"k": key, "d": direction}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size=1):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        key, direction = data["k"], data["d"]
+    except (ValueError, KeyError, TypeError):
+        raise APIException("Invalid cursor", status_code=400)
+    # cursors from before sorting was supported hold a bare id
+    if isinstance(key, int):
+        key = [key]
+    if direction not in ("next", "prev") or not isinstance(key, list) or len(key) != size:
+        raise APIException("Invalid cursor", status_code=400)
+    if not all(isinstance(value, (int, str)) for value in key):
+        raise APIException("Invalid cursor", status_code=400)
+    return key, direction
+
+
+def parse_limit(value, default, maximum, name="limit"):
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise APIException("%s must be an integer" % name, status_code=400)
+    if limit < 1:
+        raise APIException("%s must be greater than 0" % name, status_code=400)
+    return min(limit, maximum)
+
+
+def keyset_condition(order, key, direction):
+    # (c1, c2, ..., id) "after" (v1, v2, ..., k) in the given directions, written as
+    # c1 >= v1 AND (c1 > v1 OR (c1 = v1 AND c2 > v2) OR ...) so the first column bounds the index scan
+    clauses = []
+    for i, (column, descending) in enumerate(order):
+        forward = descending == (direction == "prev")
+        step = column > key[i] if forward else column < key[i]
+        clauses.append(and_(*[c == v for (c, _), v in zip(order[:i], key[:i])], step))
+    first, descending = order[0]
+    bound = first >= key[0] if descending == (direction == "prev") else first <= key[0]
+    if len(order) == 1:
+        return clauses[0]
+    return and_(bound, or_(*clauses))
+
+
+def page_statement(statement, order, limit, cursor=None):
+    """
+    Adds the keyset condition, ORDER BY and LIMIT to a SELECT, returns (statement, direction).
+    `order` is a list of (column, descending) that ends with the primary key.
+    """
+    direction = "next"
+    if cursor is not None:
+        key, direction = decode_cursor(cursor, len(order))
+        statement = statement.where(keyset_condition(order, key, direction))
+    statement = statement.order_by(*[
+        column.desc() if descending != (direction == "prev") else column.asc()
+        for column, descending in order
+    ])
+    # fetch one extra row to know if there is another page without a COUNT(*)
+    return statement.limit(limit + 1), direction
+
+
+def page_cursors(rows, order, limit, cursor, direction):
+    """Trims the rows fetched by page_statement(), returns (rows, next_cursor, prev_cursor)."""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "prev":
+        rows.reverse()
+    if not rows:
+        return rows, None, None
+
+    first = [getattr(rows[0], column.key) for column, _ in order]
+    last = [getattr(rows[-1], column.key) for column, _ in order]
+    if direction == "next":
+        next_cursor = encode_cursor(last, "next") if has_more else None
+        prev_cursor = encode_cursor(first, "prev") if cursor is not None else None
+    else:
+        next_cursor = encode_cursor(last, "next")
+        prev_cursor = encode_cursor(first, "prev") if has_more else None
+    return rows, next_cursor, prev_cursor
+
+
+def paginate(session, statement, order, limit, cursor=None):
+    """Returns (rows, next_cursor, prev_cursor) for one page of `statement` sorted by `order`."""
+    statement, direction = page_statement(statement, order, limit, cursor)
+    rows = session.execute(statement).all()
+    return page_cursors(rows, order, limit, cursor, direction)
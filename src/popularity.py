@@ -0,0 +1,156 @@
+"""
+Most favorited planets, characters and vehicles (`GET /popular/<kind>?top=N`).
+
+Every worker keeps the number of favorites of each target in memory, in a list
+sorted by count, so the top N is a slice. The counts are loaded with one
+GROUP BY over the (kind, target_id) index on the first request, then:
+- the favorite handlers of this worker move targets up and down the ranking as
+  they commit
+- every POPULAR_REFRESH_SECONDS, when the favorite table version shows writes
+  this worker hasn't seen (other workers, the admin), the counts are reloaded
+  in the background. The versions produced by the handlers of this worker don't
+  count, see versioning.local_write()
+- the counts are also reloaded at the next check when the handlers changed them
+  while they were being loaded (the load may or may not have counted those), and
+  at least every POPULAR_RECONCILE_SECONDS whatever the versions say, which
+  corrects any drift of the in-memory counts
+"""
+import bisect
+import logging
+import threading
+import time
+from collections import defaultdict
+from sqlalchemy import func, select
+from models import db, Favorite, Planet, Character, Vehicle
+from versioning import read_versions, foreign_writes
+
+logger = logging.getLogger(__name__)
+
+POPULAR_MODELS = {"planet": Planet, "character": Character, "vehicle": Vehicle}
+
+
+class Ranking:
+    """Favorite counts of one kind, sorted by count (descending) then id."""
+
+    def __init__(self, counts=None):
+        self._counts = {id: count for id, count in (counts or {}).items() if count > 0}
+        self._sorted = sorted((-count, id) for id, count in self._counts.items())
+        self._lock = threading.Lock()
+
+    def change(self, id, delta):
+        with self._lock:
+            old = self._counts.get(id, 0)
+            new = max(old + delta, 0)
+            if old:
+                del self._sorted[bisect.bisect_left(self._sorted, (-old, id))]
+            if new:
+                bisect.insort(self._sorted, (-new, id))
+                self._counts[id] = new
+            else:
+                self._counts.pop(id, None)
+
+    def remove(self, id):
+        with self._lock:
+            old = self._counts.pop(id, 0)
+            if old:
+                del self._sorted[bisect.bisect_left(self._sorted, (-old, id))]
+
+    def top(self, n):
+        with self._lock:
+            return [(id, -count) for count, id in self._sorted[:n]]
+
+
+class Popularity:
+    """The Rankings of this worker: builds them, keeps them up to date and reloads them."""
+
+    def __init__(self, refresh_seconds=60, reconcile_seconds=600):
+        self.refresh_seconds = refresh_seconds
+        self.reconcile_seconds = reconcile_seconds
+        self._rankings = None
+        self._versions = None
+        self._checked = 0
+        self._loaded = 0
+        self._build_lock = threading.Lock()
+        self._refreshing = False
+        # load() is running / a handler changed the counts meanwhile / so the counts may be off
+        self._lock = threading.Lock()
+        self._loading = False
+        self._missed = False
+        self._stale = False
+
+    def load(self, app):
+        counts = defaultdict(dict)
+        with app.app_context():
+            versions = read_versions(("favorite",))
+            statement = select(Favorite.kind, Favorite.target_id, func.count()).group_by(Favorite.kind, Favorite.target_id)
+            for kind, target_id, count in db.session.execute(statement):
+                counts[kind][target_id] = count
+            db.session.remove()
+        return {kind: Ranking(counts[kind]) for kind in POPULAR_MODELS}, versions
+
+    def reload(self, app):
+        with self._lock:
+            self._loading = True
+            self._missed = False
+        try:
+            rankings, versions = self.load(app)
+            with self._lock:
+                self._rankings, self._versions = rankings, versions
+                self._loaded = time.monotonic()
+                self._stale = self._missed
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def ensure_built(self, app):
+        if self._rankings is not None:
+            return
+        with self._build_lock:
+            if self._rankings is None:
+                started = time.perf_counter()
+                self.reload(app)
+                self._checked = time.monotonic()
+                logger.info("favorite rankings built in %.2fs", time.perf_counter() - started)
+
+    def maybe_refresh(self, app):
+        # same schedule as the search index: at most every refresh_seconds, in the background
+        if self._refreshing or time.monotonic() - self._checked < self.refresh_seconds:
+            return
+        self._checked = time.monotonic()
+        self._refreshing = True
+
+        def refresh():
+            try:
+                with app.app_context():
+                    versions = read_versions(("favorite",))
+                    db.session.remove()
+                reconcile = self._stale or time.monotonic() - self._loaded >= self.reconcile_seconds
+                if reconcile or foreign_writes(("favorite",), self._versions, versions):
+                    with self._build_lock:
+                        self.reload(app)
+                else:
+                    self._versions = versions
+            finally:
+                self._refreshing = False
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def change(self, kind, target_id, delta):
+        rankings = self._current()
+        if rankings is not None:
+            rankings[kind].change(target_id, delta)
+
+    def remove(self, kind, target_id):
+        rankings = self._current()
+        if rankings is not None:
+            rankings[kind].remove(target_id)
+
+    def _current(self):
+        # the handlers call change/remove after their commit: while load() runs it may
+        # or may not see the write, a delta can't be replayed on its counts
+        with self._lock:
+            if self._loading:
+                self._missed = True
+            return self._rankings
+
+    def top(self, kind, n):
+        return self._rankings[kind].top(n)
@@ -0,0 +1,79 @@
+"""
+Read replicas (READ_REPLICA_URLS): GET and HEAD requests read from one of the
+replica engines, everything else goes to the primary (DATABASE_URL).
+
+- the replicas take turns (round robin); one that fails to connect or drops
+  its connections is left out for REPLICA_EJECT_SECONDS, and when all of them
+  are out the reads go back to the primary
+- after a write, the response sets a short lived cookie that keeps that
+  client's reads on the primary (read your writes) for READ_YOUR_WRITES_SECONDS,
+  longer than the replication lag should ever be
+- writes are never routed: a flush or a request other than GET/HEAD always
+  uses the primary
+"""
+import itertools
+import logging
+import time
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+READ_PRIMARY_COOKIE = "read_primary"
+
+
+def reads_from_replica(method, cookies):
+    return method in ("GET", "HEAD") and READ_PRIMARY_COOKIE not in cookies
+
+
+def stick_to_primary(response, seconds):
+    response.set_cookie(READ_PRIMARY_COOKIE, "1", max_age=seconds, httponly=True, samesite="Lax")
+
+
+class ReplicaSet:
+    def __init__(self, engines, eject_seconds=30):
+        self.engines = list(engines)
+        self.eject_seconds = eject_seconds
+        self._turn = itertools.count()
+        self._ejected = {}  # engine -> monotonic time it can be used again
+        for engine in self.engines:
+            # AsyncEngines (asgi.py) raise their errors on the sync engine inside
+            sync_engine = getattr(engine, "sync_engine", engine)
+            event.listen(sync_engine, "handle_error", lambda context, engine=engine: self._on_error(engine, context))
+
+    def choose(self):
+        """The next healthy replica, or None to read from the primary."""
+        now = time.monotonic()
+        for _ in range(len(self.engines)):
+            engine = self.engines[next(self._turn) % len(self.engines)]
+            if self._ejected.get(engine, 0) <= now:
+                return engine
+        return None
+
+    def eject(self, engine):
+        self._ejected[engine] = time.monotonic() + self.eject_seconds
+        logger.warning("read replica %s ejected for %ds", engine.url.render_as_string(hide_password=True), self.eject_seconds)
+
+    def _on_error(self, engine, context):
+        # connect failures have no connection yet; dropped connections are disconnects
+        if context.connection is None or context.is_disconnect:
+            self.eject(engine)
+
+    def status(self):
+        now = time.monotonic()
+        return [{
+            "url": engine.url.render_as_string(hide_password=True),
+            "ejected_for": max(round(self._ejected.get(engine, 0) - now, 1), 0),
+        } for engine in self.engines]
+
+
+class RoutingSession(Session):
+    """db.session: statements go to g.read_replica when the request picked one."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            replica = g.get("read_replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
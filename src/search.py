@@ -0,0 +1,265 @@
+"""
+Name search across planets, characters and vehicles (`GET /search?q=`).
+
+The default backend is an in-memory index per worker:
+- a sorted list of lowercased names answers prefix queries with a binary search
+- a trigram index (trigram -> entry numbers) answers fuzzy queries by ranking the
+  names that share the most trigrams with the query; they only run when no name
+  starts with the query (or with ?fuzzy=1) and read at most MAX_POSTINGS entry
+  numbers, rarest trigrams first
+
+It is built on the first request of each worker, kept up to date by the
+create/delete handlers of this worker and rebuilt in the background when the
+table versions show that another worker (or the admin) wrote to the tables:
+the versions produced by the handlers of this worker don't count, see
+versioning.local_write(). The changes the handlers make while the index is
+being built are replayed on it before it is used.
+
+With SEARCH_BACKEND=database the queries go to the database instead: a prefix
+range on the unique name index, plus pg_trgm similarity on postgres.
+"""
+import bisect
+import logging
+import threading
+import time
+from array import array
+from collections import defaultdict, Counter
+from sqlalchemy import func, select
+from models import db, Planet, Character, Vehicle
+from versioning import read_versions, foreign_writes
+
+logger = logging.getLogger(__name__)
+
+SEARCH_MODELS = {"planet": Planet, "character": Character, "vehicle": Vehicle}
+# entry numbers a fuzzy query reads from the trigram lists, whatever the number of names
+MAX_POSTINGS = 50000
+
+
+def trigrams(text):
+    # same padding as pg_trgm: two spaces before, one after
+    padded = "  %s " % text.lower()
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    def __init__(self):
+        self._keys = []  # sorted (lowercased name, kind, id)
+        self._entries = []  # entry number -> (kind, id, name), None once removed
+        self._sizes = array("i")  # entry number -> number of trigrams of the name
+        self._positions = {}  # (kind, id) -> entry number
+        self._grams = defaultdict(lambda: array("i"))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    @classmethod
+    def from_entries(cls, entries):
+        # sorts once instead of inserting every name in order
+        index = cls()
+        index._entries = list(entries)
+        index._keys = sorted((name.lower(), kind, id) for kind, id, name in index._entries)
+        for position, (kind, id, name) in enumerate(index._entries):
+            index._positions[(kind, id)] = position
+            grams = trigrams(name)
+            index._sizes.append(len(grams))
+            for gram in grams:
+                index._grams[gram].append(position)
+        return index
+
+    def add(self, kind, id, name):
+        with self._lock:
+            if (kind, id) in self._positions:
+                self._remove(kind, id)
+            position = len(self._entries)
+            self._entries.append((kind, id, name))
+            self._positions[(kind, id)] = position
+            bisect.insort(self._keys, (name.lower(), kind, id))
+            grams = trigrams(name)
+            self._sizes.append(len(grams))
+            for gram in grams:
+                self._grams[gram].append(position)
+
+    def remove(self, kind, id):
+        with self._lock:
+            self._remove(kind, id)
+
+    def _remove(self, kind, id):
+        position = self._positions.pop((kind, id), None)
+        if position is None:
+            return
+        name = self._entries[position][2]
+        self._entries[position] = None  # trigram lists keep the number, it is skipped from now on
+        key = (name.lower(), kind, id)
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+
+    def prefix(self, q, limit, kinds):
+        with self._lock:
+            return self._prefix(q.lower(), limit, kinds)
+
+    def _prefix(self, q, limit, kinds):
+        results = []
+        i = bisect.bisect_left(self._keys, (q,))
+        while i < len(self._keys) and len(results) < limit:
+            name, kind, id = self._keys[i]
+            if not name.startswith(q):
+                break
+            if kind in kinds:
+                results.append(self._entries[self._positions[(kind, id)]])
+            i += 1
+        return results
+
+    def fuzzy(self, q, limit, kinds, threshold=0.3):
+        with self._lock:
+            return self._fuzzy(q, limit, kinds, threshold)
+
+    def _fuzzy(self, q, limit, kinds, threshold):
+        query_grams = trigrams(q)
+        shared = Counter()
+        read = 0
+        # the rarest trigrams select the candidates; a trigram found in most names
+        # ("  s", "er ") would cost a pass over the whole index and barely changes the ranking
+        for postings in sorted((self._grams.get(gram, ()) for gram in query_grams), key=len):
+            if read and read + len(postings) > MAX_POSTINGS:
+                break
+            read += len(postings)
+            shared.update(postings)
+        scored = []
+        for position, count in shared.items():
+            entry = self._entries[position]
+            if entry is None or entry[0] not in kinds:
+                continue
+            # same similarity as pg_trgm: shared / (union of both trigram sets)
+            score = count / (len(query_grams) + self._sizes[position] - count)
+            if score >= threshold:
+                scored.append((score, entry))
+        scored.sort(key=lambda item: (-item[0], item[1][2]))
+        return [entry for _, entry in scored[:limit]]
+
+
+class SearchIndex:
+    """Owns the NameIndex of this worker: builds it, refreshes it and answers queries."""
+
+    def __init__(self, refresh_seconds=60):
+        self.refresh_seconds = refresh_seconds
+        self._index = None
+        self._versions = None
+        self._checked = 0
+        self._build_lock = threading.Lock()
+        self._refreshing = False
+        # the add/remove calls made while rebuild() loads the names, None otherwise
+        self._journal = None
+        self._journal_lock = threading.Lock()
+
+    def load(self, app):
+        entries = []
+        with app.app_context():
+            versions = read_versions(tuple(SEARCH_MODELS))
+            for kind, model in SEARCH_MODELS.items():
+                for id, name in db.session.execute(select(model.id, model.name)).yield_per(10000):
+                    entries.append((kind, id, name))
+            db.session.remove()
+        return NameIndex.from_entries(entries), versions
+
+    def rebuild(self, app):
+        # load() may read the rows before the writes of this worker's handlers that run
+        # meanwhile; their versions are local, so nothing would rebuild the index again:
+        # their add/remove calls are journaled and replayed on the new index
+        with self._journal_lock:
+            self._journal = []
+        try:
+            index, versions = self.load(app)
+            with self._journal_lock:
+                for op, args in self._journal:
+                    getattr(index, op)(*args)
+                self._index, self._versions = index, versions
+        finally:
+            with self._journal_lock:
+                self._journal = None
+
+    def ensure_built(self, app):
+        if self._index is not None:
+            return
+        with self._build_lock:
+            if self._index is None:
+                started = time.perf_counter()
+                self.rebuild(app)
+                self._checked = time.monotonic()
+                logger.info("search index built: %d names in %.2fs", len(self._index), time.perf_counter() - started)
+
+    def warm_up(self, app):
+        if self._index is None and not self._build_lock.locked():
+            threading.Thread(target=self.ensure_built, args=(app,), daemon=True).start()
+
+    def maybe_refresh(self, app):
+        # at most every refresh_seconds, compare the table versions in the background
+        # and rebuild when someone else wrote to the tables
+        if self._refreshing or time.monotonic() - self._checked < self.refresh_seconds:
+            return
+        self._checked = time.monotonic()
+        self._refreshing = True
+
+        def refresh():
+            try:
+                with app.app_context():
+                    versions = read_versions(tuple(SEARCH_MODELS))
+                    db.session.remove()
+                if foreign_writes(SEARCH_MODELS, self._versions, versions):
+                    with self._build_lock:
+                        self.rebuild(app)
+                else:
+                    self._versions = versions
+            finally:
+                self._refreshing = False
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def add(self, kind, id, name):
+        self._change("add", kind, id, name)
+
+    def remove(self, kind, id):
+        self._change("remove", kind, id)
+
+    def _change(self, op, *args):
+        with self._journal_lock:
+            if self._journal is not None:
+                self._journal.append((op, args))
+            if self._index is not None:
+                getattr(self._index, op)(*args)
+
+    def search(self, q, limit, kinds, fuzzy=False):
+        index = self._index
+        results = index.prefix(q, limit, kinds)
+        # fuzzy matching reads the trigram lists, only when asked or when nothing starts with q
+        if (fuzzy or not results) and len(results) < limit:
+            seen = {(kind, id) for kind, id, _ in results}
+            for entry in index.fuzzy(q, limit, kinds):
+                if (entry[0], entry[1]) not in seen and len(results) < limit:
+                    results.append(entry)
+        return results
+
+
+def database_search(q, limit, kinds, fuzzy=False):
+    results = []
+    dialect = db.session.get_bind().dialect.name
+    pattern = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    for kind in kinds:
+        model = SEARCH_MODELS[kind]
+        if dialect == "postgresql":
+            # served by the gin_trgm_ops indexes, case insensitive
+            statement = select(model.id, model.name).where(model.name.ilike(pattern, escape="\\")).order_by(model.name)
+        else:
+            # prefix range on the unique index of name, case sensitive
+            statement = select(model.id, model.name).where(model.name >= q, model.name < q + "\U0010ffff").order_by(model.name)
+        results += [(kind, id, name) for id, name in db.session.execute(statement.limit(limit))]
+    results = results[:limit]
+    # same rule as SearchIndex.search
+    if dialect == "postgresql" and (fuzzy or not results) and len(results) < limit:
+        seen = {(kind, id) for kind, id, _ in results}
+        for kind in kinds:
+            model = SEARCH_MODELS[kind]
+            statement = select(model.id, model.name).where(model.name.op("%")(q)).order_by(func.similarity(model.name, q).desc())
+            results += [(kind, id, name) for id, name in db.session.execute(statement.limit(limit)) if (kind, id) not in seen]
+        results = results[:limit]
+    return results
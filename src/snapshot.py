@@ -0,0 +1,53 @@
+"""
+Pre-encoded JSON (and gzip) bodies of the full list endpoints.
+
+A snapshot is tagged with the table version it was built from (see
+versioning.py), so the first request after a write, in any worker, sees a
+version mismatch and rebuilds it; every other request just sends the bytes.
+"""
+import gzip
+import threading
+from flask import Response, current_app
+from models import db, serialized_select, serialize_row
+
+
+class Snapshot:
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6)
+
+
+class SnapshotStore:
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def get(self, model, version):
+        snapshot = self._snapshots.get(model.__tablename__)
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        # one rebuild at a time, requests waiting on the lock reuse the new snapshot
+        with self._lock:
+            snapshot = self._snapshots.get(model.__tablename__)
+            if snapshot is None or snapshot.version != version:
+                rows = db.session.execute(serialized_select(model)).all()
+                items = [serialize_row(model, row) for row in rows]
+                # same bytes jsonify would send
+                body = current_app.json.response(items).get_data()
+                snapshot = Snapshot(version, body)
+                self._snapshots[model.__tablename__] = snapshot
+            return snapshot
+
+    def clear(self):
+        self._snapshots.clear()
+
+
+def snapshot_response(snapshot, request):
+    if "gzip" in request.accept_encodings:
+        response = Response(snapshot.gzip_body, mimetype="application/json")
+        response.content_encoding = "gzip"
+    else:
+        response = Response(snapshot.body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    return response
@@ -0,0 +1,29 @@
+"""
+NDJSON export for the list endpoints: one JSON document per line, streamed
+while the rows are still being fetched so memory stays flat for any table size.
+"""
+from flask import Response, current_app, stream_with_context
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def wants_stream(request):
+    if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def ndjson_lines(session, list_query, batch_size):
+    # stream_results uses a server side cursor on postgres, partitions() keeps at
+    # most one batch of rows in memory and every batch goes out as one chunk
+    statement = list_query.statement().order_by(*[
+        column.desc() if descending else column.asc() for column, descending in list_query.order
+    ]).execution_options(stream_results=True)
+    result = session.execute(statement)
+    for rows in result.partitions(batch_size):
+        yield "".join(current_app.json.dumps(list_query.serialize(row)) + "\n" for row in rows)
+
+
+def ndjson_response(session, list_query, batch_size):
+    return Response(stream_with_context(ndjson_lines(session, list_query, batch_size)), mimetype=NDJSON_MIMETYPE)
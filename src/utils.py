@@ -1,3 +1,4 @@
+import os
 from flask import jsonify, url_for
 
 class APIException(Exception):
@@ -15,13 +16,19 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+def env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
     return len(defaults) >= len(arguments)
 
 def generate_sitemap(app):
-    links = ['/admin/']
+    links = [] if app.config.get('API_ONLY') else ['/admin/']
     for rule in app.url_map.iter_rules():
         # Filter out rules we can't navigate to in a browser
         # and rules that require parameters
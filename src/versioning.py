@@ -0,0 +1,180 @@
+"""
+Per table version counters and the ETags built from them.
+
+Every transaction that writes to a table also increments its row in
+`table_version`, just before it commits, so a conditional GET only needs one primary key lookup to know
+whether anything it would return has changed. The counters live in the
+database, which keeps ETags consistent across gunicorn workers.
+
+The in-memory state of a worker (search index, favorite counts) is kept up to
+date by the handlers that write, and reloaded when the versions show writes it
+hasn't seen. A handler that applies its own writes calls `local_write()` before
+committing: the versions that transaction produces are remembered, and
+`foreign_writes()` doesn't count them.
+"""
+import hashlib
+import threading
+from functools import wraps
+from flask import Response, g, make_response, request
+from sqlalchemy import event, insert, select, text, update
+from models import db, TableVersion
+
+_BUMPS = "table_version_bumps"
+_LOCAL = "local_write_tables"
+_PRODUCED = "local_write_versions"
+# versions produced by local_write() transactions of this worker, not yet seen by foreign_writes()
+_local_versions = {}
+_local_lock = threading.Lock()
+# a consumer that never calls foreign_writes() (no /search yet) mustn't make this grow forever;
+# a version forgotten is only an unneeded reload
+MAX_LOCAL_VERSIONS = 10000
+
+
+# SQLAlchemy 1.4 only compiles RETURNING for postgres, SQLite has it since 3.35
+BUMP_RETURNING = text("UPDATE table_version SET version = version + 1 WHERE name = :name RETURNING version")
+
+
+def has_returning(dialect):
+    return dialect.full_returning or (dialect.name == "sqlite" and dialect.dbapi.sqlite_version_info >= (3, 35))
+
+
+def bump(session, table):
+    """The changes.on_write listener: the version is incremented when the transaction commits."""
+    if table != TableVersion.__tablename__:
+        session.info.setdefault(_BUMPS, set()).add(table)
+
+
+def _bump(session, table):
+    connection = session.connection()
+    local = table in session.info.get(_LOCAL, ())
+    version = None
+    if local and has_returning(connection.dialect):
+        version = connection.execute(BUMP_RETURNING, {"name": table}).scalar()
+        found = version is not None
+    else:
+        found = connection.execute(
+            update(TableVersion.__table__)
+            .where(TableVersion.name == table)
+            .values(version=TableVersion.version + 1)
+        ).rowcount > 0
+    if not found:
+        connection.execute(insert(TableVersion.__table__).values(name=table, version=1))
+        version = 1
+    elif local and version is None:
+        # the row is locked by the update, nobody else can move it before this transaction ends
+        version = connection.execute(select(TableVersion.version).where(TableVersion.name == table)).scalar()
+    if local:
+        session.info.setdefault(_PRODUCED, {})[table] = version
+
+
+def local_write(session, *tables):
+    """The caller applies what this transaction writes to tables to the worker's in-memory state itself."""
+    session.info.setdefault(_LOCAL, set()).update(tables)
+
+
+def foreign_writes(tables, seen, versions):
+    """
+    Whether the tables moved from the `seen` versions to `versions` through transactions
+    other than this worker's local_write() ones; forgets the local versions up to `versions`.
+    """
+    foreign = False
+    with _local_lock:
+        for table in tables:
+            local = _local_versions.get(table, set())
+            if any(version not in local for version in range(seen.get(table, 0) + 1, versions.get(table, 0) + 1)):
+                foreign = True
+            local.difference_update([version for version in local if version <= versions.get(table, 0)])
+    return foreign
+
+
+def _before_commit(session):
+    # the UPDATE locks the row until the commit, so it comes last: the writers of a table
+    # wait for each other's commit only, not for the whole transaction. In table order, no deadlocks
+    session.flush()
+    for table in sorted(session.info.pop(_BUMPS, ())):
+        _bump(session, table)
+
+
+def _after_commit(session):
+    session.info.pop(_LOCAL, None)
+    produced = session.info.pop(_PRODUCED, None)
+    if produced:
+        with _local_lock:
+            for table, version in produced.items():
+                local = _local_versions.setdefault(table, set())
+                local.add(version)
+                if len(local) > MAX_LOCAL_VERSIONS:
+                    local.difference_update(sorted(local)[:len(local) // 2])
+
+
+def _after_rollback(session):
+    session.info.pop(_BUMPS, None)
+    session.info.pop(_LOCAL, None)
+    session.info.pop(_PRODUCED, None)
+
+
+def track(session):
+    # after the other before_commit listeners (favorite_documents.py), which may write too
+    event.listen(session, "before_commit", _before_commit)
+    event.listen(session, "after_commit", _after_commit)
+    event.listen(session, "after_soft_rollback", lambda session, previous: _after_rollback(session))
+
+
+def versions_select(tables):
+    return select(TableVersion.name, TableVersion.version).where(TableVersion.name.in_(tables))
+
+
+def read_versions(tables):
+    versions = dict.fromkeys(tables, 0)
+    versions.update(db.session.execute(versions_select(tables)).all())
+    return versions
+
+
+def etag_for(full_path, accept, versions):
+    # the representation depends on the url (path + query string) and on Accept (json or ndjson)
+    key = "%s|%s|%s" % (full_path, accept, ",".join("%s=%s" % item for item in sorted(versions.items())))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def make_etag(versions):
+    return etag_for(request.full_path, request.headers.get("Accept", ""), versions)
+
+
+def matching_etag(etag, if_none_match):
+    """Returns the tag in If-None-Match that matches etag (in any content encoding), or None."""
+    if if_none_match.star_tag:
+        return etag
+    for tag in if_none_match.as_set():
+        if tag == etag or tag.startswith(etag + "-"):
+            return tag
+    return None
+
+
+def conditional_response(etag, view, *args, **kwargs):
+    """Answers 304 when the client already has etag, else calls the view and tags its response."""
+    matched = matching_etag(etag, request.if_none_match)
+    if matched is not None:
+        response = Response(status=304)
+        response.set_etag(matched)
+    else:
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200:
+            return response
+        # a compressed body is a different representation, so it gets its own tag
+        if response.content_encoding:
+            response.set_etag("%s-%s" % (etag, response.content_encoding))
+        else:
+            response.set_etag(etag)
+    response.vary.add("Accept")
+    return response
+
+
+def conditional(*tables):
+    """Adds an ETag made from the versions of tables to the view and answers 304 when the client already has it."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            g.table_versions = read_versions(tables)
+            return conditional_response(make_etag(g.table_versions), view, *args, **kwargs)
+        return wrapper
+    return decorator
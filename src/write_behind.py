@@ -0,0 +1,190 @@
+"""
+Write-behind queue for the favorite POST/DELETE routes (FAVORITES_WRITE_BEHIND=1).
+
+The handlers check the request as usual, then queue the change and answer
+without a transaction of their own. A background thread of the worker keeps
+the last change per (user, kind, target), so a favorite toggled on and off
+before a flush is written once, and applies the queue every FAVORITES_FLUSH_MS
+or as soon as FAVORITES_FLUSH_BATCH changes are waiting: one transaction with
+one INSERT for the additions and one DELETE for the removals.
+
+Changes are applied with "ensure present" / "ensure absent" statements, so a
+change another worker already made is not an error; only the changes a flush
+really made are passed to `on_applied` (the favorite rankings of the worker)
+after its commit. Until its flush, a change
+is only visible in the worker that queued it: `pending(user_id)` lets
+GET /favorites/user/<id> merge them, so users read their own writes (as long as
+the next request reaches the same worker, the flush is a few milliseconds away
+otherwise). The queue is drained when the process exits normally and before
+the routes that need the table as it is (user, entity deletes, the batch).
+"""
+import atexit
+import logging
+import threading
+from sqlalchemy import delete, insert, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Favorite
+import changes
+import favorite_documents
+import versioning
+
+logger = logging.getLogger(__name__)
+
+ADD = "add"
+REMOVE = "remove"
+
+
+class FavoriteQueue:
+    def __init__(self, flush_ms=10, batch_size=500, on_applied=None):
+        self.flush_seconds = flush_ms / 1000
+        self.batch_size = batch_size
+        # called after each commit with the (delta, kind, target_id) of the favorites it changed
+        self.on_applied = on_applied
+        self._ops = {}       # (user_id, kind, target_id) -> ADD / REMOVE, in arrival order
+        self._flushing = {}  # taken by the flush in progress, still pending until it commits
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self.app = None
+        self.flushes = 0
+        self.flushed = 0
+
+    def init_app(self, app):
+        self.app = app
+        atexit.register(self.drain)
+
+    def add(self, user_id, kind, target_id):
+        """Queues the addition; False if it is waiting already (two requests for the same favorite)."""
+        return self._put((user_id, kind, target_id), ADD)
+
+    def remove(self, user_id, kind, target_id):
+        """Queues the removal; False if it is waiting already."""
+        return self._put((user_id, kind, target_id), REMOVE)
+
+    def _put(self, key, op):
+        self._start()
+        with self._lock:
+            if self._ops.get(key, self._flushing.get(key)) == op:
+                return False
+            self._ops.pop(key, None)
+            self._ops[key] = op
+            if len(self._ops) == 1 or len(self._ops) >= self.batch_size:
+                self._wake.notify()
+            return True
+
+    def state(self, user_id, kind, target_id):
+        """ADD or REMOVE if a change of this favorite is waiting, None otherwise."""
+        key = (user_id, kind, target_id)
+        with self._lock:
+            return self._ops.get(key, self._flushing.get(key))
+
+    def pending(self, user_id):
+        """{(kind, target_id): ADD / REMOVE} of the changes of this user that are not in the table yet."""
+        with self._lock:
+            merged = dict(self._flushing)
+            merged.update(self._ops)
+        return {(kind, target_id): op for (user, kind, target_id), op in merged.items() if user == user_id}
+
+    def _start(self):
+        # on the first change, not at import: threads don't survive gunicorn's fork
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ops:
+                    self._wake.wait()
+                # give the batch flush_seconds to fill up, unless it is full already
+                if len(self._ops) < self.batch_size:
+                    self._wake.wait(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("favorite flush failed")
+
+    def flush(self):
+        """Applies the waiting changes in one transaction; returns how many."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._ops:
+                    return 0
+                self._flushing, self._ops = self._ops, {}
+            try:
+                with self.app.app_context():
+                    try:
+                        self._applied(apply(self._flushing))
+                    except Exception:
+                        # one bad change (e.g. its user was just deleted) must not lose the others
+                        logger.exception("favorite batch of %d failed, applying one by one", len(self._flushing))
+                        for key, op in self._flushing.items():
+                            try:
+                                self._applied(apply({key: op}))
+                            except Exception:
+                                logger.exception("dropped favorite %s %s", op, key)
+            finally:
+                count = len(self._flushing)
+                with self._lock:
+                    self._flushing = {}
+            self.flushes += 1
+            self.flushed += count
+            return count
+
+    def _applied(self, applied):
+        if self.on_applied is not None and applied:
+            self.on_applied(applied)
+
+    def drain(self):
+        while self.flush():
+            pass
+
+
+def insert_ignoring_duplicates(dialect):
+    # the unique index on (user_id, kind, target_id) decides, another worker may have added it
+    if dialect == "postgresql":
+        return postgresql.insert(Favorite).on_conflict_do_nothing()
+    if dialect == "sqlite":
+        return sqlite.insert(Favorite).on_conflict_do_nothing()
+    return None
+
+
+def apply(ops):
+    """Writes ops in one transaction; returns the (delta, kind, target_id) of the favorites it changed."""
+    try:
+        key_columns = tuple_(Favorite.user_id, Favorite.kind, Favorite.target_id)
+        existing = set(db.session.execute(
+            select(Favorite.user_id, Favorite.kind, Favorite.target_id).where(key_columns.in_(list(ops)))
+        ).all())
+        adds = [key for key, op in ops.items() if op == ADD]
+        removes = [key for key, op in ops.items() if op == REMOVE]
+        applied = [(1, key[1], key[2]) for key in adds if key not in existing]
+        applied += [(-1, key[1], key[2]) for key in removes if key in existing]
+        if adds:
+            statement = insert_ignoring_duplicates(db.engine.dialect.name)
+            if statement is None:
+                adds = [key for key in adds if key not in existing]
+                statement = insert(Favorite)
+            if adds:
+                db.session.execute(statement, [{"user_id": u, "kind": k, "target_id": t} for u, k, t in adds])
+        if removes:
+            db.session.execute(
+                delete(Favorite).where(key_columns.in_(removes)).execution_options(synchronize_session=False)
+            )
+        # the rankings count what is returned; when some changes were made already (by another
+        # worker), the version stays foreign and the rankings reload
+        if len(applied) == len(ops):
+            versioning.local_write(db.session, "favorite")
+        changes.record(db.session, "favorite")
+        for (user_id, kind, target_id), op in ops.items():
+            favorite_documents.mark_favorite(db.session, user_id, kind, target_id, op == ADD)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        db.session.remove()
+    return applied
@@ -0,0 +1,105 @@
+"""
+Fixtures of the test suite: the app on a SQLite file of its own, emptied before
+every test, and helpers to fill it.
+
+    pipenv install --dev && pipenv run pytest
+"""
+import os
+import sys
+import threading
+import pytest
+from sqlalchemy import event
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    os.environ["DATABASE_URL"] = "sqlite:///%s" % (tmp_path_factory.mktemp("db") / "test.db")
+    os.environ["API_ONLY"] = "1"
+    # no index build in a background thread, its statements would be counted by the tests
+    os.environ["SEARCH_BACKEND"] = "database"
+    import app as module
+    return module.create_app()
+
+
+@pytest.fixture
+def module(app):
+    import app as module
+    return module
+
+
+@pytest.fixture
+def db(app, module):
+    import versioning
+    from models import db
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+    # the in-memory state of the worker describes the previous database
+    module.entity_cache.clear()
+    module.list_snapshots.clear()
+    module.idempotency.cache.clear()
+    versioning._local_versions.clear()
+    yield db
+    with app.app_context():
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
+
+
+@pytest.fixture
+def session(app, db):
+    with app.app_context():
+        yield db.session
+        db.session.remove()
+
+
+@pytest.fixture
+def seed(client, app, db):
+    """seed(users, targets) creates the users and `targets` planets, characters and vehicles through the API."""
+    from models import User
+    import datetime
+
+    def seed(users=2, targets=3):
+        for i in range(targets):
+            assert client.post("/planet", json={
+                "name": "planet %d" % i, "population": i, "climate": "arid", "terrain": "desert", "diameter": i,
+                "rotation_period": 1, "orbital_period": 1, "gravity": "1", "surface_water": 1, "created": "2021-09-01"
+            }).status_code == 200
+            assert client.post("/character", json={
+                "name": "character %d" % i, "height": 1, "mass": 1, "hair_color": "none", "age": 1, "homeworld": "x", "species": "human"
+            }).status_code == 200
+            assert client.post("/vehicle", json={
+                "name": "vehicle %d" % i, "model": "m", "manufacturer": "m", "length": 1, "max_atmosphering_speed": 1,
+                "passengers": i, "cargo_capacity": 1, "consumables": "none"
+            }).status_code == 200
+        with app.app_context():
+            for i in range(users):
+                db.session.add(User("user %d" % i, "user%d@example.com" % i, "secret", datetime.date(2021, 9, 1)))
+            db.session.commit()
+    return seed
+
+
+@pytest.fixture
+def count_statements(app, db):
+    """count_statements(fn) runs fn() and returns the number of SQL statements it sent from this thread."""
+    def count_statements(fn):
+        count = [0]
+        thread = threading.get_ident()
+
+        def before_cursor_execute(*args):
+            if threading.get_ident() == thread:
+                count[0] += 1
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        try:
+            fn()
+        finally:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        return count[0]
+    return count_statements
@@ -0,0 +1,100 @@
+"""DELETE /<entity>?ids=: the rows that exist go with their favorites, the others are reported."""
+import pytest
+from sqlalchemy import event, func, select
+import favorite_documents
+from models import Favorite, FavoriteDocument, Planet, User
+from popularity import Popularity
+
+
+@pytest.fixture
+def popularity(app, module, monkeypatch):
+    popularity = Popularity(refresh_seconds=3600, reconcile_seconds=3600)
+    monkeypatch.setattr(module, "popularity", popularity)
+    return popularity
+
+
+def planet_ids(session):
+    session.expire_all()
+    return session.execute(select(Planet.id).order_by(Planet.id)).scalars().all()
+
+
+def test_not_found(client, seed, session):
+    seed(users=0, targets=3)
+    response = client.delete("/planet?ids=2,7,3,2&ids=9")
+    assert response.status_code == 200
+    assert response.get_json() == {"deleted": 2, "not_found": [7, 9]}
+    assert planet_ids(session) == [1]
+    assert client.delete("/planet?ids=2,3").get_json() == {"deleted": 0, "not_found": [2, 3]}
+
+
+def test_batches(app, client, db, seed, session, monkeypatch):
+    seed(users=0, targets=7)
+    monkeypatch.setitem(app.config, "BULK_BATCH_SIZE", 2)
+    deletes = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.startswith("DELETE FROM planet"):
+            deletes.append(statement)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        # batches [1, 2] [4, 5] [6, 8] [9]: the last one has nothing to delete, the third one only 6
+        response = client.delete("/planet?ids=1,2,4,5,6,8,9")
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    assert response.get_json() == {"deleted": 5, "not_found": [8, 9]}
+    assert len(deletes) == 3
+    assert planet_ids(session) == [3, 7]
+
+
+def test_invalid_ids(app, client, seed, session, monkeypatch):
+    seed(users=0, targets=3)
+    monkeypatch.setitem(app.config, "BULK_DELETE_MAX", 2)
+    assert client.delete("/planet").status_code == 400
+    assert client.delete("/planet?ids=").status_code == 400
+    assert client.delete("/planet?ids=1,x").status_code == 400
+    assert client.delete("/planet?ids=1,2,3").status_code == 400
+    # repeats count once
+    assert client.delete("/planet?ids=1,2,2,1").status_code == 200
+    assert planet_ids(session) == [3]
+
+
+@pytest.fixture
+def favorites(client, seed):
+    seed(users=3, targets=3)
+    for user_id in (1, 2, 3):
+        for kind in ("planet", "vehicle"):
+            for target_id in range(1, user_id + 1):
+                assert client.post("/favorite/user/%d/%s/%d" % (user_id, kind, target_id)).status_code == 200
+
+
+def assert_favorites(session, expected):
+    session.expire_all()
+    assert session.execute(select(func.count()).select_from(Favorite)).scalar() == expected
+    user_ids = session.execute(select(User.id)).scalars().all()
+    stored = dict(session.execute(select(FavoriteDocument.user_id, FavoriteDocument.document)).all())
+    assert stored == favorite_documents.build(session, user_ids)
+
+
+def popular(client, kind):
+    return {item["id"]: item["favorites"] for item in client.get("/popular/%s" % kind).get_json()["results"]}
+
+
+def test_delete_targets(client, favorites, session, popularity):
+    assert popular(client, "planet") == {1: 3, 2: 2, 3: 1}
+    assert client.delete("/planet?ids=1,3,4").get_json() == {"deleted": 2, "not_found": [4]}
+    assert_favorites(session, 8)
+    assert popular(client, "planet") == {2: 2}
+    assert popular(client, "vehicle") == {1: 3, 2: 2, 3: 1}
+    assert [item["id"] for item in client.get("/favorites/user/3").get_json()["favorite_planet"]] == [2]
+
+
+def test_delete_users(client, favorites, session, popularity):
+    assert popular(client, "vehicle") == {1: 3, 2: 2, 3: 1}
+    assert client.delete("/user?ids=1,3,4").get_json() == {"deleted": 2, "not_found": [4]}
+    assert_favorites(session, 4)
+    assert session.execute(select(FavoriteDocument.user_id)).scalars().all() == [2]
+    assert popular(client, "planet") == {1: 1, 2: 1}
+    assert popular(client, "vehicle") == {1: 1, 2: 1}
+    assert client.get("/favorites/user/3").status_code == 404
@@ -0,0 +1,91 @@
+"""The stored favorite documents stay equal to what favorite_documents.build() makes from the tables."""
+import pytest
+from sqlalchemy import select
+import favorite_documents
+from models import FavoriteDocument, Planet, User
+
+
+def assert_documents_match(session):
+    session.expire_all()
+    user_ids = session.execute(select(User.id)).scalars().all()
+    stored = dict(session.execute(select(FavoriteDocument.user_id, FavoriteDocument.document)).all())
+    assert stored == favorite_documents.build(session, user_ids)
+
+
+@pytest.fixture
+def favorites(client, seed):
+    seed(users=3, targets=3)
+    for user_id in (1, 2, 3):
+        for kind in ("planet", "character", "vehicle"):
+            for target_id in (1, 2):
+                assert client.post("/favorite/user/%d/%s/%d" % (user_id, kind, target_id)).status_code == 200
+
+
+def test_add(client, favorites, session):
+    assert client.post("/favorite/user/1/planet/3").status_code == 200
+    assert_documents_match(session)
+    assert [item["id"] for item in client.get("/favorites/user/1").get_json()["favorite_planet"]] == [1, 2, 3]
+
+
+def test_add_existing(client, favorites, session):
+    assert client.post("/favorite/user/1/planet/1").status_code == 400
+    assert_documents_match(session)
+
+
+def test_remove(client, favorites, session):
+    assert client.delete("/favorite/user/1/character/1").status_code == 200
+    assert client.delete("/favorite/user/1/character/3").status_code == 404
+    assert_documents_match(session)
+    assert [item["id"] for item in client.get("/favorites/user/1").get_json()["favorite_character"]] == [2]
+
+
+def test_batch(client, favorites, session):
+    response = client.post("/favorites/user/2/batch", json=[
+        {"op": "add", "kind": "vehicle", "id": 3},
+        {"op": "remove", "kind": "planet", "id": 1},
+        {"op": "add", "kind": "character", "id": 1},
+    ])
+    assert response.status_code == 200
+    assert_documents_match(session)
+
+
+def test_delete_target(client, favorites, session):
+    assert client.delete("/planet/2").status_code == 200
+    assert_documents_match(session)
+    assert client.delete("/vehicle?ids=1,3").status_code == 200
+    assert_documents_match(session)
+    body = client.get("/favorites/user/3").get_json()
+    assert [item["id"] for item in body["favorite_planet"]] == [1]
+    assert [item["id"] for item in body["favorite_vehicle"]] == [2]
+
+
+def test_change_target(client, favorites, session):
+    # e.g. from the admin: rebuilds the documents of the users who favorited it
+    session.get(Planet, 1).name = "renamed"
+    session.commit()
+    assert_documents_match(session)
+    assert client.get("/favorites/user/1").get_json()["favorite_planet"][0]["name"] == "renamed"
+
+
+def test_delete_user(client, favorites, session):
+    assert client.delete("/user/2").status_code == 200
+    assert_documents_match(session)
+    assert session.get(FavoriteDocument, 2) is None
+    assert client.get("/favorites/user/2").status_code == 404
+    assert client.delete("/user?ids=1,3").status_code == 200
+    assert session.execute(select(FavoriteDocument)).first() is None
+
+
+def test_rebuild(client, favorites, session):
+    session.query(FavoriteDocument).delete()
+    session.commit()
+    assert favorite_documents.rebuild(session) == (3, 0)
+    assert_documents_match(session)
+
+
+def test_etag_is_per_user(client, favorites):
+    tag = client.get("/favorites/user/1").headers["ETag"]
+    assert client.post("/favorite/user/2/planet/3").status_code == 200
+    assert client.get("/favorites/user/1", headers={"If-None-Match": tag}).status_code == 304
+    assert client.post("/favorite/user/1/planet/3").status_code == 200
+    assert client.get("/favorites/user/1", headers={"If-None-Match": tag}).status_code == 200
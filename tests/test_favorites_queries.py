@@ -0,0 +1,40 @@
+"""GET /favorites/user/<id> sends the same number of statements however many favorites the user has."""
+from sqlalchemy import delete
+from models import FavoriteDocument, FAVORITE_KINDS
+
+
+def add_favorites(client, user_id, per_kind):
+    for kind in FAVORITE_KINDS:
+        for target_id in range(1, per_kind + 1):
+            assert client.post("/favorite/user/%d/%s/%d" % (user_id, kind, target_id)).status_code == 200
+
+
+def statements_per_user(client, count_statements, user_ids):
+    counts = []
+    for user_id in user_ids:
+        def get():
+            response = client.get("/favorites/user/%d" % user_id)
+            assert response.status_code == 200
+        counts.append(count_statements(get))
+    return counts
+
+
+def test_stored_document(client, seed, count_statements):
+    seed(users=2, targets=10)
+    add_favorites(client, 1, 1)
+    add_favorites(client, 2, 10)
+    few, many = statements_per_user(client, count_statements, (1, 2))
+    assert few == many
+
+
+def test_without_stored_document(client, seed, session, count_statements):
+    seed(users=2, targets=10)
+    add_favorites(client, 1, 1)
+    add_favorites(client, 2, 10)
+    # users from before `flask favorites rebuild`: the eager loading fallback
+    session.execute(delete(FavoriteDocument))
+    session.commit()
+    few, many = statements_per_user(client, count_statements, (1, 2))
+    assert few == many
+    body = client.get("/favorites/user/2").get_json()
+    assert all(len(body["favorite_%s" % kind]) == 10 for kind in FAVORITE_KINDS)
@@ -0,0 +1,83 @@
+"""Idempotency-Key on the POST routes: replays, conflicts and keys released after errors."""
+import hashlib
+from sqlalchemy import func, select
+from models import IdempotencyKey, Planet
+
+PLANET = {
+    "name": "Tatooine", "population": 200000, "climate": "arid", "terrain": "desert", "diameter": 10465,
+    "rotation_period": 23, "orbital_period": 304, "gravity": "1", "surface_water": 1, "created": "2021-09-01"
+}
+
+
+def post_planet(client, key, body=PLANET):
+    return client.post("/planet", json=body, headers={"Idempotency-Key": key})
+
+
+def planets(session):
+    return session.execute(select(func.count()).select_from(Planet)).scalar()
+
+
+def test_replay(client, session, module):
+    first = post_planet(client, "key-1")
+    assert first.status_code == 200
+    assert "Idempotent-Replayed" not in first.headers
+    replayed = post_planet(client, "key-1")
+    assert replayed.status_code == 200
+    assert replayed.headers["Idempotent-Replayed"] == "true"
+    assert replayed.get_data() == first.get_data()
+    # from the table when the LRU doesn't have it (another worker)
+    module.idempotency.cache.clear()
+    assert post_planet(client, "key-1").get_data() == first.get_data()
+    assert planets(session) == 1
+
+
+def test_key_is_scoped_to_the_route(client, seed):
+    seed(users=1, targets=1)
+    headers = {"Idempotency-Key": "key-1"}
+    assert client.post("/favorite/user/1/planet/1", headers=headers).status_code == 200
+    assert client.post("/favorite/user/1/vehicle/1", headers=headers).status_code == 200
+    assert "Idempotent-Replayed" not in client.post("/favorite/user/1/character/1", headers=headers).headers
+
+
+def test_in_progress(client, app, module, session):
+    key = hashlib.sha1(b"POST /planet key-1").hexdigest()
+    with app.app_context():
+        # what the first request does before running its view
+        assert module.idempotency.claim(key, hashlib.sha1(b"first").hexdigest()) is None
+    assert post_planet(client, "key-1").status_code == 409
+    assert planets(session) == 0
+
+
+def test_different_body(client, session):
+    assert post_planet(client, "key-1").status_code == 200
+    response = post_planet(client, "key-1", dict(PLANET, name="Alderaan"))
+    assert response.status_code == 422
+    assert planets(session) == 1
+
+
+def test_released_after_an_error_response(client, seed, session):
+    seed(users=1, targets=1)
+    headers = {"Idempotency-Key": "key-1"}
+    assert client.post("/favorite/user/1/planet/1").status_code == 200
+    # already a favorite: 400, not stored
+    assert client.post("/favorite/user/1/planet/1", headers=headers).status_code == 400
+    assert session.execute(select(IdempotencyKey)).first() is None
+    assert client.delete("/favorite/user/1/planet/1").status_code == 200
+    response = client.post("/favorite/user/1/planet/1", headers=headers)
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+
+
+def test_released_after_an_exception(client, session):
+    # the view fails on the missing fields
+    assert post_planet(client, "key-1", {"name": "Tatooine"}).status_code == 500
+    assert session.execute(select(IdempotencyKey)).first() is None
+    response = post_planet(client, "key-1")
+    assert response.status_code == 200
+    assert "Idempotent-Replayed" not in response.headers
+    assert planets(session) == 1
+
+
+def test_invalid_key(client):
+    assert post_planet(client, "").status_code == 400
+    assert post_planet(client, "x" * 256).status_code == 400
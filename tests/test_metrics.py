@@ -0,0 +1,27 @@
+"""GET /metrics counts every SQL statement of a request once, however many apps the process created."""
+import re
+
+# what create_app() sets up in app.py
+APP_GLOBALS = ("read_replicas", "metrics", "compression", "entity_cache", "list_snapshots", "search_index", "popularity", "favorite_queue")
+
+
+def statements_sum(client, route):
+    body = client.get("/metrics").get_data(as_text=True)
+    match = re.search(r'^sql_statements_per_request_sum\{method="GET",route="%s"\} (\S+)$' % re.escape(route), body, re.M)
+    return float(match.group(1)) if match else 0
+
+
+def test_second_app(client, module, monkeypatch, seed, count_statements):
+    seed(users=1, targets=2)
+    saved = {name: getattr(module, name) for name in APP_GLOBALS}
+    for name, value in saved.items():
+        monkeypatch.setattr(module, name, value)
+    # e.g. the benchmarks or a script next to the workers' app
+    module.create_app()
+    for name, value in saved.items():
+        setattr(module, name, value)
+
+    before = statements_sum(client, "/favorites/user/<int:user_id>")
+    statements = count_statements(lambda: client.get("/favorites/user/1"))
+    assert statements > 0
+    assert statements_sum(client, "/favorites/user/<int:user_id>") - before == statements
@@ -0,0 +1,64 @@
+"""GET /popular/<kind>: the in-memory favorite counts are reloaded when they may be off."""
+import time
+import pytest
+from popularity import Popularity
+
+
+@pytest.fixture
+def popularity(module, monkeypatch):
+    popularity = Popularity(refresh_seconds=3600, reconcile_seconds=3600)
+    monkeypatch.setattr(module, "popularity", popularity)
+    return popularity
+
+
+def counts(client, kind="planet"):
+    return {item["id"]: item["favorites"] for item in client.get("/popular/%s" % kind).get_json()["results"]}
+
+
+def refreshed(client, popularity):
+    """The counts after a check of the table versions, and the reload it started if any."""
+    popularity._checked = 0
+    counts(client)
+    deadline = time.monotonic() + 5
+    while popularity._refreshing and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return counts(client)
+
+
+def test_own_writes_are_counted(client, seed, popularity):
+    seed(users=2, targets=2)
+    assert client.post("/favorite/user/1/planet/1").status_code == 200
+    assert counts(client) == {1: 1}
+    assert client.post("/favorite/user/2/planet/1").status_code == 200
+    assert client.post("/favorite/user/2/planet/2").status_code == 200
+    assert client.delete("/favorite/user/1/planet/1").status_code == 200
+    assert refreshed(client, popularity) == {1: 1, 2: 1}
+    assert popularity._loaded and not popularity._stale
+
+
+def test_reconcile_corrects_drift(client, seed, popularity):
+    seed(users=1, targets=2)
+    assert client.post("/favorite/user/1/planet/1").status_code == 200
+    assert counts(client) == {1: 1}
+    # no write of another worker: only the reconciliation notices
+    popularity.change("planet", 2, 3)
+    assert refreshed(client, popularity) == {1: 1, 2: 3}
+    popularity.reconcile_seconds = 0
+    assert refreshed(client, popularity) == {1: 1}
+
+
+def test_write_during_the_load(app, client, seed, popularity, monkeypatch):
+    seed(users=1, targets=2)
+    load = popularity.load
+
+    def slow_load(app):
+        loaded = load(app)
+        # committed after the GROUP BY: neither in the counts nor applied to them
+        assert client.post("/favorite/user/1/planet/2").status_code == 200
+        return loaded
+    monkeypatch.setattr(popularity, "load", slow_load)
+    popularity.ensure_built(app)
+    monkeypatch.setattr(popularity, "load", load)
+    assert popularity._stale
+    assert refreshed(client, popularity) == {2: 1}
+    assert not popularity._stale
@@ -0,0 +1,58 @@
+"""The in-memory search index keeps the names this worker writes while it is being built."""
+import pytest
+import search
+from search import SearchIndex
+
+PLANET = {
+    "name": "Tatooine", "population": 200000, "climate": "arid", "terrain": "desert", "diameter": 10465,
+    "rotation_period": 23, "orbital_period": 304, "gravity": "1", "surface_water": 1, "created": "2021-09-01"
+}
+
+
+@pytest.fixture
+def index(app, module, monkeypatch):
+    index = SearchIndex()
+    # built by the tests, not by a thread on the first request
+    monkeypatch.setattr(index, "warm_up", lambda app: None)
+    monkeypatch.setattr(module, "search_index", index)
+    monkeypatch.setitem(app.config, "SEARCH_BACKEND", "memory")
+    return index
+
+
+def during_load(monkeypatch, write):
+    """Runs write() once, after load() read the names and before the index is made of them."""
+    from_entries = search.NameIndex.from_entries
+
+    def slow_from_entries(entries):
+        monkeypatch.setattr(search.NameIndex, "from_entries", from_entries)
+        write()
+        return from_entries(entries)
+    monkeypatch.setattr(search.NameIndex, "from_entries", slow_from_entries)
+
+
+def names(client, q):
+    return [result["name"] for result in client.get("/search?q=%s" % q).get_json()["results"]]
+
+
+def test_write_during_the_first_build(app, client, seed, index, monkeypatch):
+    seed(users=0, targets=2)
+
+    def write():
+        assert client.post("/planet", json=PLANET).status_code == 200
+    during_load(monkeypatch, write)
+    index.ensure_built(app)
+    assert names(client, "tatoo") == ["Tatooine"]
+    assert names(client, "planet") == ["planet 0", "planet 1"]
+
+
+def test_writes_during_a_rebuild(app, client, seed, index, monkeypatch):
+    seed(users=0, targets=2)
+    index.ensure_built(app)
+
+    def write():
+        assert client.post("/planet", json=PLANET).status_code == 200
+        assert client.delete("/planet/1").status_code == 200
+    during_load(monkeypatch, write)
+    index.rebuild(app)
+    assert names(client, "tatoo") == ["Tatooine"]
+    assert names(client, "planet") == ["planet 1"]
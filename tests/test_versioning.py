@@ -0,0 +1,38 @@
+"""Table versions: the writes of this worker's handlers are told apart from everyone else's."""
+from sqlalchemy import text
+from versioning import foreign_writes, read_versions
+
+
+def versions(app, tables):
+    with app.app_context():
+        return read_versions(tables)
+
+
+def test_own_writes_are_not_foreign(app, client, seed):
+    seed(users=1, targets=2)
+    before = versions(app, ("planet", "favorite"))
+    assert client.post("/favorite/user/1/planet/1").status_code == 200
+    assert client.delete("/planet/2").status_code == 200
+    after = versions(app, ("planet", "favorite"))
+    assert after["planet"] > before["planet"] and after["favorite"] > before["favorite"]
+    assert not foreign_writes(("planet", "favorite"), before, after)
+
+
+def test_other_writes_are_foreign(app, client, seed, session):
+    seed(users=1, targets=2)
+    before = versions(app, ("planet",))
+    assert client.delete("/planet/1").status_code == 200
+    # another worker, a script or the admin
+    session.execute(text("UPDATE table_version SET version = version + 1 WHERE name = 'planet'"))
+    session.commit()
+    assert client.delete("/planet/2").status_code == 200
+    assert foreign_writes(("planet",), before, versions(app, ("planet",)))
+
+
+def test_writes_without_local_write_are_foreign(app, session, seed):
+    from models import Planet
+    seed(users=0, targets=1)
+    before = versions(app, ("planet",))
+    session.get(Planet, 1).name = "renamed"
+    session.commit()
+    assert foreign_writes(("planet",), before, versions(app, ("planet",)))
@@ -0,0 +1,110 @@
+"""FAVORITES_WRITE_BEHIND: the queued changes are merged into GET /favorites/user/<id> until the flush."""
+import pytest
+from sqlalchemy import select
+import favorite_documents
+from models import Favorite, FavoriteDocument
+from popularity import Popularity
+from versioning import foreign_writes, read_versions
+from write_behind import FavoriteQueue
+
+
+@pytest.fixture
+def queue(app, module, monkeypatch):
+    queue = FavoriteQueue(on_applied=module.count_favorites)
+    queue.app = app
+    # no flush thread: the changes stay queued until the test (or a route) drains them
+    monkeypatch.setattr(queue, "_start", lambda: None)
+    monkeypatch.setattr(module, "favorite_queue", queue)
+    yield queue
+    queue.drain()
+
+
+def favorite_ids(response, kind):
+    return [item["id"] for item in response.get_json()["favorite_%s" % kind]]
+
+
+def stored_favorites(session):
+    session.expire_all()
+    return set(session.execute(select(Favorite.user_id, Favorite.kind, Favorite.target_id)).all())
+
+
+def test_pending_changes_are_merged(client, seed, session, queue):
+    seed(users=2, targets=3)
+    assert client.post("/favorite/user/1/planet/1").status_code == 200
+    assert client.post("/favorite/user/1/vehicle/2").status_code == 200
+    queue.drain()
+    assert client.post("/favorite/user/1/planet/2").status_code == 200
+    assert client.delete("/favorite/user/1/vehicle/2").status_code == 200
+    assert stored_favorites(session) == {(1, "planet", 1), (1, "vehicle", 2)}
+
+    response = client.get("/favorites/user/1")
+    assert response.status_code == 200
+    assert favorite_ids(response, "planet") == [1, 2]
+    assert favorite_ids(response, "vehicle") == []
+    assert response.get_json()["favorite_planet"][1]["name"] == "planet 1"
+    # not in the stored document yet: no ETag, other users keep theirs
+    assert "ETag" not in response.headers
+    assert "ETag" in client.get("/favorites/user/2").headers
+
+    queue.drain()
+    assert stored_favorites(session) == {(1, "planet", 1), (1, "planet", 2)}
+    flushed = client.get("/favorites/user/1")
+    assert "ETag" in flushed.headers
+    assert flushed.get_json() == response.get_json()
+    document = session.execute(select(FavoriteDocument.document).where(FavoriteDocument.user_id == 1)).scalar()
+    assert document == favorite_documents.build(session, [1])[1]
+
+
+def test_pending_change_checks(client, seed, session, queue):
+    seed(users=1, targets=2)
+    assert client.post("/favorite/user/1/character/1").status_code == 200
+    assert client.post("/favorite/user/1/character/1").status_code == 400
+    assert client.delete("/favorite/user/1/character/2").status_code == 404
+    # added and removed before the flush: never written
+    assert client.delete("/favorite/user/1/character/1").status_code == 200
+    assert queue.pending(1) == {("character", 1): "remove"}
+    assert favorite_ids(client.get("/favorites/user/1"), "character") == []
+    queue.drain()
+    assert stored_favorites(session) == set()
+
+
+def test_deletes_drain_the_queue(client, seed, session, queue):
+    seed(users=1, targets=2)
+    assert client.post("/favorite/user/1/planet/1").status_code == 200
+    assert client.post("/favorite/user/1/planet/2").status_code == 200
+    assert client.delete("/planet/1").status_code == 200
+    assert queue.pending(1) == {}
+    assert stored_favorites(session) == {(1, "planet", 2)}
+    assert favorite_ids(client.get("/favorites/user/1"), "planet") == [2]
+
+
+def test_concurrent_requests(client, seed, module, queue, monkeypatch):
+    seed(users=1, targets=1)
+    # both requests passed the check before either queued its change
+    monkeypatch.setattr(module, "favorite_exists", lambda *key: False)
+    assert client.post("/favorite/user/1/planet/1").status_code == 200
+    assert client.post("/favorite/user/1/planet/1").status_code == 400
+    monkeypatch.setattr(module, "favorite_exists", lambda *key: True)
+    assert client.delete("/favorite/user/1/planet/1").status_code == 200
+    assert client.delete("/favorite/user/1/planet/1").status_code == 404
+    assert queue.pending(1) == {("planet", 1): "remove"}
+
+
+def test_rankings_count_the_flushed_changes(app, client, seed, session, module, queue, monkeypatch):
+    popularity = Popularity(refresh_seconds=3600, reconcile_seconds=3600)
+    monkeypatch.setattr(module, "popularity", popularity)
+    seed(users=2, targets=1)
+    popularity.ensure_built(app)
+    assert client.post("/favorite/user/1/planet/1").status_code == 200
+    assert client.post("/favorite/user/2/planet/1").status_code == 200
+    assert popularity.top("planet", 10) == []
+    # another worker added the second one first
+    session.add(Favorite(user_id=2, kind="planet", target_id=1))
+    session.commit()
+    with app.app_context():
+        before = read_versions(("favorite",))
+    queue.drain()
+    assert popularity.top("planet", 10) == [(1, 1)]
+    # the flush didn't make all its changes: not a local write, the rankings reload
+    with app.app_context():
+        assert foreign_writes(("favorite",), before, read_versions(("favorite",)))